@@ -1,10 +1,29 @@
 
+from .timeline import Timeline, TimelineStopped
 from .duration import Duration
 from .closed_loop_condition import  ClosedLoopCondition
 from .open_loop_condition import OpenLoopCondition
 from .spatial_temporal import SpatialTemporal
 from .sweep_condition import SweepCondition
 from .csv_formatter import CsvFormatter
+from .compressed_stream import CompressedStream
+from .session_index import SessionIndex, load_session_index
+from .csv_sink import CsvSink
+from .binary_sink import BinarySink
+from .log_writer import LogWriter
+from .fictrac_recorder import FicTracRecorder, read_fictrac_recording
 from .trial import Trial
+from .protocol_schedule import ProtocolSchedule
+from .experiment_socket import ExperimentSocket
+from .clock_sync import ClockSync, ClockSyncService
+from .latency_stats import LatencyStats
+from .display_group import DisplayGroup
+from .runner_registry import ProtocolRunner, RunnerRegistry
+from .session import Session
+from .fictrac_parser import FicTracFrame, FicTracParser
+from .fictrac_service import FicTracService, FicTracSubscription
+from .closed_loop_trace import ClosedLoopTrace
+from .fake_fictrac import FakeFicTrac
+from .log_reader import LogReader
 
-__all__ = ['Duration', 'SpatialTemporal', 'OpenLoopCondition', 'SweepCondition', 'ClosedLoopCondition', 'Trial', 'CsvFormatter']
\ No newline at end of file
+__all__ = ['Timeline', 'TimelineStopped', 'Duration', 'SpatialTemporal', 'OpenLoopCondition', 'SweepCondition', 'ClosedLoopCondition', 'Trial', 'ProtocolSchedule', 'CsvFormatter', 'CompressedStream', 'SessionIndex', 'load_session_index', 'CsvSink', 'BinarySink', 'LogWriter', 'FicTracRecorder', 'read_fictrac_recording', 'LogReader', 'ExperimentSocket', 'ClockSync', 'ClockSyncService', 'LatencyStats', 'DisplayGroup', 'ProtocolRunner', 'RunnerRegistry', 'Session', 'FicTracFrame', 'FicTracParser', 'FicTracService', 'FicTracSubscription', 'ClosedLoopTrace', 'FakeFicTrac']
\ No newline at end of file
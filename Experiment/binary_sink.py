@@ -0,0 +1,289 @@
+"""
+Columnar binary session log. Part of FlyFlix
+
+The file starts with a header (magic and number of message columns), followed by a sequence of
+self-contained chunks. Each chunk stores its rows column by column: the server timestamps as
+int64, then for every message column one type tag per row and dense int64 and float64 arrays
+for the values with these types. Strings are dictionary encoded. Only strings first seen in a
+chunk are stored there, so keys like `panels-tick-rotation` are written once per file.
+
+A chunk is written in a single write, so a file from a crashed session can be read up to the
+last complete chunk. The module can be run as a script to convert a binary log to the CSV
+file `CsvSink` would have written:
+
+    python -m Experiment.binary_sink data/repeater_20230101_120000.ffb
+
+Compressed binary logs (`.ffb.gz`, `.ffb.zst`) are decompressed up to the last complete frame.
+"""
+
+import array
+import csv
+import struct
+import sys
+import time
+import zlib
+
+from .compressed_stream import CompressedStream, open_log
+from .session_index import SessionIndex
+
+MAGIC = b"FFXLOG\x00\x01"
+FILE_HEADER = struct.Struct("<8sH")
+CHUNK_HEADER = struct.Struct("<4sIII")
+CHUNK_MAGIC = b"CHNK"
+COUNT = struct.Struct("<I")
+
+TAG_NONE = 0
+TAG_INT = 1
+TAG_FLOAT = 2
+TAG_STR = 3
+TAG_BOOL = 4
+
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+
+class BinarySink():
+    """
+    Write log rows to a chunked columnar binary file. Use `binary_to_csv` to get the equivalent
+    CSV file.
+    """
+
+    def __init__(self, filename, columns=5, chunk_rows=8192, chunk_seconds=1.0,
+                 compression=None, index=False) -> None:
+        """
+        Open the binary log for writing.
+
+        :param str filename: path of the binary log, by convention ending in `.ffb`
+        :param int columns: number of message columns after the server timestamp
+        :param int chunk_rows: rows are collected until a chunk has this many rows...
+        :param float chunk_seconds: ...or the oldest collected row is this old (in s)
+        :param str compression: None for an uncompressed file, or `gzip` or `zstd` to compress
+            the file in frames with a `CompressedStream`
+        :param bool index: write a `SessionIndex` with the chunk offsets of trials, conditions,
+            and block repetitions to `filename` + `.idx`
+        :rtype: None
+        """
+        self.filename = filename
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.chunk_seconds = chunk_seconds
+        self.strings = {}
+        self.pending = []
+        self.pending_since = None
+        if compression:
+            self.stream = CompressedStream(filename, compression)
+        else:
+            self.stream = open(filename, "wb")
+        self.stream.write(FILE_HEADER.pack(MAGIC, columns))
+        self.stream.flush()
+        self.offset = FILE_HEADER.size
+        self.rows = 0
+        self.index = SessionIndex(f"{filename}.idx", chunked=True) if index else None
+
+    def write(self, rows) -> None:
+        """
+        Collect rows and write a chunk once enough rows are collected or they waited long
+        enough.
+
+        :param list rows: list of rows, each the server timestamp in ns followed by `columns`
+            values
+        :rtype: None
+        """
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending.extend(rows)
+        if len(self.pending) >= self.chunk_rows or \
+                time.monotonic() - self.pending_since >= self.chunk_seconds:
+            self.flush()
+
+    def flush_if_due(self) -> None:
+        """
+        Write the collected rows if the oldest waited `chunk_seconds`, and let a compressed
+        stream write its frame if it is due. The `LogWriter` calls this while no rows arrive.
+
+        :rtype: None
+        """
+        if self.pending and time.monotonic() - self.pending_since >= self.chunk_seconds:
+            self.flush()
+        else:
+            self.stream.flush()
+
+    def flush(self) -> None:
+        """
+        Write all collected rows as one chunk.
+
+        :rtype: None
+        """
+        if self.pending:
+            chunk = self._encode_chunk(self.pending)
+            self.stream.write(chunk)
+            self.stream.flush()
+            if self.index is not None:
+                for number, row in enumerate(self.pending, start=self.rows):
+                    if SessionIndex.is_indexed(row):
+                        self.index.add(row, self.offset, self.offset + len(chunk), number)
+            self.offset += len(chunk)
+            self.rows += len(self.pending)
+            self.pending = []
+
+    def close(self) -> None:
+        """
+        Write the remaining rows and close the file and its index.
+
+        :rtype: None
+        """
+        self.flush()
+        self.stream.close()
+        if self.index is not None:
+            self.index.close()
+
+    def _encode_chunk(self, rows) -> bytes:
+        """
+        (private) Encode rows as a chunk.
+
+        :param list rows: rows to encode
+        :rtype: bytes
+        """
+        new_strings = []
+        timestamps = array.array("q", (row[0] for row in rows))
+        parts = [timestamps.tobytes()]
+        for column in range(1, self.columns + 1):
+            tags = array.array("B")
+            ints = array.array("q")
+            floats = array.array("d")
+            for row in rows:
+                value = row[column] if column < len(row) else None
+                if value is None:
+                    tags.append(TAG_NONE)
+                elif isinstance(value, bool):
+                    tags.append(TAG_BOOL)
+                    ints.append(int(value))
+                elif isinstance(value, int) and INT64_MIN <= value <= INT64_MAX:
+                    tags.append(TAG_INT)
+                    ints.append(value)
+                elif isinstance(value, float):
+                    tags.append(TAG_FLOAT)
+                    floats.append(value)
+                else:
+                    if not isinstance(value, str):
+                        value = str(value)
+                    index = self.strings.get(value)
+                    if index is None:
+                        index = len(self.strings)
+                        self.strings[value] = index
+                        new_strings.append(value)
+                    tags.append(TAG_STR)
+                    ints.append(index)
+            parts += [
+                tags.tobytes(),
+                COUNT.pack(len(ints)), ints.tobytes(),
+                COUNT.pack(len(floats)), floats.tobytes()]
+        encoded = [s.encode("utf-8") for s in new_strings]
+        lengths = array.array("I", (len(s) for s in encoded))
+        payload = b"".join([lengths.tobytes()] + encoded + parts)
+        header = CHUNK_HEADER.pack(CHUNK_MAGIC, len(rows), len(new_strings), len(payload))
+        return header + payload + COUNT.pack(zlib.crc32(payload))
+
+
+def iter_binary_chunks(stream):
+    """
+    Decode the chunks of a binary log. Decoding stops silently at the first incomplete or
+    damaged chunk, for example at the end of a file from a crashed session.
+
+    :param stream: binary file object positioned at the start of the file
+    :returns: generator of `(offset, timestamps, columns, strings)` tuples, one per chunk.
+        `columns` is a list of `(tags, ints, floats)` arrays per message column and `strings`
+        is the dictionary of all strings up to and including this chunk.
+    """
+    magic, columns = FILE_HEADER.unpack(stream.read(FILE_HEADER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{getattr(stream, 'name', 'stream')} is not a FlyFlix binary log")
+    strings = []
+    while True:
+        offset = stream.tell()
+        header = stream.read(CHUNK_HEADER.size)
+        if len(header) < CHUNK_HEADER.size:
+            return
+        chunk_magic, nrows, nstrings, length = CHUNK_HEADER.unpack(header)
+        payload = stream.read(length)
+        crc = stream.read(COUNT.size)
+        if chunk_magic != CHUNK_MAGIC or len(payload) < length or len(crc) < COUNT.size \
+                or COUNT.unpack(crc)[0] != zlib.crc32(payload):
+            return
+        pos = 0
+        lengths = array.array("I")
+        lengths.frombytes(payload[pos:pos + 4 * nstrings])
+        pos += 4 * nstrings
+        for size in lengths:
+            strings.append(payload[pos:pos + size].decode("utf-8"))
+            pos += size
+        timestamps = array.array("q")
+        timestamps.frombytes(payload[pos:pos + 8 * nrows])
+        pos += 8 * nrows
+        decoded = []
+        for _ in range(columns):
+            tags = array.array("B")
+            tags.frombytes(payload[pos:pos + nrows])
+            pos += nrows
+            ints = array.array("q")
+            count = COUNT.unpack_from(payload, pos)[0]
+            ints.frombytes(payload[pos + 4:pos + 4 + 8 * count])
+            pos += 4 + 8 * count
+            floats = array.array("d")
+            count = COUNT.unpack_from(payload, pos)[0]
+            floats.frombytes(payload[pos + 4:pos + 4 + 8 * count])
+            pos += 4 + 8 * count
+            decoded.append((tags, ints, floats))
+        yield offset, timestamps, decoded, strings
+
+
+def iter_binary_rows(stream):
+    """
+    Decode a binary log row by row.
+
+    :param stream: binary file object positioned at the start of the file
+    :returns: generator of rows with the same values that were written
+    """
+    for _, timestamps, columns, strings in iter_binary_chunks(stream):
+        values = []
+        for tags, ints, floats in columns:
+            int_iter = iter(ints)
+            float_iter = iter(floats)
+            column = []
+            for tag in tags:
+                if tag == TAG_INT:
+                    column.append(next(int_iter))
+                elif tag == TAG_FLOAT:
+                    column.append(next(float_iter))
+                elif tag == TAG_STR:
+                    column.append(strings[next(int_iter)])
+                elif tag == TAG_BOOL:
+                    column.append(bool(next(int_iter)))
+                else:
+                    column.append(None)
+            values.append(column)
+        for row in zip(timestamps, *values):
+            yield list(row)
+
+
+def binary_to_csv(binary_filename, csv_filename) -> int:
+    """
+    Convert a binary log to the CSV file that `CsvSink` writes for the same rows.
+
+    :param str binary_filename: path of the binary log, optionally compressed
+    :param str csv_filename: path of the CSV file to write
+    :returns: number of rows written
+    :rtype: int
+    """
+    count = 0
+    with open_log(binary_filename) as source, open(csv_filename, "w") as target:
+        writer = csv.writer(target, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        for row in iter_binary_rows(source):
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        csvname = filename.split(".ffb", 1)[0] + ".csv"
+        print(f"{filename} → {csvname}: {binary_to_csv(filename, csvname)} rows")
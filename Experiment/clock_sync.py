@@ -0,0 +1,279 @@
+"""NTP-style clock synchronisation between server and clients. Part of FlyFlix"""
+
+import json
+import time
+
+class ClockSync():
+    """
+    Model of a client clock (`performance.now()` in ms) in server time (`time.time_ns()`).
+
+    Each burst of ping-pong exchanges keeps only the exchange with the shortest round trip, the
+    one where the client timestamp is closest to the midpoint between sending and receiving on
+    the server. A line through the best exchanges of the recent bursts gives the offset and the
+    drift of the client clock.
+    """
+
+    def __init__(self, window=20) -> None:
+        """
+        Start without a model.
+
+        :param int window: number of recent bursts used for the fit
+        :rtype: None
+        """
+        self.window = window
+        self.burst = []
+        self.points = []
+        self.bursts = 0
+        self.reference_client_ns = None
+        self.offset_ns = None
+        self.slope = 1.0
+        self.rtt_ns = None
+
+    def add(self, sent_ns, client_ms, received_ns) -> None:
+        """
+        Add one ping-pong exchange to the current burst.
+
+        :param int sent_ns: server time when the ping was sent
+        :param float client_ms: client time when the ping was answered
+        :param int received_ns: server time when the pong was received
+        :rtype: None
+        """
+        self.burst.append((received_ns - sent_ns, (sent_ns + received_ns) // 2, client_ms))
+
+    def end_burst(self) -> bool:
+        """
+        Keep the exchange with the shortest round trip of the burst and fit the model.
+
+        :returns: False if the burst was empty
+        :rtype: bool
+        """
+        if not self.burst:
+            return False
+        rtt_ns, server_ns, client_ms = min(self.burst)
+        self.burst = []
+        self.bursts += 1
+        self.rtt_ns = rtt_ns
+        self.points = self.points[-(self.window - 1):] + [(round(client_ms * 1e6), server_ns)]
+        self._fit()
+        return True
+
+    def _fit(self) -> None:
+        """
+        Least squares line through the recent points, relative to the latest point. With a single
+        point the drift is assumed to be zero.
+
+        :rtype: None
+        """
+        reference_client, reference_server = self.points[-1]
+        slope = 1.0
+        if len(self.points) > 1:
+            xs = [client - reference_client for client, _ in self.points]
+            ys = [server - reference_server for _, server in self.points]
+            x_mean = sum(xs) / len(xs)
+            y_mean = sum(ys) / len(ys)
+            sxx = sum((x - x_mean) ** 2 for x in xs)
+            if sxx > 0:
+                slope = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sxx
+                reference_server += round(y_mean - slope * x_mean)
+        self.reference_client_ns = reference_client
+        self.offset_ns = reference_server - reference_client
+        self.slope = slope
+
+    def to_server_ns(self, client_ms) -> int:
+        """
+        Map a client timestamp to server time.
+
+        :param float client_ms: client time in ms
+        :returns: server time in ns, None without a model
+        :rtype: int
+        """
+        if self.offset_ns is None:
+            return None
+        client_ns = client_ms * 1e6
+        # the offset is added as an integer, a float the size of epoch ns only resolves 256 ns
+        return round(client_ns + (client_ns - self.reference_client_ns) * (self.slope - 1)) \
+            + self.offset_ns
+
+    def to_client_ms(self, server_ns) -> float:
+        """
+        Map a server timestamp to client time.
+
+        :param int server_ns: server time in ns
+        :returns: client time in ms, None without a model
+        :rtype: float
+        """
+        if self.offset_ns is None:
+            return None
+        reference_server = self.reference_client_ns + self.offset_ns
+        return (self.reference_client_ns + (server_ns - reference_server) / self.slope) / 1e6
+
+    def model(self) -> dict:
+        """
+        Current model, for example to be logged.
+
+        :returns: `offset` (server minus client time in ns at the client time `reference` in
+            ms), `drift` in ppm (server ns per client ns minus one), the shortest round trip `rtt` of the last
+            burst in ns, which bounds the error to `rtt`/2, and the number of `bursts`
+        :rtype: dict
+        """
+        reference = None if self.reference_client_ns is None else self.reference_client_ns / 1e6
+        return {
+            "offset": self.offset_ns,
+            "reference": reference,
+            "drift": (self.slope - 1) * 1e6,
+            "rtt": self.rtt_ns,
+            "bursts": self.bursts}
+
+
+class ClockSyncService():
+    """
+    Runs ping-pong bursts with every registered client, at registration and then periodically,
+    and keeps a `ClockSync` per client. Each new model is logged as `clock-sync` and sent to its
+    client as `clock-model`.
+    """
+
+    def __init__(self, socket_io, log, burst_size=16, interval=30.0) -> None:
+        """
+        Create the service. Call `run` in a background task for the periodic bursts.
+
+        :param SocketIO socket_io: Socket.IO used for communication with the clients
+        :param log: function called with `(sid, key, value)` to store each model
+        :param int burst_size: number of ping-pong exchanges per burst
+        :param float interval: time between bursts in seconds
+        :rtype: None
+        """
+        self.socket_io = socket_io
+        self.log = log
+        self.burst_size = burst_size
+        self.interval = interval
+        self.clocks = {}
+        self.pending = {}
+        self.sequence = 0
+
+    def register(self, sid) -> None:
+        """
+        Start synchronising with a client.
+
+        :param str sid: session ID of the client
+        :rtype: None
+        """
+        self.clocks[sid] = ClockSync()
+        self.start_burst(sid)
+
+    def unregister(self, sid) -> None:
+        """
+        Stop synchronising with a client.
+
+        :param str sid: session ID of the client
+        :rtype: None
+        """
+        self.clocks.pop(sid, None)
+        self.pending.pop(sid, None)
+
+    def start_burst(self, sid) -> None:
+        """
+        Start a burst of ping-pong exchanges. Each ping is sent after the previous pong was
+        received, so the exchanges do not queue behind each other.
+
+        :param str sid: session ID of the client
+        :rtype: None
+        """
+        clock = self.clocks.get(sid)
+        if clock is None:
+            return
+        clock.burst = []
+        self._ping(sid)
+
+    def pong(self, sid, sequence, client_ms) -> None:
+        """
+        Handle the answer to a ping. The burst continues with the next ping or ends with a new
+        model.
+
+        :param str sid: session ID of the client
+        :param int sequence: sequence number of the ping
+        :param float client_ms: client time when the ping was answered
+        :rtype: None
+        """
+        received_ns = time.time_ns()
+        clock = self.clocks.get(sid)
+        pending = self.pending.get(sid)
+        if clock is None or pending is None or pending[0] != sequence:
+            return
+        del self.pending[sid]
+        clock.add(pending[1], client_ms, received_ns)
+        if len(clock.burst) < self.burst_size:
+            self._ping(sid)
+        elif clock.end_burst():
+            self.log(sid, "clock-sync", json.dumps(clock.model()))
+            self._send_model(sid, clock)
+
+    def is_synchronised(self, sid) -> bool:
+        """
+        Check if there is a clock model for a client.
+
+        :param str sid: session ID of the client
+        :rtype: bool
+        """
+        clock = self.clocks.get(sid)
+        return clock is not None and clock.offset_ns is not None
+
+    def to_server_ns(self, sid, client_ms) -> int:
+        """
+        Map a client timestamp to server time.
+
+        :param str sid: session ID of the client
+        :param float client_ms: client time in ms
+        :returns: server time in ns, None if there is no model for the client yet
+        :rtype: int
+        """
+        clock = self.clocks.get(sid)
+        return None if clock is None else clock.to_server_ns(client_ms)
+
+    def to_client_ms(self, sid, server_ns) -> float:
+        """
+        Map a server timestamp to client time.
+
+        :param str sid: session ID of the client
+        :param int server_ns: server time in ns
+        :returns: client time in ms, None if there is no model for the client yet
+        :rtype: float
+        """
+        clock = self.clocks.get(sid)
+        return None if clock is None else clock.to_client_ms(server_ns)
+
+    def run(self) -> None:
+        """
+        Start a burst with every registered client every `interval` seconds.
+
+        :rtype: None
+        """
+        while True:
+            time.sleep(self.interval)
+            for sid in list(self.clocks):
+                self.start_burst(sid)
+
+    def _send_model(self, sid, clock) -> None:
+        """
+        Send the model to its client as `clock-model`, so that the client can map server times
+        to its own clock: a reference time on the client clock in ms, the same time on the server
+        clock in ms, and the server ms per client ms.
+
+        :param str sid: session ID of the client
+        :param ClockSync clock: model of the client clock
+        :rtype: None
+        """
+        reference_server_ns = clock.reference_client_ns + clock.offset_ns
+        self.socket_io.emit(
+            "clock-model",
+            (clock.reference_client_ns / 1e6, reference_server_ns / 1e6, clock.slope), to=sid)
+
+    def _ping(self, sid) -> None:
+        """
+        Send the next ping. Only the sequence number is sent, the send time stays on the server.
+
+        :param str sid: session ID of the client
+        :rtype: None
+        """
+        self.sequence += 1
+        self.pending[sid] = (self.sequence, time.time_ns())
+        self.socket_io.emit("clock-ping", self.sequence, to=sid)
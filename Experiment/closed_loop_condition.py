@@ -1,8 +1,9 @@
 """Closed loop condition, implementing direct feedback from FicTrac"""
 
+import json
+import math
 import warnings
 import time
-import socket
 
 from . import Duration
 
@@ -14,7 +15,8 @@ class ClosedLoopCondition():
         self,
         spatial_temporal=None, trial_duration=None,
         gain=1.0, fps=60,
-        pretrial_duration=Duration(500), posttrial_duration=Duration(500)) -> None:
+        pretrial_duration=Duration(500), posttrial_duration=Duration(500),
+        skip_backlog=False, predict=False, horizon_ms=50) -> None:
         """
         Initialize the closed loop condition.
 
@@ -26,6 +28,13 @@ class ClosedLoopCondition():
         :param Duration pretrial_duration: duration of the pre-trial period, when stimulus is
             shown but not animated.
         :param Duration posttrial_duration: duration of the post-trial period.
+        :param bool skip_backlog: if FicTrac frames arrive faster than they are forwarded, only
+            forward the newest one. The rotation speed is then calculated over the skipped
+            frames.
+        :param bool predict: send the heading instead of the rotation speed, so that the client
+            compensates the latency by extrapolating the heading to the time it renders a frame
+        :param float horizon_ms: longest time in ms the client extrapolates beyond the newest
+            FicTrac frame in `predict` mode
         :rtype: None
         """
 
@@ -41,9 +50,13 @@ class ClosedLoopCondition():
         self.fps = fps
         self.pretrial_duration = pretrial_duration
         self.posttrial_duration = posttrial_duration
+        self.skip_backlog = skip_backlog
+        self.predict = predict
+        self.horizon_ms = horizon_ms
         self.is_triggering = False
+        self._subscription = None
 
-    def trigger(self, socket_io) -> None:
+    def trigger(self, socket_io, timeline=None) -> None:
         """
         Trigger the closed loop condition. Once the ClosedLoopCondition is triggered, the server
         sends updates via the socket specified in `socket_io` and receives updates through the
@@ -51,31 +64,53 @@ class ClosedLoopCondition():
 
         Specifically, it sends the required FPS and the setup of the screen by triggering the
         current SpatialTemporal object. This is followed by a delay specified in the
-        `pretrial_duration`. Then a another thread attempts to connec to the local FicTrac  (see
-        `loop`) and does that for the length of `trial_duration`. At the end the pattern is
+        `pretrial_duration`. Then a another thread subscribes to the FicTrac frames of the server
+        (see `loop`) and does that for the length of `trial_duration`. At the end the pattern is
         stopped and held at the current position for the duration of `posttrial_duration`.
 
         The log file contains a `closedloop-start` and a `closedloop-end` with the same timestamp
         (in nanoseconds) at the beginning and the end of the trial.
 
         :param socket socket_io: The Socket.IO used for communicating with the client.
+        :param Timeline timeline: schedule the durations are placed on
         :rtype: None
         """
         shared_key = time.time_ns()
         socket_io.emit("meta", (shared_key, "closedloop-start", 1))
-        self.trigger_fps(socket_io)
-        self.spatial_temporal.trigger_spatial(socket_io)
+        self.spatial_temporal.trigger_condition_setup(
+            socket_io, self.fps, self.spatial_temporal.get_closedloop_start_deg())
+        self.pretrial_duration.trigger_delay(socket_io, timeline, "closedloop-pretrial")
+        loopthread = self.start_loop(socket_io)
+        try:
+            self.trial_duration.trigger_delay(socket_io, timeline, "closedloop-trial")
+        finally:
+            self.stop_loop(loopthread)
         self.spatial_temporal.trigger_stop(socket_io)
-        self.spatial_temporal.trigger_closedloop_start_position(socket_io)
-        self.pretrial_duration.trigger_delay(socket_io)
+        self.posttrial_duration.trigger_delay(socket_io, timeline, "closedloop-posttrial")
+        socket_io.emit("meta", (shared_key, "closedloop-end", 1))
+
+    def start_loop(self, socket_io):
+        """
+        Start forwarding FicTrac data to the client in a background task, see `loop`.
+
+        :param socket socket_io: The Socket.IO used for communicating with the client.
+        :returns: the background task, to be passed to `stop_loop`
+        """
         self.is_triggering = True
-        loopthread = socket_io.start_background_task(self.loop, socket_io)
-        self.trial_duration.trigger_delay(socket_io)
+        return socket_io.start_background_task(self.loop, socket_io)
+
+    def stop_loop(self, loopthread) -> None:
+        """
+        Stop forwarding FicTrac data and wait for the background task to finish. The task is
+        woken up right away, also if no FicTrac frames arrive.
+
+        :param loopthread: background task returned by `start_loop`
+        :rtype: None
+        """
         self.is_triggering = False
+        if self._subscription is not None:
+            self._subscription.interrupt()
         loopthread.join()
-        self.spatial_temporal.trigger_stop(socket_io)
-        self.posttrial_duration.trigger_delay(socket_io)
-        socket_io.emit("meta", (shared_key, "closedloop-end", 1))
 
     def trigger_fps(self, socket_io) -> None:
         """
@@ -89,54 +124,107 @@ class ClosedLoopCondition():
 
     def loop(self, socket_io):
         """
-        Connect to the local FicTrac, extract the relevant rotational information and forward it
-        to the client via `socket_io`.
+        Subscribe to the FicTrac frames of the server, extract the relevant rotational
+        information and forward it to the client via `socket_io`.
 
-        For the ClosedLoopCondition to work, Fictrac needs to run locally and has a socket
-        communication enabled on port 1717. To achieve this, change `sock_host` to `127.0.0.1`
-        and `sock_port` to `1717` in the FicTrac configuration.
+        For the ClosedLoopCondition to work, Fictrac needs to run locally and send its frames to
+        the `FicTracService` of the server, which `socket_io` provides as `fictrac`. By default,
+        the service listens on `127.0.0.1` port `1717`, so change `sock_host` to `127.0.0.1` and
+        `sock_port` to `1717` in the FicTrac configuration.
 
         This method reads the 17th column from the FicTrac data, which is the "integrated animal
         heading" and calculates the rotation speed considering the time difference to the previous
-        sample. This rotation speed in radians per second is then sent via `socket_io`.
+        update. The heading difference is unwrapped to the shorter turn, so that a heading that
+        crosses 0 and 2pi does not cause a jump in speed. FicTrac usually sends more frames than
+        the client renders, so the frames are coalesced to at most one update per frame interval
+        of the client at `fps`, paced on the monotonic clock: each `speed` message carries the
+        counter of the newest frame, the rotation speed in radians per second over all frames
+        since the previous update, and the counter of the first of these frames. The first frame
+        after a quiet interval is sent right away. At the end, the number of updates and coalesced
+        frames are logged as `closedloop-coalesce`.
+
+        In `predict` mode, each update is a `predict` message instead, with the counter of the
+        newest frame, the heading in radians since the start of the loop, the rotation speed, the
+        server time in ms when FicTrac captured the frame, the prediction horizon in ms, and the
+        counter of the first coalesced frame. Both the heading and the speed are multiplied by
+        the gain.
+
+        While the stimulus is frozen during a pause (`socket_io.paused`), the frames are read but
+        no updates are sent, and the movement of the ball during the pause is not applied later.
+
+        If `socket_io` provides a `closed_loop_trace`, the newest frame of each update is stamped
+        there, so that the end-to-end latency can be measured when the client renders it.
 
         :param socket socket_io: The Socket.IO used for communicating with the client.
         :rtype: None
         """
         shared_key = time.time_ns()
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.settimeout(0.1)
-            prevheading = None
-            prevts = None
-            data = ""
-            try:
-                sock.bind(( '127.0.0.1', 1717))
-                new_data = sock.recv(1)
-                data = new_data.decode('UTF-8')
-                socket_io.emit("meta", (shared_key, "fictrac-connect-ok", 1))
-            except: # If Fictrac doesn't exist # FIXME: catch specific exception
-                socket_io.emit("meta", (shared_key, "fictrac-connect-fail", 0))
-                warnings.warn("Fictrac is not running on 127.0.0.1:1717")
-                return
-
+        fictrac = getattr(socket_io, "fictrac", None)
+        subscription = fictrac.subscribe("closed-loop") if fictrac is not None else None
+        if subscription is None or not subscription.connect():
+            socket_io.emit("meta", (shared_key, "fictrac-connect-fail", 0))
+            warnings.warn("Fictrac is not sending to the server")
+            if subscription is not None:
+                subscription.close()
+            return
+        socket_io.emit("meta", (shared_key, "fictrac-connect-ok", 1))
+        self._subscription = subscription
+        trace = getattr(socket_io, "closed_loop_trace", None)
+
+        interval_ns = 1e9 / self.fps
+        next_update_ns = 0
+        previous = None # frame of the previous update
+        newest = None # newest frame since the previous update
+        first_counter = None
+        angle = 0.0 # unwrapped heading since the start of the loop
+        samples = 0
+        coalesced = {"updates": 0, "samples": 0, "max-samples": 0}
+        try:
             while self.is_triggering:
-                new_data = sock.recv(1024)
-                if not new_data:
-                    break
-                data += new_data.decode('UTF-8')
-                endline = data.find("\n")
-                line = data[:endline]
-                data = data[endline+1:]
-                toks = line.split(", ")
-                if (len(toks) < 24) | (toks[0] != "FT"):
-                    continue # This is not the expected fictrac data package
-                cnt = int(toks[1])
-                heading = float(toks[17])
-                timestamp = float(toks[22])
-                if prevheading:
-                    updateval = (heading-prevheading)/((timestamp-prevts)/1000)
-                    socket_io.emit('speed', (cnt, updateval * self.gain))
-                prevheading = heading
-                prevts = timestamp
-
+                timeout = 0.1
+                if newest is not None:
+                    timeout = max(next_update_ns - time.monotonic_ns(), 0) / 1e9
+                if subscription.wait(timeout):
+                    skipped = subscription.skipped
+                    frames = subscription.read(newest_only=self.skip_backlog)
+                    if previous is None:
+                        previous = frames.pop(0)
+                    if frames:
+                        if newest is None:
+                            first_counter = frames[0].counter
+                        newest = frames[-1]
+                        samples += len(frames) + subscription.skipped - skipped
+                if getattr(socket_io, "paused", False):
+                    previous = newest = None
+                    samples = 0
+                    continue
+                now_ns = time.monotonic_ns()
+                if newest is None or now_ns < next_update_ns:
+                    continue
+                delta_ms = newest.timestamp - previous.timestamp
+                if delta_ms > 0:
+                    if trace is not None:
+                        trace.sample(newest)
+                    turn = (newest.heading-previous.heading+math.pi) % (2*math.pi) - math.pi
+                    if self.predict:
+                        angle += turn
+                        socket_io.emit('predict', (
+                            newest.counter, angle * self.gain, turn / (delta_ms/1000) * self.gain,
+                            newest.capture_ns / 1e6, self.horizon_ms, first_counter))
+                    else:
+                        updateval = turn/(delta_ms/1000)
+                        socket_io.emit(
+                            'speed', (newest.counter, updateval * self.gain, first_counter))
+                    coalesced["updates"] += 1
+                    coalesced["samples"] += samples
+                    coalesced["max-samples"] = max(coalesced["max-samples"], samples)
+                    next_update_ns = now_ns + interval_ns
+                previous = newest
+                newest = None
+                samples = 0
+        finally:
+            self._subscription = None
+            subscription.close()
+
+        socket_io.emit("meta", (shared_key, "closedloop-coalesce", json.dumps(coalesced)))
         socket_io.emit("meta", (shared_key, "fictrac-disconnect-ok", 1))
@@ -0,0 +1,144 @@
+"""End-to-end latency of closed loop feedback. Part of FlyFlix"""
+
+import json
+import time
+
+from collections import OrderedDict
+
+from .latency_stats import LatencyStats
+
+# Messages that carry closed loop feedback, with the FicTrac frame counter as first argument
+CLOSED_LOOP_EVENTS = {"speed", "predict"}
+
+# Stages of a closed loop sample: from the FicTrac capture to the server receive, the server
+# emit, the client receive, and the rendered frame, and all the way from capture to render
+TRACE_STAGES = [
+    "capture-receive", "receive-emit", "emit-receive", "receive-render", "capture-render"]
+
+class ClosedLoopTrace():
+    """
+    Follows closed loop samples from the ball movement to the pattern movement. Each FicTrac
+    frame that a closed loop condition sends is stamped with its capture and receive time. When
+    a display acknowledges the frame that first showed the update, the stamps are completed
+    with the emit time on the server and the receive and render time on the client, mapped to
+    server time by the clock synchronisation. The latencies of each stage are collected per
+    trial and reported after the trial ends: the server stages once per sample, the client
+    stages once per sample and display.
+    """
+
+    def __init__(self, socket_io, log, keep=4096, report_delay=1.0, histogram_ms=2.0) -> None:
+        """
+        Create an empty trace.
+
+        :param SocketIO socket_io: Socket.IO used to send the reports to the control panel
+        :param log: function called with `(sid, key, value)` to store the report of each trial
+        :param int keep: number of recent samples that can be acknowledged
+        :param float report_delay: time in seconds between the end of a trial and its report,
+            so that the displays can acknowledge the last samples of the trial
+        :param float histogram_ms: bin width of the reported histograms in ms
+        :rtype: None
+        """
+        self.socket_io = socket_io
+        self.log = log
+        self.keep = keep
+        self.report_delay = report_delay
+        self.histogram_ms = histogram_ms
+        self.samples = OrderedDict()
+        self.trial = None
+        self.trials = {}
+
+    def sample(self, frame) -> None:
+        """
+        Stamp a FicTrac frame before its update is sent.
+
+        :param FicTracFrame frame: newest frame of the update
+        :rtype: None
+        """
+        self.samples[frame.counter] = (frame.capture_ns, frame.receive_ns, self.trial, set())
+        while len(self.samples) > self.keep:
+            self.samples.popitem(last=False)
+
+    def rendered(self, sid, counter, emit_ns, receive_ns, render_ns) -> dict:
+        """
+        Complete the stamps of a sample with the acknowledgement of a display. The server
+        stages are collected with the first acknowledgement of the sample, the client stages
+        with the first acknowledgement from each display.
+
+        :param str sid: Socket.IO session ID of the display
+        :param int counter: FicTrac frame counter of the update
+        :param int emit_ns: server time when the update was sent
+        :param int receive_ns: server time when the display received the update, None without
+            a clock model of the display
+        :param int render_ns: server time of the frame that first showed the update, None
+            without a clock model of the display
+        :returns: latency of each stage in ms, None if the sample was not stamped
+        :rtype: dict
+        """
+        stamps = self.samples.get(counter)
+        if stamps is None:
+            return None
+        capture_ns, server_receive_ns, trial, acknowledged = stamps
+        server = {
+            "capture-receive": (server_receive_ns - capture_ns) / 1e6,
+            "receive-emit": (emit_ns - server_receive_ns) / 1e6}
+        client = {}
+        if receive_ns is not None and render_ns is not None:
+            client["emit-receive"] = (receive_ns - emit_ns) / 1e6
+            client["receive-render"] = (render_ns - receive_ns) / 1e6
+            client["capture-render"] = (render_ns - capture_ns) / 1e6
+        stats = self.trials.get(trial)
+        if stats is not None and sid not in acknowledged:
+            collect = dict(client) if acknowledged else dict(server, **client)
+            for stage, latency in collect.items():
+                stats[stage].add(latency)
+        acknowledged.add(sid)
+        return dict(server, **client)
+
+    def follow(self, key, value) -> None:
+        """
+        Track the running trial from `meta` messages and report its latencies after it ended.
+
+        :param str key: key of the `meta` message
+        :param value: value of the `meta` message
+        :rtype: None
+        """
+        if key == "trial-start":
+            self.trial = value
+            self.trials[value] = {stage: LatencyStats() for stage in TRACE_STAGES}
+        elif key == "trial-end" and self.trial is not None:
+            trial_id = self.trial
+            self.trial = None
+            self.socket_io.start_background_task(self._report_later, trial_id)
+
+    def report(self, trial_id) -> dict:
+        """
+        Log the latencies of a trial as `closedloop-latency` and send them to the control panel
+        as `closedloop-latency-update`. Trials without closed loop samples are not reported.
+
+        :param trial_id: trial as sent with `trial-start`
+        :returns: for each stage the `LatencyStats` summary in ms with its `histogram`, None
+            without samples
+        :rtype: dict
+        """
+        stats = self.trials.pop(trial_id, None)
+        if stats is None or stats["receive-emit"].count == 0:
+            return None
+        summary = {
+            "trial": trial_id,
+            "stages": {
+                stage: dict(stage_stats.summary(),
+                            histogram=stage_stats.histogram(self.histogram_ms))
+                for stage, stage_stats in stats.items()}}
+        self.log("server", "closedloop-latency", json.dumps(summary))
+        self.socket_io.emit("closedloop-latency-update", summary)
+        return summary
+
+    def _report_later(self, trial_id) -> None:
+        """
+        Report the latencies of a trial after `report_delay`.
+
+        :param trial_id: trial as sent with `trial-start`
+        :rtype: None
+        """
+        time.sleep(self.report_delay)
+        self.report(trial_id)
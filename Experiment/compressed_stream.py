@@ -0,0 +1,204 @@
+"""
+Streaming compression for session logs. Part of FlyFlix
+
+Data is compressed in independent frames: concatenated gzip members or zstd frames. Standard
+tools (`gunzip`, `zstd -d`) decompress the whole file, and a file from a crashed session can be
+decompressed up to the last complete frame with `iter_frames`. The module can be run as a
+script to decompress logs:
+
+    python -m Experiment.compressed_stream data/repeater_20230101_120000.csv.gz
+"""
+
+import gzip
+import io
+import sys
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+DECOMPRESSION_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard else (zlib.error,)
+
+class CompressedStream(io.RawIOBase):
+    """
+    Binary file object that compresses everything written to it in independently decodable
+    frames. The `LogWriter` thread does all the writing, so compression never runs on the
+    eventlet hub.
+    """
+
+    def __init__(self, filename, compression="gzip", level=None,
+                 frame_bytes=4*1024*1024, frame_seconds=5.0) -> None:
+        """
+        Open the compressed file for writing.
+
+        :param str filename: path of the compressed file
+        :param str compression: `gzip` or `zstd` (requires the `zstandard` package)
+        :param int level: compression level, defaults to 6 for gzip and 3 for zstd
+        :param int frame_bytes: uncompressed size after which a frame is written
+        :param float frame_seconds: on `flush()`, a frame is written if the oldest uncompressed
+            data is at least this old (in s). This limits what is lost if the session crashes.
+        :rtype: None
+        """
+        super().__init__()
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"unknown compression '{compression}'")
+        if compression == "zstd":
+            if zstandard is None:
+                raise ImportError("zstd compression requires the 'zstandard' package")
+            self._compressor = zstandard.ZstdCompressor(level=level or 3)
+            self._compress = self._compressor.compress
+        else:
+            self._compress = lambda data: gzip.compress(data, compresslevel=level or 6, mtime=0)
+        self.filename = filename
+        self.compression = compression
+        self.frame_bytes = frame_bytes
+        self.frame_seconds = frame_seconds
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.frames = 0
+        self._file = open(filename, "ab")
+        self._buffer = bytearray()
+        self._buffer_since = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        """
+        Add data to the current frame and write the frame once it is large enough.
+
+        :param bytes data: uncompressed data
+        :returns: number of bytes accepted
+        :rtype: int
+        """
+        if not self._buffer:
+            self._buffer_since = time.monotonic()
+        self._buffer += data
+        if len(self._buffer) >= self.frame_bytes:
+            self.write_frame()
+        return len(data)
+
+    def flush(self) -> None:
+        """
+        Write the current frame if its oldest data is older than `frame_seconds`.
+
+        :rtype: None
+        """
+        if self._buffer and time.monotonic() - self._buffer_since >= self.frame_seconds:
+            self.write_frame()
+
+    def write_frame(self) -> None:
+        """
+        Compress the current frame and write it to disk.
+
+        :rtype: None
+        """
+        if self._buffer:
+            frame = self._compress(bytes(self._buffer))
+            self._file.write(frame)
+            self._file.flush()
+            self.raw_bytes += len(self._buffer)
+            self.compressed_bytes += len(frame)
+            self.frames += 1
+            self._buffer = bytearray()
+
+    def close(self) -> None:
+        """
+        Write the last frame and close the file.
+
+        :rtype: None
+        """
+        if not self.closed:
+            self.write_frame()
+            self._file.close()
+        super().close()
+
+
+def compression_of(filename):
+    """
+    Guess the compression from the file name.
+
+    :param str filename: path of a log file
+    :returns: `gzip`, `zstd`, or None for uncompressed files
+    """
+    for compression, suffix in COMPRESSIONS.items():
+        if str(filename).endswith(suffix):
+            return compression
+    return None
+
+
+def iter_frames(filename, compression=None):
+    """
+    Decompress a file frame by frame. Decompression stops silently at an incomplete or damaged
+    frame, so the data of a crashed session is available up to the last complete frame.
+
+    :param str filename: path of the compressed file
+    :param str compression: `gzip` or `zstd`, guessed from the file name if not given
+    :returns: generator of decompressed frames as bytes
+    """
+    compression = compression or compression_of(filename)
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"cannot guess the compression of '{filename}'")
+    if compression == "zstd" and zstandard is None:
+        raise ImportError("zstd decompression requires the 'zstandard' package")
+    def new_decompressor():
+        if compression == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj()
+        return zlib.decompressobj(wbits=31)
+    with open(filename, "rb") as stream:
+        decompressor = new_decompressor()
+        frame = []
+        data = b""
+        while True:
+            if not data:
+                data = stream.read(1024*1024)
+                if not data:
+                    return
+            try:
+                frame.append(decompressor.decompress(data))
+            except DECOMPRESSION_ERRORS:
+                return
+            if decompressor.eof:
+                yield b"".join(frame)
+                frame = []
+                data = decompressor.unused_data
+                decompressor = new_decompressor()
+            else:
+                data = b""
+
+
+def open_log(filename):
+    """
+    Open a (possibly compressed) binary log file for reading. Compressed files are decompressed
+    into memory up to the last complete frame.
+
+    :param str filename: path of the log file
+    :returns: binary file object
+    """
+    if compression_of(filename) is None:
+        return open(filename, "rb")
+    return io.BytesIO(b"".join(iter_frames(filename)))
+
+
+def decompress_file(filename) -> str:
+    """
+    Decompress a log file next to the compressed file, removing the compression suffix.
+
+    :param str filename: path of the compressed file
+    :returns: path of the decompressed file
+    :rtype: str
+    """
+    target = str(filename)[:-len(COMPRESSIONS[compression_of(filename)])]
+    with open(target, "wb") as stream:
+        for frame in iter_frames(filename):
+            stream.write(frame)
+    return target
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:]:
+        print(f"{name} → {decompress_file(name)}")
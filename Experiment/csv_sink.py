@@ -0,0 +1,103 @@
+"""CSV file sink for the LogWriter. Part of FlyFlix"""
+
+import csv
+import io
+import locale
+import os
+
+from .compressed_stream import CompressedStream
+from .session_index import SessionIndex
+
+class CsvSink():
+    """
+    Write log rows to a CSV file. The output is the same as `CsvFormatter` with a
+    `logging.FileHandler`: every field is quoted and rows are separated by a newline.
+    """
+
+    def __init__(self, filename, compression=None, index=False) -> None:
+        """
+        Open the CSV file for writing.
+
+        :param str filename: path of the CSV file
+        :param str compression: None for plain text, or `gzip` or `zstd` to compress the file
+            in frames with a `CompressedStream`
+        :param bool index: write a `SessionIndex` with the byte offsets of trials, conditions,
+            and block repetitions to `filename` + `.idx`
+        :rtype: None
+        """
+        self.filename = filename
+        if compression:
+            self.stream = CompressedStream(filename, compression)
+        else:
+            self.stream = open(filename, "ab")
+        self.encoding = locale.getpreferredencoding(False)
+        self.offset = 0
+        self.rows = 0
+        self.index = SessionIndex(f"{filename}.idx") if index else None
+
+    def write(self, rows) -> None:
+        """
+        Write a batch of rows and flush them to disk with a single write.
+
+        :param list rows: list of rows, each a list of values
+        :rtype: None
+        """
+        output = io.StringIO()
+        writer = csv.writer(output, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        marks = []
+        for row in rows:
+            if self.index is not None and SessionIndex.is_indexed(row):
+                start = output.tell()
+                writer.writerow(row)
+                marks.append((row, start, output.tell(), self.rows))
+            else:
+                writer.writerow(row)
+            self.rows += 1
+        text = output.getvalue()
+        for row, start, end, row_number in marks:
+            self.index.add(
+                row, self.offset + self._size(text[:start]), self.offset + self._size(text[:end]),
+                row_number)
+        data = self._encode(text)
+        self.stream.write(data)
+        self.stream.flush()
+        self.offset += len(data)
+
+    def flush_if_due(self) -> None:
+        """
+        Let a compressed stream write its frame if it is due. The `LogWriter` calls this while
+        no rows arrive.
+
+        :rtype: None
+        """
+        self.stream.flush()
+
+    def close(self) -> None:
+        """
+        Close the CSV file and its index.
+
+        :rtype: None
+        """
+        self.stream.close()
+        if self.index is not None:
+            self.index.close()
+
+    def _encode(self, text) -> bytes:
+        """
+        (private) Encode text the same way a file opened in text mode would.
+
+        :param str text: text to encode
+        :rtype: bytes
+        """
+        if os.linesep != "\n":
+            text = text.replace("\n", os.linesep)
+        return text.encode(self.encoding)
+
+    def _size(self, text) -> int:
+        """
+        (private) Size of the encoded text in bytes.
+
+        :param str text: text to measure
+        :rtype: int
+        """
+        return len(self._encode(text))
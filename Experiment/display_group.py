@@ -0,0 +1,301 @@
+"""Synchronised presentation on several displays. Part of FlyFlix"""
+
+import json
+import threading
+import time
+
+from .experiment_socket import STIMULUS_EVENTS
+from .latency_stats import LatencyStats
+
+# Messages that are applied at the shared time of the group. `meta` messages keep their order
+# relative to the stimulus messages on the client.
+SYNCHRONISED_EVENTS = STIMULUS_EVENTS | {"meta"}
+
+class DisplayGroup():
+    """
+    Displays that show the same experiment, for example the pages `l4l5left` and `l4l5right` or
+    several tabs of a protocol. Instead of broadcasting a stimulus message that each display
+    applies on arrival, the group sends it to every member together with a shared time in the
+    near future. The time is converted into the clock of each member through the clock
+    synchronisation, and all members apply the change on the frame closest to that time.
+
+    The group stands in for the `ExperimentSocket` it wraps while a protocol runs. Background
+    tasks, such as the closed loop, get the wrapped socket instead and their updates are applied
+    on arrival. They start once the messages sent before them are applied, so that their updates
+    do not arrive before the setup of their condition.
+
+    With a schedule executed by the clients, the commands are applied at the shared start of
+    the schedule plus their time in the schedule, and the group follows the trials through the
+    `meta` messages the server logs.
+    """
+
+    def __init__(self, socket_io, clock_sync, log, lead_ms=50, report_delay=1.0) -> None:
+        """
+        Create an empty group.
+
+        :param ExperimentSocket socket_io: socket used for communication with the displays
+        :param ClockSyncService clock_sync: clock synchronisation with the displays
+        :param log: function called with `(sid, key, value)` to store the readiness of the
+            group and the skew of each trial
+        :param float lead_ms: time between sending a message and applying it on all displays
+        :param float report_delay: time in seconds between the end of a trial and its skew
+            report, so that the displays can acknowledge the last messages of the trial
+        :rtype: None
+        """
+        self.socket_io = socket_io
+        self.clock_sync = clock_sync
+        self.log = log
+        self.lead_ms = lead_ms
+        self.report_delay = report_delay
+        self.members = {}
+        self.trial = None
+        self.trials = {}
+        self.skews = {}
+        # latest time a member applies a message that was sent
+        self.applied_ns = 0
+        # timeline of the running protocol, which stops the wait in `start_background_task`
+        self.timeline = None
+        # set when a member joins, leaves, or gets a clock model, wakes `wait_ready`
+        self._changed = threading.Event()
+
+    def join(self, sid, name) -> None:
+        """
+        Add a display to the group.
+
+        :param str sid: session ID of the display
+        :param str name: name of the display in the skew reports, for example its page
+        :rtype: None
+        """
+        self.members[sid] = name
+        self.log(sid, "display-join", name)
+        self._changed.set()
+
+    def leave(self, sid) -> None:
+        """
+        Remove a display from the group.
+
+        :param str sid: session ID of the display
+        :rtype: None
+        """
+        if self.members.pop(sid, None) is not None:
+            self.log(sid, "display-leave", 1)
+            self._changed.set()
+
+    def synchronised(self, sid) -> None:
+        """
+        Register a new clock model of a display, so that `wait_ready` checks the group again.
+
+        :param str sid: session ID of the display
+        :rtype: None
+        """
+        if sid in self.members:
+            self._changed.set()
+
+    def ready(self) -> list:
+        """
+        Displays with a clock model, which can apply messages at a shared time.
+
+        :returns: session IDs of the ready displays
+        :rtype: list
+        """
+        return [sid for sid in self.members if self.clock_sync.is_synchronised(sid)]
+
+    def waiting(self) -> list:
+        """
+        Displays without a clock model, which apply messages on arrival.
+
+        :returns: names of the displays that are not ready
+        :rtype: list
+        """
+        return [name for sid, name in self.members.items()
+                if not self.clock_sync.is_synchronised(sid)]
+
+    def wait_ready(self, timeline, timeout=10.0) -> bool:
+        """
+        Wait until there is at least one display and all displays of the group are ready. The
+        wait wakes up when a display joins, leaves, or gets a clock model (see `synchronised`),
+        and gives up right away once the timeline is stopped. The displays that are ready and,
+        after a timeout, those that are not are logged.
+
+        The timeout does not stop the protocol: the caller decides whether to start without
+        all displays, which then apply messages on arrival (see `waiting`), or not at all.
+
+        :param Timeline timeline: timeline of the protocol
+        :param float timeout: longest time to wait in seconds
+        :returns: False if the group was not ready before the timeout
+        :rtype: bool
+        :raises TimelineStopped: if the timeline is stopped during the wait
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self._changed.clear()
+            if self.members and not self.waiting():
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.log("server", "display-ready-timeout", json.dumps(self.waiting()))
+                return False
+            timeline.wait_for(self._changed, remaining)
+        self.log("server", "display-ready", json.dumps(list(self.members.values())))
+        return True
+
+    def emit(self, event, *args, **kwargs):
+        """
+        Send a message to the displays. Stimulus and `meta` messages are applied by all members
+        at the same time, `lead_ms` from now, and a `schedule-start` starts the schedule of all
+        members at the same time, at the server time given as its second argument or after its
+        lead time. Members without a clock model and all other messages get the message on
+        arrival.
+
+        :param str event: name of the Socket.IO event
+        :param args: arguments as for `SocketIO.emit`
+        """
+        if not self.members or not args or "to" in kwargs:
+            return self.socket_io.emit(event, *args, **kwargs)
+        if event == "schedule-start":
+            start_ns = args[1] if len(args) > 1 else time.time_ns() + round(args[0] * 1_000_000)
+            for sid in list(self.members):
+                start_ms = self.clock_sync.to_client_ms(sid, start_ns)
+                if start_ms is None:
+                    self.socket_io.emit(event, args[0], to=sid)
+                else:
+                    self.socket_io.emit("schedule-start-at", start_ms, to=sid)
+            return None
+        if event not in SYNCHRONISED_EVENTS:
+            return self.socket_io.emit(event, *args, **kwargs)
+        data = args[0] if isinstance(args[0], tuple) else (args[0],)
+        if event == "meta":
+            self.socket_io.log_meta(*data)
+        apply_ns = time.time_ns() + round(self.lead_ms * 1_000_000)
+        for sid in list(self.members):
+            apply_ms = self.clock_sync.to_client_ms(sid, apply_ns)
+            if apply_ms is None and event == "meta":
+                self.socket_io.socket_io.emit(event, data, to=sid)
+            elif apply_ms is None:
+                self.socket_io.emit(event, data, to=sid)
+            else:
+                self.socket_io.emit_at(event, data, apply_ns, apply_ms, sid)
+                self.applied_ns = max(self.applied_ns, apply_ns)
+        if event != "meta" and self.trial is not None:
+            self.trials[apply_ns] = self.trial
+        return None
+
+    def number_schedule(self, commands, start_ns) -> list:
+        """
+        Give the stimulus commands of a schedule sequence numbers, see
+        `ExperimentSocket.number_schedule`, and assign the time each command is applied to the
+        trial it belongs to, so that the skew of the trial is reported.
+
+        :param list commands: `[time_ms, event, args]` commands of the schedule
+        :param int start_ns: server time when the schedule starts
+        :returns: `[time_ms, event, args, sequence]` commands
+        :rtype: list
+        """
+        numbered = self.socket_io.number_schedule(commands, start_ns)
+        trial = None
+        for time_ms, event, args, sequence in numbered:
+            if event == "meta" and args[1] == "trial-start":
+                trial = args[2]
+            elif event == "meta" and args[1] == "trial-end":
+                trial = None
+            elif sequence is not None and trial is not None:
+                self.trials[start_ns + round(time_ms * 1_000_000)] = trial
+        return numbered
+
+    def rendered(self, sid, apply_ns, render_ns) -> float:
+        """
+        Register the frame that first showed a message on a display.
+
+        :param str sid: session ID of the display
+        :param int apply_ns: server time when the message should have been applied
+        :param int render_ns: server time of the frame that first showed the message
+        :returns: time between the shared time and the frame in ms
+        :rtype: float
+        """
+        skew_ms = (render_ns - apply_ns) / 1e6
+        skews = self.skews.get(self.trials.get(apply_ns))
+        if skews is not None:
+            skews.setdefault(apply_ns, {})[sid] = skew_ms
+        return skew_ms
+
+    def report(self, trial_id) -> dict:
+        """
+        Log the skew of a trial as `display-skew` and send it to the control panel as
+        `display-skew-update`.
+
+        :param trial_id: trial as sent with `trial-start`
+        :returns: for each display the absolute time between the shared time and the frame that
+            showed a message, and the `spread` between the earliest and latest display for each message,
+            as `LatencyStats` summaries in ms
+        :rtype: dict
+        """
+        skews = self.skews.pop(trial_id, {})
+        # commands of a schedule are assigned ahead, keep those of later repetitions of the trial
+        now_ns = time.time_ns()
+        self.trials = {apply_ns: trial for apply_ns, trial in self.trials.items()
+                       if trial != trial_id or apply_ns > now_ns}
+        displays = {}
+        spread = LatencyStats()
+        for by_display in skews.values():
+            for sid, skew_ms in by_display.items():
+                displays.setdefault(sid, LatencyStats()).add(abs(skew_ms))
+            if len(by_display) > 1:
+                spread.add(max(by_display.values()) - min(by_display.values()))
+        summary = {
+            "trial": trial_id,
+            "spread": spread.summary(),
+            "displays": {
+                sid: dict(stats.summary(), name=self.members.get(sid))
+                for sid, stats in displays.items()}}
+        self.log("server", "display-skew", json.dumps(summary))
+        self.socket_io.emit("display-skew-update", summary)
+        return summary
+
+    def start_background_task(self, target, *args, **kwargs):
+        """
+        Start a background task. Arguments that refer to the group are replaced with the wrapped
+        socket, so that streamed updates are not delayed by `lead_ms`. The task starts once the
+        members applied the messages sent before, for example the setup of a closed loop
+        condition, so that its updates are not overwritten by them. The wait ends early once the
+        `timeline` of the protocol is stopped.
+
+        :param target: function to run
+        :raises TimelineStopped: if the timeline is stopped before the task starts
+        """
+        wait_ns = self.applied_ns - time.time_ns()
+        if wait_ns > 0 and self.timeline is not None:
+            self.timeline.sleep(wait_ns / 1e9)
+        elif wait_ns > 0:
+            time.sleep(wait_ns / 1e9)
+        args = [self.socket_io if arg is self else arg for arg in args]
+        return self.socket_io.start_background_task(target, *args, **kwargs)
+
+    def follow(self, key, value) -> None:
+        """
+        Track the running trial from the logged `meta` messages and report its skew after it
+        ended.
+
+        :param str key: key of the `meta` message
+        :param value: value of the `meta` message
+        :rtype: None
+        """
+        if key == "trial-start":
+            self.trial = value
+            self.skews[value] = {}
+        elif key == "trial-end" and self.trial is not None:
+            trial_id = self.trial
+            self.trial = None
+            self.socket_io.start_background_task(self._report_later, trial_id)
+
+    def _report_later(self, trial_id) -> None:
+        """
+        Report the skew of a trial after `report_delay`.
+
+        :param trial_id: trial as sent with `trial-start`
+        :rtype: None
+        """
+        time.sleep(self.report_delay)
+        self.report(trial_id)
+
+    def __getattr__(self, name):
+        return getattr(self.socket_io, name)
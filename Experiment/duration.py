@@ -2,7 +2,7 @@
 
 import time
 
-from datetime import datetime, timedelta
+from .timeline import Timeline
 
 class Duration():
     """
@@ -18,18 +18,21 @@ class Duration():
         """
         self.time_duration = time_duration
 
-    def trigger_delay(self, socket_io) -> None:
+    def trigger_delay(self, socket_io, timeline=None, phase="duration") -> None:
         """
         Triggers the duration. This is basically a server-side delay for the amount of time
-        specified in the constructor.
+        specified in the constructor. With a `timeline`, the delay ends at its deadline on the
+        timeline, otherwise `time_duration` after now.
 
         :param socket socket_io: Socket.IO used for communication with the client. It is part of
             the standard interface, but not used in this particular method.
+        :param Timeline timeline: schedule of the experiment
+        :param str phase: name of the phase on the timeline
         :rtype: None
         """
         shared_key = time.time_ns()
-        ttime = datetime.now() + timedelta(milliseconds=self.time_duration)
         socket_io.emit("meta", (shared_key, "duration-delay-start", self.time_duration))
-        while datetime.now() < ttime:
-            time.sleep(0.01)
+        if timeline is None:
+            timeline = Timeline()
+        timeline.wait(self.time_duration, phase)
         socket_io.emit("meta", (shared_key, "duration-delay-end", self.time_duration))
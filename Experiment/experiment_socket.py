@@ -0,0 +1,196 @@
+"""Socket.IO wrapper used while running experiments. Part of FlyFlix"""
+
+import time
+
+from collections import OrderedDict
+
+# Messages that change the stimulus. They carry a sequence number as their last argument and
+# the client acknowledges the frame that first shows the change.
+STIMULUS_EVENTS = {
+    "speed", "oscillation", "spatial-setup", "rotate-to", "camera-flip", "fps", "condition-setup",
+    "predict"}
+
+# Stimulus messages that set the motion of the pattern, which is frozen while a protocol pauses
+MOTION_EVENTS = {"speed", "oscillation", "condition-setup", "predict"}
+
+class ExperimentSocket():
+    """
+    Wrapper around the Socket.IO server that logs every `meta` message on the server at the time
+    it is sent. The client only acknowledges `meta` messages, so the log no longer depends on
+    the client echoing them back. Stimulus messages get a sequence number, so that the onset
+    acknowledgement of the client can be matched with the time the message was sent. All other
+    methods and messages are passed through unchanged.
+    """
+
+    def __init__(self, socket_io, log_meta, keep=4096) -> None:
+        """
+        Wrap a Socket.IO server.
+
+        :param SocketIO socket_io: Socket.IO used for communication with the client
+        :param log_meta: function called with `(shared_key, key, value)` for every `meta`
+            message before it is sent
+        :param int keep: number of recent stimulus messages that can be acknowledged
+        :rtype: None
+        """
+        self.socket_io = socket_io
+        self.log_meta = log_meta
+        self.keep = keep
+        self.sequence = 0
+        self.sent = OrderedDict()
+        # stimulus commands of the current schedule, which are kept until the next schedule
+        self.scheduled = {}
+        # `FicTracService` that closed loop conditions subscribe to, None without FicTrac
+        self.fictrac = None
+        # `ClosedLoopTrace` that stamps the FicTrac frames of closed loop updates, None to not trace
+        self.closed_loop_trace = None
+        # latest rotation speed and oscillation sent to the displays, restored by `thaw`
+        self.motion = {"speed": (0,), "oscillation": (0, 0)}
+        # set while the stimulus is frozen, closed loop conditions hold their updates
+        self.paused = False
+
+    def emit(self, event, *args, **kwargs):
+        """
+        Send a message to the client. `meta` messages are logged first, stimulus messages get
+        the next sequence number as an additional last argument.
+
+        :param str event: name of the Socket.IO event
+        :param args: arguments as for `SocketIO.emit`
+        """
+        if event == "meta":
+            shared_key, key, value = args[0]
+            self.log_meta(shared_key, key, value)
+        elif event in STIMULUS_EVENTS and args:
+            data = args[0] if isinstance(args[0], tuple) else (args[0],)
+            args = (self._number(event, data),) + args[1:]
+        return self.socket_io.emit(event, *args, **kwargs)
+
+    def emit_at(self, event, data, apply_ns, apply_ms, to):
+        """
+        Send a message to one client that applies it at a given time instead of on arrival. The
+        client receives it as `apply-at` and applies it on the frame closest to `apply_ms`.
+        Stimulus messages get a sequence number as in `emit`, `meta` messages are not logged,
+        since the same message usually goes to several clients.
+
+        :param str event: name of the Socket.IO event
+        :param tuple data: arguments of the message
+        :param int apply_ns: server time when the message should be applied
+        :param float apply_ms: the same time on the clock of the client
+        :param str to: session ID of the client
+        """
+        if event in STIMULUS_EVENTS:
+            data = self._number(event, data, apply_ns)
+        return self.socket_io.emit("apply-at", (apply_ms, event, list(data)), to=to)
+
+    def remember_motion(self, event, data) -> None:
+        """
+        Keep the rotation speed and oscillation of a stimulus message, so that `thaw` can
+        restore them. Messages sent while the stimulus is frozen are not kept.
+
+        :param str event: name of the Socket.IO event
+        :param tuple data: arguments of the message, starting with the shared key
+        :rtype: None
+        """
+        if self.paused or event not in MOTION_EVENTS:
+            return
+        if event == "condition-setup":
+            setup = data[1]
+            self.motion = {"speed": (setup["speed"],),
+                           "oscillation": tuple(setup["oscillation"])}
+        elif event == "speed":
+            self.motion["speed"] = (data[1],)
+        elif event == "oscillation":
+            self.motion["oscillation"] = (data[1], data[2])
+        else:
+            # closed loop updates in `predict` mode restart once the stimulus is thawed
+            self.motion["speed"] = (0,)
+
+    def freeze(self) -> bool:
+        """
+        Hold the pattern where it is: stop the rotation and oscillation on all displays, and
+        hold the updates of closed loop conditions until `thaw`.
+
+        :returns: False if the stimulus was already frozen
+        :rtype: bool
+        """
+        if self.paused:
+            return False
+        self.paused = True
+        shared_key = time.time_ns()
+        self.emit("speed", (shared_key, 0))
+        self.emit("oscillation", (shared_key, 0, 0))
+        return True
+
+    def thaw(self, restore=True) -> bool:
+        """
+        Continue a frozen stimulus with the rotation speed and oscillation from before `freeze`.
+        An oscillation starts again from its center.
+
+        :param bool restore: send the motion from before the freeze, for example not after the
+            protocol was stopped
+        :returns: False if the stimulus was not frozen
+        :rtype: bool
+        """
+        if not self.paused:
+            return False
+        if restore:
+            shared_key = time.time_ns()
+            self.emit("speed", (shared_key,) + self.motion["speed"])
+            self.emit("oscillation", (shared_key,) + self.motion["oscillation"])
+        self.paused = False
+        return True
+
+    def acknowledge(self, sequence):
+        """
+        Look up a stimulus message by its sequence number.
+
+        :param int sequence: sequence number sent with the message
+        :returns: tuple of event, shared key, the time the message was sent in ns (None for
+            commands of a schedule), and the time it should be applied in ns (None if it is
+            applied on arrival), or None if the message is unknown or too old
+        :rtype: tuple
+        """
+        return self.sent.get(sequence) or self.scheduled.get(sequence)
+
+    def number_schedule(self, commands, start_ns) -> list:
+        """
+        Give the stimulus commands of a schedule sequence numbers, so that the client can
+        acknowledge them like stimulus messages. Each command is remembered with the time it is
+        applied, but without a send time, until the next schedule.
+
+        :param list commands: `[time_ms, event, args]` commands of the schedule
+        :param int start_ns: server time when the schedule starts
+        :returns: `[time_ms, event, args, sequence]` commands, the sequence is None for commands
+            that are not stimulus messages
+        :rtype: list
+        """
+        self.scheduled = {}
+        numbered = []
+        for time_ms, event, args in commands:
+            sequence = None
+            if event in STIMULUS_EVENTS:
+                self.sequence += 1
+                sequence = self.sequence
+                self.scheduled[sequence] = (
+                    event, args[0], None, start_ns + round(time_ms * 1_000_000))
+            numbered.append([time_ms, event, args, sequence])
+        return numbered
+
+    def _number(self, event, data, apply_ns=None) -> tuple:
+        """
+        Remember a stimulus message under the next sequence number.
+
+        :param str event: name of the Socket.IO event
+        :param tuple data: arguments of the message, starting with the shared key
+        :param int apply_ns: server time when the message should be applied, if not on arrival
+        :returns: the arguments with the sequence number appended
+        :rtype: tuple
+        """
+        self.remember_motion(event, data)
+        self.sequence += 1
+        self.sent[self.sequence] = (event, data[0], time.time_ns(), apply_ns)
+        if len(self.sent) > self.keep:
+            self.sent.popitem(last=False)
+        return data + (self.sequence,)
+
+    def __getattr__(self, name):
+        return getattr(self.socket_io, name)
@@ -0,0 +1,76 @@
+"""Synthetic FicTrac output for bench tests. Part of FlyFlix"""
+
+import math
+import socket
+import time
+
+class FakeFicTrac():
+    """
+    Sends FicTrac frames over UDP like FicTrac with socket output, so that closed loop
+    conditions and their latency can be tested without a camera, ball, or fly. The heading
+    oscillates around pi, so that it stays within [0, 2pi) without wrapping, and each frame
+    carries the time it was "captured" on the clock of the sender, as FicTrac does for camera
+    frames.
+    """
+
+    def __init__(self, host="127.0.0.1", port=1717, rate=100, amplitude=math.pi/4,
+                 period=4.0) -> None:
+        """
+        Create a sender that is not sending yet.
+
+        :param str host: address of the FlyFlix FicTrac service
+        :param int port: port of the FlyFlix FicTrac service
+        :param float rate: frames per second
+        :param float amplitude: amplitude of the heading oscillation in radians, at most pi
+        :param float period: period of the heading oscillation in seconds
+        :rtype: None
+        """
+        self.address = (host, port)
+        self.rate = rate
+        self.amplitude = amplitude
+        self.period = period
+        self.counter = 0
+        self.running = False
+
+    def frame(self, capture_ns) -> bytes:
+        """
+        Next FicTrac line.
+
+        :param int capture_ns: time of the frame in ns since the epoch
+        :returns: line with the `FT` marker, 23 columns, and a line break
+        :rtype: bytes
+        """
+        self.counter += 1
+        heading = math.pi + self.amplitude * math.sin(2 * math.pi * capture_ns / 1e9 / self.period)
+        columns = [0.0] * 23
+        columns[0] = self.counter
+        columns[16] = heading
+        columns[21] = capture_ns / 1e6
+        columns[22] = self.counter
+        return ("FT, " + ", ".join(repr(value) for value in columns) + "\n").encode()
+
+    def run(self) -> None:
+        """
+        Send frames at `rate` until `stop`. Run it in a background task.
+
+        :rtype: None
+        """
+        self.running = True
+        interval_ns = 1e9 / self.rate
+        next_ns = time.time_ns()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            while self.running:
+                now_ns = time.time_ns()
+                if now_ns < next_ns:
+                    time.sleep((next_ns - now_ns) / 1e9)
+                    continue
+                sock.sendto(self.frame(time.time_ns()), self.address)
+                next_ns = max(next_ns + interval_ns, now_ns)
+
+    def stop(self) -> None:
+        """
+        Stop sending.
+
+        :rtype: None
+        """
+        self.running = False
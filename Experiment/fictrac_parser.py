@@ -0,0 +1,129 @@
+"""Framing and parsing of FicTrac output. Part of FlyFlix"""
+
+from collections import namedtuple
+
+# number of columns of a FicTrac frame, including the `FT` marker
+FICTRAC_COLUMNS = 24
+
+# columns the server reads from every frame: the frame counter, the integrated animal heading,
+# and the FicTrac timestamp in ms
+COUNTER_COLUMN = 1
+HEADING_COLUMN = 17
+TIMESTAMP_COLUMN = 22
+
+# FicTrac timestamps further than this from the receive time are not capture times on the clock of
+# the server, for example positions in a video file
+CAPTURE_WINDOW_NS = 10_000_000_000
+
+class FicTracFrame(namedtuple(
+        "FicTracFrame", ["receive_ns", "counter", "heading", "timestamp", "line"])):
+    """
+    One FicTrac frame: the server time of reception in ns, the frame counter, the integrated
+    animal heading, the FicTrac timestamp in ms, and the received line. All columns are only
+    converted to floats when `values` is read, for example by the recorder.
+    """
+
+    __slots__ = ()
+
+    @property
+    def values(self) -> list:
+        """
+        All columns after the `FT` marker as floats.
+
+        :rtype: list
+        """
+        return [float(tok) for tok in self.line.split(b", ")[1:]]
+
+    @property
+    def capture_ns(self) -> int:
+        """
+        Server time when the frame was captured. FicTrac stamps camera frames with the time since
+        the epoch on its host, which is the server clock if FicTrac runs on the server. For other
+        timestamps, such as positions in a video file, this is the receive time.
+
+        :rtype: int
+        """
+        capture_ns = round(self.timestamp * 1e6)
+        if abs(capture_ns - self.receive_ns) < CAPTURE_WINDOW_NS:
+            return capture_ns
+        return self.receive_ns
+
+
+# creates a frame from a tuple without the argument handling of the namedtuple constructor
+_new_frame = tuple.__new__
+
+
+class FicTracParser():
+    """
+    Splits the bytes FicTrac sends into lines and parses each line into a `FicTracFrame`. A
+    datagram can hold several lines, and a line can be split across datagrams, so incomplete
+    lines are kept until the rest arrives. Only the counter, heading, and timestamp columns are
+    converted, and the line is never decoded.
+    """
+
+    def __init__(self, max_pending=65536) -> None:
+        """
+        Create a parser without pending bytes.
+
+        :param int max_pending: bytes of an incomplete line that are kept, longer lines are
+            dropped and counted as malformed
+        :rtype: None
+        """
+        self.max_pending = max_pending
+        self.pending = b""
+        self.frames = 0
+        self.malformed = 0
+
+    def feed(self, data, receive_ns) -> list:
+        """
+        Parse all complete lines of the received bytes.
+
+        :param bytes data: received bytes
+        :param int receive_ns: server time when the bytes were received
+        :returns: frames in the order FicTrac sent them
+        :rtype: list
+        """
+        if self.pending:
+            data = self.pending + data
+        lines = data.split(b"\n")
+        self.pending = lines.pop()
+        if len(self.pending) > self.max_pending:
+            self.pending = b""
+            self.malformed += 1
+        return self._parse_lines(lines, receive_ns)
+
+    def parse(self, line, receive_ns):
+        """
+        Parse one line without its line break.
+
+        :param bytes line: line of FicTrac output, columns separated by `, `
+        :param int receive_ns: server time when the line was received
+        :returns: the frame, or None if the line is not a FicTrac frame
+        :rtype: FicTracFrame
+        """
+        frames = self._parse_lines([line], receive_ns)
+        return frames[0] if frames else None
+
+    def _parse_lines(self, lines, receive_ns) -> list:
+        """
+        Parse complete lines, counting those that are not FicTrac frames as malformed.
+
+        :param list lines: lines without their line breaks
+        :param int receive_ns: server time when the lines were received
+        :returns: frames in the order of the lines
+        :rtype: list
+        """
+        frames = []
+        for line in lines:
+            toks = line.split(b", ")
+            if len(toks) >= FICTRAC_COLUMNS and toks[0] == b"FT":
+                try:
+                    frames.append(_new_frame(FicTracFrame, (
+                        receive_ns, int(toks[COUNTER_COLUMN]), float(toks[HEADING_COLUMN]),
+                        float(toks[TIMESTAMP_COLUMN]), line)))
+                except ValueError:
+                    self.malformed += 1
+            elif line.strip():
+                self.malformed += 1
+        self.frames += len(frames)
+        return frames
@@ -0,0 +1,89 @@
+"""
+Server-side recording of all FicTrac frames. Part of FlyFlix
+
+A recording starts with a header (magic and the number of FicTrac data columns) followed by
+fixed size records: the server receive time in ns (int64), the trial id and the condition
+number within the trial (int32 each, -1 outside of trials), and all FicTrac data columns after
+the `FT` marker as float64, starting with the frame counter. Use `read_fictrac_recording` to
+load a recording as a NumPy structured array.
+"""
+
+import struct
+
+import numpy as np
+
+MAGIC = b"FFXFT\x00\x01\x00"
+FILE_HEADER = struct.Struct("<8sH")
+
+class FicTracRecorder():
+    """
+    `LogWriter` sink for FicTrac frames. Each row is the LogWriter timestamp followed by the
+    receive time, trial id, condition number, and the FicTrac columns.
+    """
+
+    def __init__(self, filename) -> None:
+        """
+        Open the recording. The header is written with the first frame, once the number of
+        FicTrac columns is known.
+
+        :param str filename: path of the recording, by convention ending in `.fictrac`
+        :rtype: None
+        """
+        self.filename = filename
+        self.stream = open(filename, "wb")
+        self.columns = None
+        self.record = None
+        self.frames = 0
+
+    def write(self, rows) -> None:
+        """
+        Write a batch of frames. Frames with a different number of columns than the first frame
+        are padded with NaN or truncated.
+
+        :param list rows: rows of `[logged_ns, receive_ns, trial, condition, *columns]`
+        :rtype: None
+        """
+        if self.columns is None:
+            self.columns = len(rows[0]) - 4
+            self.record = struct.Struct("<qii" + "d" * self.columns)
+            self.stream.write(FILE_HEADER.pack(MAGIC, self.columns))
+        data = []
+        for row in rows:
+            values = row[4:4 + self.columns]
+            if len(values) < self.columns:
+                values = list(values) + [float("nan")] * (self.columns - len(values))
+            data.append(self.record.pack(row[1], row[2], row[3], *values))
+        self.stream.write(b"".join(data))
+        self.stream.flush()
+        self.frames += len(rows)
+
+    def close(self) -> None:
+        """
+        Close the recording.
+
+        :rtype: None
+        """
+        self.stream.close()
+
+
+def read_fictrac_recording(filename) -> np.ndarray:
+    """
+    Load a FicTrac recording. An incomplete last record (from a crashed session) is ignored.
+
+    :param str filename: path of the recording
+    :returns: structured array with the fields `receive_ns`, `trial`, `condition`, and
+        `columns` (the FicTrac data columns, `columns[:, 0]` is the frame counter)
+    :rtype: numpy.ndarray
+    """
+    with open(filename, "rb") as stream:
+        data = stream.read()
+    if len(data) < FILE_HEADER.size:
+        return np.zeros(0, dtype=[("receive_ns", "<i8"), ("trial", "<i4"),
+                                  ("condition", "<i4"), ("columns", "<f8", (0,))])
+    magic, columns = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{filename} is not a FlyFlix FicTrac recording")
+    dtype = np.dtype([("receive_ns", "<i8"), ("trial", "<i4"), ("condition", "<i4"),
+                      ("columns", "<f8", (columns,))])
+    count = (len(data) - FILE_HEADER.size) // dtype.itemsize
+    return np.frombuffer(data, dtype, count, FILE_HEADER.size).copy()
@@ -0,0 +1,299 @@
+"""Shared reception of FicTrac frames. Part of FlyFlix"""
+
+import json
+import socket
+import threading
+import time
+import warnings
+
+from .fictrac_parser import FicTracParser
+
+class FicTracSubscription():
+    """
+    Reader of the frames of a `FicTracService`. Each subscription has its own position in the
+    ring buffer of the service. A subscriber that falls more than the capacity of the buffer
+    behind misses the oldest frames, which are counted as `missed`.
+    """
+
+    def __init__(self, service, name) -> None:
+        """
+        Start reading at the next frame the service receives.
+
+        :param FicTracService service: service that receives the frames
+        :param str name: name of the subscriber in the status and the log
+        :rtype: None
+        """
+        self.service = service
+        self.name = name
+        self.cursor = service.count
+        self.read_frames = 0
+        self.missed = 0
+        self.skipped = 0
+        self.max_lag = 0
+        self.closed = False
+        self.interrupted = False
+        # set by the service for each new frame and by `interrupt`
+        self.new_frame = threading.Event()
+
+    @property
+    def lag(self) -> int:
+        """
+        Number of frames received by the service that the subscriber has not read yet.
+
+        :rtype: int
+        """
+        return self.service.count - self.cursor
+
+    def connect(self, timeout=0.1) -> bool:
+        """
+        Check that FicTrac is sending: it sent a frame within the last second or sends one
+        within `timeout`.
+
+        :param float timeout: longest time to wait for a frame in seconds
+        :rtype: bool
+        """
+        return self.service.is_receiving() or self.wait(timeout)
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Wait until there is at least one frame to read.
+
+        :param float timeout: longest time to wait in seconds, no limit if None
+        :returns: False if no frame arrived before the timeout or the subscription was
+            interrupted
+        :rtype: bool
+        """
+        self.new_frame.clear()
+        if self.lag > 0:
+            return True
+        if not self.interrupted:
+            self.new_frame.wait(timeout)
+        return self.lag > 0
+
+    def interrupt(self) -> None:
+        """
+        End a running `wait` right away, and let all later ones return without waiting, for
+        example to stop the reader within a frame when FicTrac stopped sending.
+
+        :rtype: None
+        """
+        self.interrupted = True
+        self.new_frame.set()
+
+    def read(self, newest_only=False) -> list:
+        """
+        All frames received since the last read, oldest first. Frames that were overwritten in
+        the ring buffer before they were read are skipped and counted as `missed`.
+
+        :param bool newest_only: skip straight to the newest frame, for a reader that only needs
+            the current state and would otherwise fall behind. The older frames are counted as
+            `skipped`.
+        :returns: list of `FicTracFrame`
+        :rtype: list
+        """
+        frames = self.service.frames
+        capacity = len(frames)
+        end = self.service.count
+        lag = end - self.cursor
+        self.max_lag = max(self.max_lag, lag)
+        if newest_only and lag > 0:
+            self.skipped += lag - 1
+            self.cursor = end
+            self.read_frames += 1
+            return [frames[(end - 1) % capacity]]
+        if lag > capacity:
+            self.missed += lag - capacity
+            self.cursor = end - capacity
+        batch = [frames[i % capacity] for i in range(self.cursor, end)]
+        # the service may have overwritten the oldest slots while they were copied
+        overrun = self.service.count - capacity - self.cursor
+        if overrun > 0:
+            self.missed += overrun
+            batch = batch[overrun:]
+        self.cursor = end
+        self.read_frames += len(batch)
+        return batch
+
+    def close(self) -> None:
+        """
+        Stop reading and log the counters of the subscription.
+
+        :rtype: None
+        """
+        self.service.unsubscribe(self)
+
+    def status(self) -> dict:
+        """
+        Counters of the subscription.
+
+        :returns: dictionary with the `name`, the number of `read`, `missed`, and `skipped`
+            frames, and the current and maximum `lag` in frames
+        :rtype: dict
+        """
+        return {
+            "name": self.name,
+            "read": self.read_frames,
+            "missed": self.missed,
+            "skipped": self.skipped,
+            "lag": self.lag,
+            "max-lag": self.max_lag}
+
+
+class FicTracService():
+    """
+    Receives FicTrac frames on one long-lived UDP socket and publishes them to any number of
+    subscribers, such as the FicTrac recorder of a session and closed loop conditions. Each
+    frame is parsed once and stored in a ring buffer. The service is the only writer, and it
+    only advances the frame count after a frame is stored, so subscribers read without locks.
+
+    For the service to receive frames, FicTrac needs to run with socket communication enabled:
+    set `sock_host` and `sock_port` in the FicTrac configuration to the host and port of the
+    service, by default `127.0.0.1` and `1717`.
+    """
+
+    def __init__(self, socket_io, log=None, capacity=4096) -> None:
+        """
+        Create the service without opening the socket.
+
+        :param SocketIO socket_io: Socket.IO used to start the background task
+        :param log: function called with `(sid, key, value)` to store the state of the socket
+            and the counters of closed subscriptions
+        :param int capacity: number of recent frames kept for the subscribers
+        :rtype: None
+        """
+        self.socket_io = socket_io
+        self.log = log
+        self.frames = [None] * capacity
+        self.count = 0
+        self.parser = FicTracParser()
+        self.last_receive_ns = None
+        self.subscriptions = []
+        self.address = None
+        self.running = False
+        self._sock = None
+
+    def start(self, host="127.0.0.1", port=1717) -> bool:
+        """
+        Bind the socket and receive frames in a background task until `stop`.
+
+        :param str host: address FicTrac sends its frames to
+        :param int port: port FicTrac sends its frames to
+        :returns: False if the socket could not be bound
+        :rtype: bool
+        """
+        if self.running:
+            return True
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((host, port))
+        except OSError as exc:
+            sock.close()
+            self._log("fictrac-bind-fail", {"host": host, "port": port, "error": repr(exc)})
+            warnings.warn(f"Cannot receive FicTrac on {host}:{port}: {exc}")
+            return False
+        sock.settimeout(0.5)
+        self._sock = sock
+        self.address = (host, port)
+        self.running = True
+        self._log("fictrac-bind-ok", {"host": host, "port": port})
+        self.socket_io.start_background_task(self._run)
+        return True
+
+    def stop(self) -> None:
+        """
+        Stop receiving and close the socket.
+
+        :rtype: None
+        """
+        self.running = False
+
+    def subscribe(self, name) -> FicTracSubscription:
+        """
+        Add a subscriber that reads the frames from now on.
+
+        :param str name: name of the subscriber in the status and the log
+        :rtype: FicTracSubscription
+        """
+        subscription = FicTracSubscription(self, name)
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription) -> None:
+        """
+        Remove a subscriber and log its counters as `fictrac-subscription`.
+
+        :param FicTracSubscription subscription: subscription returned by `subscribe`
+        :rtype: None
+        """
+        if subscription.closed:
+            return
+        subscription.closed = True
+        self.subscriptions = [sub for sub in self.subscriptions if sub is not subscription]
+        self._log("fictrac-subscription", subscription.status())
+
+    def is_receiving(self, within=1.0) -> bool:
+        """
+        True if a frame arrived within the last `within` seconds.
+
+        :param float within: time in seconds
+        :rtype: bool
+        """
+        return (self.last_receive_ns is not None
+                and time.time_ns() - self.last_receive_ns < within * 1e9)
+
+    def publish(self, frame) -> None:
+        """
+        Store a frame in the ring buffer and wake up the waiting subscribers.
+
+        :param FicTracFrame frame: parsed frame
+        :rtype: None
+        """
+        self.frames[self.count % len(self.frames)] = frame
+        self.count += 1
+        self.last_receive_ns = frame.receive_ns
+        for subscription in self.subscriptions:
+            subscription.new_frame.set()
+
+    def status(self) -> dict:
+        """
+        State of the socket and counters of the service and its subscribers.
+
+        :returns: dictionary with the `address`, whether the service is `running` and
+            `receiving`, the number of `frames` and `malformed` lines, and the status of each of
+            the `subscriptions`
+        :rtype: dict
+        """
+        return {
+            "address": self.address,
+            "running": self.running,
+            "receiving": self.is_receiving(),
+            "frames": self.count,
+            "malformed": self.parser.malformed,
+            "subscriptions": [sub.status() for sub in self.subscriptions]}
+
+    def _run(self) -> None:
+        """
+        Receive datagrams and publish every FicTrac frame they contain.
+
+        :rtype: None
+        """
+        with self._sock:
+            while self.running:
+                try:
+                    data = self._sock.recv(65536)
+                except socket.timeout:
+                    continue
+                for frame in self.parser.feed(data, time.time_ns()):
+                    self.publish(frame)
+        self._sock = None
+
+    def _log(self, key, value) -> None:
+        """
+        Log a change of the service on behalf of the server.
+
+        :param str key: key of the key-value pair
+        :param dict value: stored as JSON
+        :rtype: None
+        """
+        if self.log is not None:
+            self.log("server", key, json.dumps(value))
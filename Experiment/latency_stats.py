@@ -0,0 +1,91 @@
+"""Running latency statistics. Part of FlyFlix"""
+
+class LatencyStats():
+    """
+    Histogram of latencies with fixed bins. Adding a latency is constant time and percentiles
+    are available at any point without keeping every value.
+    """
+
+    def __init__(self, bin_ms=0.1, max_ms=1000) -> None:
+        """
+        Create empty statistics.
+
+        :param float bin_ms: width of a histogram bin in ms
+        :param float max_ms: upper end of the histogram, longer latencies share the last bin
+        :rtype: None
+        """
+        self.bin_ms = bin_ms
+        self.counts = [0] * (int(max_ms / bin_ms) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, latency_ms) -> None:
+        """
+        Add a latency. Negative latencies, for example from clock offsets, count in the first bin.
+
+        :param float latency_ms: latency in ms
+        :rtype: None
+        """
+        index = min(max(int(latency_ms / self.bin_ms), 0), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += latency_ms
+        if self.minimum is None or latency_ms < self.minimum:
+            self.minimum = latency_ms
+        if self.maximum is None or latency_ms > self.maximum:
+            self.maximum = latency_ms
+
+    def percentile(self, percent) -> float:
+        """
+        Latency at a percentile, estimated as the upper edge of the histogram bin.
+
+        :param float percent: percentile between 0 and 100
+        :returns: latency in ms, None without latencies
+        :rtype: float
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if index == len(self.counts) - 1:
+                    return self.maximum
+                return round((index + 1) * self.bin_ms, 6)
+        return self.maximum
+
+    def histogram(self, width_ms=1.0) -> list:
+        """
+        Histogram with wider bins, for example to be shown or logged.
+
+        :param float width_ms: width of a bin in ms, a multiple of the bin width of the statistics
+        :returns: `[start_ms, count]` for each bin with latencies, in order
+        :rtype: list
+        """
+        merge = max(round(width_ms / self.bin_ms), 1)
+        bins = {}
+        for index, count in enumerate(self.counts):
+            if count:
+                start = index // merge
+                bins[start] = bins.get(start, 0) + count
+        return [[round(start * merge * self.bin_ms, 6), count] for start, count in bins.items()]
+
+    def summary(self) -> dict:
+        """
+        Summary of the statistics.
+
+        :returns: number of latencies, mean, minimum, maximum, and the p50, p95, and p99
+            latencies in ms
+        :rtype: dict
+        """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.minimum,
+            "max": self.maximum,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99)}
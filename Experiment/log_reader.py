@@ -0,0 +1,516 @@
+"""
+Indexed reader for FlyFlix session logs. Part of FlyFlix
+
+The reader memory-maps a session log (CSV from `CsvSink` or binary from `BinarySink`) and
+builds an index with the server timestamp, key, and client of every row on first open. The
+index is cached next to the log as `<log>.ffx.npz`, so later opens only load the index. Trials,
+conditions, and block repetitions are taken from the `SessionIndex` the sinks write next to the
+log (`<log>.idx`), and only found by scanning the log if it has none. Queries by trial,
+condition, block repetition, key, and client then only parse the selected rows:
+
+    reader = LogReader("data/repeater_20230101_120000.csv")
+    frames = reader.values("fictrac-frame", trial=12)
+    ts = reader.timestamps("panels-tick-rotation", condition="12.0")
+"""
+
+import csv
+import mmap
+import os
+
+import numpy as np
+
+from .binary_sink import (
+    MAGIC, FILE_HEADER, CHUNK_HEADER, CHUNK_MAGIC, TAG_INT, TAG_FLOAT, TAG_STR, TAG_BOOL)
+from .compressed_stream import compression_of, open_log
+from .session_index import load_session_index
+
+INDEX_VERSION = 1
+BLOCK_SIZE = 64*1024*1024
+ROW_BATCH = 1024*1024
+
+class LogReader():
+    """
+    Lazy, indexed access to one session log.
+    """
+
+    def __init__(self, filename, use_cache=True) -> None:
+        """
+        Open a session log and load or build its index.
+
+        :param str filename: path of the log. Compressed logs (`.gz`, `.zst`) are decompressed
+            into memory, everything else is memory-mapped.
+        :param bool use_cache: load the index from (and save it to) `<log>.ffx.npz`
+        :rtype: None
+        """
+        self.filename = str(filename)
+        self.cache_filename = f"{self.filename}.ffx.npz"
+        self.index_filename = f"{self.filename}.idx"
+        if os.path.getsize(self.filename) == 0:
+            # a log that was opened but not written to yet, for example at server start
+            self.data = b""
+        elif compression_of(self.filename):
+            with open_log(self.filename) as stream:
+                self.data = stream.read()
+        else:
+            with open(self.filename, "rb") as stream:
+                self.data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        self.is_binary = self.data[:len(MAGIC)] == MAGIC
+        self.source_size = len(self.data)
+        self._chunk_cache = {}
+        if not (use_cache and self._load_index()):
+            self._build_index()
+            if use_cache:
+                self._save_index()
+        self._key_codes = {key: code for code, key in enumerate(self.keys)}
+        self._sid_codes = {sid: code for code, sid in enumerate(self.sids)}
+        self.trials, self.conditions, self.blocks = {}, {}, {}
+        if not self._load_session_index():
+            self.trials = self._ranges("trial")
+            self.conditions = self._ranges("condition")
+            self.blocks = self._block_ranges()
+
+    def __len__(self) -> int:
+        return len(self.ns)
+
+    def close(self) -> None:
+        """
+        Release the memory map. Arrays returned by the reader are copies and stay valid.
+
+        :rtype: None
+        """
+        self._chunk_cache.clear()
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                pass # a view on the map is still referenced, it is closed once released
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def select(self, key=None, trial=None, condition=None, block=None, sid=None) -> np.ndarray:
+        """
+        Find the rows matching all given criteria.
+
+        :param str key: key of the key-value pair, for example `de-panel-speed`
+        :param trial: trial id as logged in `trial-start`
+        :param str condition: condition id `{trial_id}.{count}` as logged in `condition-start`
+        :param block: block repetition as logged in `block-repetition`
+        :param str sid: client id (Socket.IO sid), or `server` for rows logged by the server
+        :returns: row numbers
+        :rtype: numpy.ndarray
+        """
+        first, last = 0, len(self.ns)
+        for ranges, value in ((self.trials, trial), (self.conditions, condition),
+                              (self.blocks, block)):
+            if value is not None:
+                start, end = ranges.get(_label(value), (0, -1))
+                first, last = max(first, start), min(last, end + 1)
+        mask = np.ones(max(last - first, 0), dtype=bool)
+        if key is not None:
+            mask &= self.key[first:last] == self._key_codes.get(key, -1)
+        if sid is not None:
+            mask &= self.sid[first:last] == self._sid_codes.get(str(sid), -1)
+        return np.flatnonzero(mask) + first
+
+    def timestamps(self, key=None, **criteria) -> np.ndarray:
+        """
+        Server timestamps (in ns) of the matching rows.
+
+        :param str key: key of the key-value pair
+        :param criteria: `trial`, `condition`, `block`, or `sid`, see `select()`
+        :rtype: numpy.ndarray
+        """
+        return self.ns[self.select(key, **criteria)]
+
+    def values(self, key, column="value", dtype=np.float64, **criteria) -> np.ndarray:
+        """
+        Values of the matching rows. Empty values become NaN for numeric dtypes.
+
+        :param str key: key of the key-value pair, for example `fictrac-frame`
+        :param str column: `value`, `client_timestamp`, or `request_timestamp`
+        :param dtype: numpy dtype of the result, `object` returns the values as strings
+        :param criteria: `trial`, `condition`, `block`, or `sid`, see `select()`
+        :rtype: numpy.ndarray
+        """
+        column = {"client_timestamp": 1, "request_timestamp": 2, "value": 4}[column]
+        rows = self.select(key, **criteria)
+        if self.is_binary:
+            return self._binary_values(rows, column, dtype)
+        values = [row[column + 1] for row in self._csv_rows(rows)]
+        if np.dtype(dtype) == np.dtype(object):
+            return np.array(values, dtype=object)
+        return np.array([value if value != "" else "nan" for value in values]).astype(dtype)
+
+    def rows(self, key=None, **criteria) -> list:
+        """
+        The matching rows as lists of strings, the same way `csv.reader` returns them.
+
+        :param str key: key of the key-value pair
+        :param criteria: `trial`, `condition`, `block`, or `sid`, see `select()`
+        :rtype: list
+        """
+        rows = self.select(key, **criteria)
+        if self.is_binary:
+            columns = [self._binary_values(rows, column, object) for column in range(5)]
+            return [[str(ns)] + [_text(value) for value in row]
+                    for ns, *row in zip(self.ns[rows], *columns)]
+        return list(self._csv_rows(rows))
+
+    def _csv_rows(self, rows):
+        """
+        (private) Parse the selected CSV rows.
+        """
+        def lines():
+            for row in rows:
+                start = self.offset[row]
+                end = self.offset[row + 1] if row + 1 < len(self.offset) else self.source_size
+                yield self.data[start:end].decode("utf-8", errors="replace")
+        return csv.reader(lines())
+
+    def _binary_values(self, rows, column, dtype) -> np.ndarray:
+        """
+        (private) Decode one column of the selected rows from their chunks.
+        """
+        as_object = np.dtype(dtype) == np.dtype(object)
+        result = np.empty(len(rows), dtype=object if as_object else np.float64)
+        chunks = self.chunk[rows]
+        for chunk in np.unique(chunks):
+            selected = np.flatnonzero(chunks == chunk)
+            tags, ints, floats, strings = self._decode_chunk(chunk)[column]
+            positions = rows[selected] - self.chunk_first_row[chunk]
+            result[selected] = _column_values(tags, ints, floats, strings, positions, as_object)
+        return result if as_object else result.astype(dtype)
+
+    def _decode_chunk(self, chunk) -> list:
+        """
+        (private) Zero-copy view of the message columns of a chunk.
+        """
+        if chunk not in self._chunk_cache:
+            if len(self._chunk_cache) > 64:
+                self._chunk_cache.clear()
+            columns = []
+            offset = int(self.chunk_offset[chunk])
+            _, nrows, nstrings, _ = CHUNK_HEADER.unpack_from(self.data, offset)
+            pos = offset + CHUNK_HEADER.size
+            lengths = np.frombuffer(self.data, np.uint32, nstrings, pos)
+            pos += 4*nstrings + int(lengths.sum()) + 8*nrows
+            for _ in range(FILE_HEADER.unpack_from(self.data, 0)[1]):
+                tags = np.frombuffer(self.data, np.uint8, nrows, pos)
+                pos += nrows
+                count = int(np.frombuffer(self.data, np.uint32, 1, pos)[0])
+                ints = np.frombuffer(self.data, np.int64, count, pos + 4)
+                pos += 4 + 8*count
+                count = int(np.frombuffer(self.data, np.uint32, 1, pos)[0])
+                floats = np.frombuffer(self.data, np.float64, count, pos + 4)
+                pos += 4 + 8*count
+                columns.append((tags, ints, floats, self.strings))
+            self._chunk_cache[chunk] = columns
+        return self._chunk_cache[chunk]
+
+    def _load_session_index(self) -> bool:
+        """
+        (private) First and last row of each trial, condition, and block repetition from the
+        `SessionIndex` of the log. Ranges without an end, for example after a crash, extend to
+        the end of the log, and entries for rows that are not in the log yet are left out.
+        """
+        if not os.path.exists(self.index_filename):
+            return False
+        try:
+            index = load_session_index(self.index_filename)
+        except (OSError, ValueError, KeyError):
+            return False
+        last = len(self.ns) - 1
+        for name, ranges in (("trials", self.trials), ("conditions", self.conditions),
+                             ("blocks", self.blocks)):
+            for value, bounds in index[name].items():
+                if bounds["start_row"] > last:
+                    continue
+                end = last if bounds["end_row"] is None else min(bounds["end_row"], last)
+                ranges[_label(value)] = (bounds["start_row"], end)
+        return True
+
+    def _ranges(self, group) -> dict:
+        """
+        (private) First and last row of each trial or condition, from its `-start` and `-end`
+        rows. If the end is missing, the range extends to the end of the log.
+        """
+        ranges = {}
+        starts = self.values(f"{group}-start", dtype=object)
+        for row, value in zip(self.select(f"{group}-start"), starts):
+            ranges.setdefault(_label(value), [int(row), len(self.ns) - 1])
+        ends = self.values(f"{group}-end", dtype=object)
+        for row, value in zip(self.select(f"{group}-end"), ends):
+            if _label(value) in ranges:
+                ranges[_label(value)][1] = int(row)
+        return {label: tuple(bounds) for label, bounds in ranges.items()}
+
+    def _block_ranges(self) -> dict:
+        """
+        (private) First and last row of each block repetition. A block ends before the next
+        one starts.
+        """
+        firsts = {}
+        values = self.values("block-repetition", dtype=object)
+        for row, value in zip(self.select("block-repetition"), values):
+            firsts.setdefault(_label(value), int(row))
+        ordered = sorted(firsts.items(), key=lambda item: item[1])
+        ends = [row - 1 for _, row in ordered[1:]] + [len(self.ns) - 1]
+        return {label: (row, end) for (label, row), end in zip(ordered, ends)}
+
+    def _build_index(self) -> None:
+        """
+        (private) Scan the whole log once for the server timestamp, key, and client of each row.
+        """
+        if self.source_size == 0:
+            self._build_empty_index()
+        elif self.is_binary:
+            self._build_binary_index()
+        else:
+            self._build_csv_index()
+
+    def _build_empty_index(self) -> None:
+        """
+        (private) Index of a log without rows.
+        """
+        self.offset = self.ns = self.chunk_offset = self.chunk_first_row = \
+            np.zeros(0, dtype=np.int64)
+        self.key = self.sid = self.chunk = np.zeros(0, dtype=np.int32)
+        self.keys, self.sids, self.strings = [], [], []
+
+    def _build_csv_index(self) -> None:
+        """
+        (private) Find the row boundaries with vectorized scans over blocks of the file: a
+        newline ends a row if the number of quotes before it is even. The first five fields of
+        every row never contain quotes, so the first five `","` separators delimit them.
+        """
+        starts = [np.zeros(1, dtype=np.int64)]
+        separators = []
+        quotes = 0
+        for block in range(0, self.source_size, BLOCK_SIZE):
+            data = np.frombuffer(self.data, np.uint8, min(BLOCK_SIZE, self.source_size - block),
+                                 block)
+            is_quote = data == ord('"')
+            # uint8 wraps around, but keeps the parity
+            parity = (np.cumsum(is_quote, dtype=np.uint8) + quotes % 2) & 1
+            quotes += int(is_quote.sum())
+            newlines = np.flatnonzero((data == ord("\n")) & (parity == 0))
+            starts.append(newlines.astype(np.int64) + block + 1)
+            comma = np.flatnonzero(data[1:-1] == ord(",")) + 1
+            comma = comma[(data[comma - 1] == ord('"')) & (data[comma + 1] == ord('"'))]
+            separators.append(comma.astype(np.int64) + block)
+            # separators spanning two blocks
+            if block + BLOCK_SIZE < self.source_size:
+                edge = bytes(self.data[block + BLOCK_SIZE - 2:block + BLOCK_SIZE + 1])
+                for shift in range(2):
+                    if edge[shift:shift + 3] == b'","':
+                        separators.append(np.array([block + BLOCK_SIZE - 1 + shift]))
+        starts = np.concatenate(starts)
+        starts = starts[starts < self.source_size]
+        separators = np.sort(np.concatenate(separators))
+        first = np.searchsorted(separators, starts)
+        fields = np.minimum(first[:, None] + np.arange(5), len(separators) - 1)
+        bounds = separators[fields]
+        data = np.frombuffer(self.data, np.uint8)
+        ns, key_fields, sid_fields = [], [], []
+        for first_row in range(0, len(starts), ROW_BATCH):
+            part = slice(first_row, first_row + ROW_BATCH)
+            ns.append(_parse_int(data, starts[part] + 1, bounds[part, 0] - 1))
+            key_fields.append(_gather(data, bounds[part, 3] + 2, bounds[part, 4] - 1))
+            sid_fields.append(_gather(data, bounds[part, 0] + 2, bounds[part, 1] - 1))
+        ns = np.concatenate(ns) if ns else np.zeros(0, dtype=np.int64)
+        keys, key = _encode(key_fields)
+        sids, sid = _encode(sid_fields)
+        self.offset = starts
+        self.ns = ns
+        self.key = key
+        self.sid = sid
+        self.keys = keys
+        self.sids = sids
+        self.chunk = self.chunk_offset = self.chunk_first_row = np.zeros(0, dtype=np.int64)
+        self.strings = []
+
+    def _build_binary_index(self) -> None:
+        """
+        (private) Walk the chunks of a binary log and keep the server timestamp, key, and client
+        of every row together with its chunk.
+        """
+        self.strings = []
+        ns, key, sid, chunk, chunk_offset, chunk_first_row = [], [], [], [], [], []
+        sids = {}
+        pos = FILE_HEADER.size
+        rows = 0
+        while pos + CHUNK_HEADER.size <= self.source_size:
+            chunk_magic, nrows, nstrings, length = CHUNK_HEADER.unpack_from(self.data, pos)
+            if chunk_magic != CHUNK_MAGIC or pos + CHUNK_HEADER.size + length + 4 > self.source_size:
+                break
+            start = pos + CHUNK_HEADER.size
+            lengths = np.frombuffer(self.data, np.uint32, nstrings, start)
+            cursor = start + 4*nstrings
+            for size in lengths.tolist():
+                self.strings.append(bytes(self.data[cursor:cursor + size]).decode("utf-8"))
+                cursor += size
+            chunk_offset.append(pos)
+            chunk_first_row.append(rows)
+            ns.append(np.frombuffer(self.data, np.int64, nrows, cursor))
+            chunk.append(np.full(nrows, len(chunk_offset) - 1, dtype=np.int32))
+            pos += CHUNK_HEADER.size + length + 4
+            rows += nrows
+        self.chunk_offset = np.array(chunk_offset, dtype=np.int64)
+        self.chunk_first_row = np.array(chunk_first_row, dtype=np.int64)
+        self.ns = np.concatenate(ns) if ns else np.zeros(0, dtype=np.int64)
+        self.chunk = np.concatenate(chunk) if chunk else np.zeros(0, dtype=np.int32)
+        self.keys = list(self.strings)
+        for number in range(len(self.chunk_offset)):
+            columns = self._decode_chunk(number)
+            tags, ints, _, _ = columns[3]
+            key.append(_column_codes(tags, ints))
+            tags, ints, floats, _ = columns[0]
+            labels = _column_values(tags, ints, floats, self.strings,
+                                    np.arange(len(tags)), True)
+            sid.append(np.array([sids.setdefault(_text(label), len(sids)) for label in labels],
+                                dtype=np.int32))
+        self._chunk_cache = {}
+        self.key = np.concatenate(key).astype(np.int32) if key else np.zeros(0, dtype=np.int32)
+        self.sid = np.concatenate(sid) if sid else np.zeros(0, dtype=np.int32)
+        self.sids = list(sids)
+        self.offset = np.zeros(0, dtype=np.int64)
+
+    def _save_index(self) -> None:
+        """
+        (private) Cache the index next to the log. Empty logs are not cached, they are about to
+        grow.
+        """
+        if self.source_size == 0:
+            return
+        try:
+            with open(self.cache_filename, "wb") as stream:
+                np.savez(
+                    stream, version=INDEX_VERSION, source_size=self.source_size,
+                    offset=self.offset, ns=self.ns, key=self.key, sid=self.sid,
+                    keys=np.array(self.keys, dtype=str), sids=np.array(self.sids, dtype=str),
+                    strings=np.array(self.strings, dtype=str), chunk=self.chunk,
+                    chunk_offset=self.chunk_offset, chunk_first_row=self.chunk_first_row)
+        except OSError:
+            pass # read-only data directory: work without cache
+
+    def _load_index(self) -> bool:
+        """
+        (private) Load the cached index if it belongs to the current state of the log.
+        """
+        if not os.path.exists(self.cache_filename):
+            return False
+        with np.load(self.cache_filename) as cache:
+            if int(cache["version"]) != INDEX_VERSION or \
+                    int(cache["source_size"]) != self.source_size:
+                return False
+            for name in ("offset", "ns", "key", "sid", "chunk", "chunk_offset",
+                         "chunk_first_row"):
+                setattr(self, name, cache[name])
+            self.keys = cache["keys"].tolist()
+            self.sids = cache["sids"].tolist()
+            self.strings = cache["strings"].tolist()
+        if self.is_binary:
+            self.keys = list(self.strings)
+        return True
+
+
+def _gather(data, starts, ends) -> np.ndarray:
+    """(private) Fixed width byte strings of the fields between `starts` and `ends`."""
+    width = max(int((ends - starts).max(initial=0)), 1)
+    positions = starts[:, None] + np.arange(width)
+    inside = positions < ends[:, None]
+    fields = np.where(inside, data[np.minimum(positions, len(data) - 1)], 0).astype(np.uint8)
+    return np.ascontiguousarray(fields).view(f"S{width}").ravel()
+
+
+def _encode(fields) -> tuple:
+    """(private) Dictionary encode the gathered fields: labels in order of appearance, codes."""
+    if not fields:
+        return [], np.zeros(0, dtype=np.int32)
+    width = max(field.dtype.itemsize for field in fields)
+    fields = np.concatenate([field.astype(f"S{width}") for field in fields])
+    unique, first, codes = np.unique(fields, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    labels = [label.decode("utf-8", errors="replace") for label in unique[order].tolist()]
+    return labels, rank[codes.ravel()]
+
+
+def _parse_int(data, starts, ends) -> np.ndarray:
+    """(private) Parse unsigned integer fields, -1 if a field is not a number."""
+    width = max(int((ends - starts).max(initial=0)), 1)
+    positions = starts[:, None] + np.arange(width)
+    inside = positions < ends[:, None]
+    digits = np.where(inside, data[np.minimum(positions, len(data) - 1)], ord("0")).astype(np.int64)
+    digits -= ord("0")
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1) & (ends > starts)
+    exponent = np.clip((ends - starts)[:, None] - 1 - np.arange(width), 0, None)
+    values = (np.where(inside, digits, 0) * 10**exponent).sum(axis=1)
+    return np.where(valid, values, -1)
+
+
+def _label(value) -> str:
+    """(private) Normalize trial, condition, and block ids from CSV text and binary values."""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _text(value) -> str:
+    """(private) Text representation of a value as `csv.writer` writes it."""
+    return "" if value is None else str(value)
+
+
+def _column_codes(tags, ints) -> np.ndarray:
+    """(private) String indices of a dictionary encoded column, -1 for other types."""
+    codes = np.full(len(tags), -1, dtype=np.int64)
+    in_ints = (tags == TAG_INT) | (tags == TAG_STR) | (tags == TAG_BOOL)
+    positions = np.cumsum(in_ints) - 1
+    is_str = tags == TAG_STR
+    codes[is_str] = ints[positions[is_str]]
+    return codes
+
+
+def _column_values(tags, ints, floats, strings, positions, as_object) -> np.ndarray:
+    """(private) Values of a column at the given row positions."""
+    in_ints = (tags == TAG_INT) | (tags == TAG_STR) | (tags == TAG_BOOL)
+    int_rank = np.cumsum(in_ints) - 1
+    float_rank = np.cumsum(tags == TAG_FLOAT) - 1
+    selected = tags[positions]
+    result = np.empty(len(positions), dtype=object if as_object else np.float64)
+    if not as_object:
+        result[:] = np.nan
+    for tag in (TAG_INT, TAG_FLOAT, TAG_STR, TAG_BOOL):
+        where = np.flatnonzero(selected == tag)
+        if len(where) == 0:
+            continue
+        if tag == TAG_FLOAT:
+            values = floats[float_rank[positions[where]]]
+        else:
+            values = ints[int_rank[positions[where]]]
+        if as_object:
+            if tag == TAG_STR:
+                values = [strings[index] for index in values.tolist()]
+            elif tag == TAG_BOOL:
+                values = [bool(value) for value in values.tolist()]
+            else:
+                values = values.tolist()
+            result[where] = values
+        elif tag == TAG_STR:
+            result[where] = [_float(strings[index]) for index in values.tolist()]
+        else:
+            result[where] = values
+    return result
+
+
+def _float(text) -> float:
+    """(private) Convert text to float, NaN if it is not a number."""
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
@@ -0,0 +1,184 @@
+"""Asynchronous log writer that keeps disk access off the eventlet hub. Part of FlyFlix"""
+
+import logging
+import time
+
+try:
+    # Eventlet replaces `threading` and `queue` with green versions once `monkey_patch()` is
+    # called. The writer needs a real OS thread, otherwise a stalled disk blocks the hub.
+    from eventlet.patcher import original
+    _threading = original("threading")
+    _queue = original("queue")
+except ImportError:
+    import threading as _threading
+    import queue as _queue
+
+_STOP = object()
+
+class LogWriter(logging.Handler):
+    """
+    Logging handler that pushes records onto a bounded queue. A dedicated writer thread drains
+    the queue in batches and hands each batch to the sinks, which write and flush it at once.
+    While no records arrive, the thread asks the sinks to write out data they still hold, so
+    the last rows of a session reach the disk even if nothing is logged afterwards.
+    """
+
+    def __init__(self, sinks, max_queue=100000, batch_size=2000, idle_seconds=0.5) -> None:
+        """
+        Constructor for the LogWriter. The writer thread starts immediately.
+
+        :param list sinks: objects with `write(rows)` and `close()` methods, for example a
+            `CsvSink`. Each row is a list starting with the server timestamp in ns followed by
+            the logged message.
+        :param int max_queue: number of records that can wait for the writer. Records logged
+            while the queue is full are dropped and counted.
+        :param int batch_size: maximum number of records written in one batch
+        :param float idle_seconds: time without records after which the sinks that have a
+            `flush_if_due()` method are asked to write out what they hold
+        :rtype: None
+        """
+        super().__init__()
+        self.sinks = list(sinks)
+        self.batch_size = batch_size
+        self.idle_seconds = idle_seconds
+        self.queue = _queue.Queue(maxsize=max_queue)
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.max_batch = 0
+        self.errors = 0
+        self._closed = False
+        self._thread = _threading.Thread(target=self._run, name="flyflix-log-writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, record) -> None:
+        """
+        Queue the record for the writer thread. This never blocks: if the queue is full, the
+        record is dropped and its rows are counted in `stats()`.
+
+        :param logging.LogRecord record: record with a list (or a list of lists for a batch)
+            in `msg`
+        :rtype: None
+        """
+        if self._closed:
+            return
+        record.created_ns = time.time_ns()
+        rows = len(record.msg) if getattr(record, "batch", False) else 1
+        try:
+            self.queue.put_nowait(record)
+        except _queue.Full:
+            self.dropped += rows
+            return
+        self.queued += rows
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def push(self, msg) -> None:
+        """
+        Queue a message for the sinks without going through `logging`, for example a recorded
+        FicTrac frame.
+
+        :param list msg: values of the row after the server timestamp
+        :rtype: None
+        """
+        self.emit(logging.makeLogRecord({"msg": msg}))
+
+    def stats(self) -> dict:
+        """
+        Current state of the writer. The queue depth counts queue entries, where a batch of
+        records logged at once is a single entry. All other counters are in rows, so that once
+        the queue is drained, `queued` equals `written`, and `queued` plus `dropped` is the
+        number of rows that were logged.
+
+        :returns: dictionary with the current and maximum queue depth, the number of queued,
+            written, and dropped rows, the number of batches and the largest batch in rows.
+        :rtype: dict
+        """
+        return {
+            "queue-depth": self.queue.qsize(),
+            "queue-max-depth": self.max_depth,
+            "queued": self.queued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "max-batch": self.max_batch,
+            "errors": self.errors}
+
+    def flush(self) -> None:
+        """
+        Block until all queued records are written. This waits on a real lock, so avoid calling
+        it while a protocol is running.
+
+        :rtype: None
+        """
+        if not self._closed:
+            self.queue.join()
+
+    def close(self) -> None:
+        """
+        Write all remaining records, stop the writer thread, and close the sinks. This is also
+        called by `logging.shutdown()` when the interpreter exits.
+
+        :rtype: None
+        """
+        if not self._closed:
+            self._closed = True
+            self.queue.put(_STOP)
+            self._thread.join()
+            for sink in self.sinks:
+                sink.close()
+        super().close()
+
+    def _run(self) -> None:
+        """
+        (private) Writer thread: wait for the first record, then take everything else that is
+        already queued (up to `batch_size` records) and commit it as one group. While waiting,
+        idle sinks are flushed every `idle_seconds`.
+        """
+        running = True
+        while running:
+            try:
+                records = [self.queue.get(timeout=self.idle_seconds)]
+            except _queue.Empty:
+                self._flush_idle()
+                continue
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self.queue.get_nowait())
+                except _queue.Empty:
+                    break
+            rows = []
+            for record in records:
+                if record is _STOP:
+                    running = False
+                elif getattr(record, "batch", False):
+                    rows.extend([record.created_ns] + list(row) for row in record.msg)
+                else:
+                    rows.append([record.created_ns] + list(record.msg))
+            if rows:
+                for sink in self.sinks:
+                    try:
+                        sink.write(rows)
+                    except Exception: # pylint: disable=broad-except
+                        self.errors += 1
+                self.written += len(rows)
+                self.batches += 1
+                self.max_batch = max(self.max_batch, len(rows))
+            for _ in records:
+                self.queue.task_done()
+
+    def _flush_idle(self) -> None:
+        """
+        (private) Let the sinks write out rows they held back, for example the collected rows of
+        a binary chunk or a partial compressed frame.
+        """
+        for sink in self.sinks:
+            flush_if_due = getattr(sink, "flush_if_due", None)
+            if flush_if_due is not None:
+                try:
+                    flush_if_due()
+                except Exception: # pylint: disable=broad-except
+                    self.errors += 1
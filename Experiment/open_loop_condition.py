@@ -48,22 +48,21 @@ class OpenLoopCondition():
         shared_key = time.time_ns()
         socket_io.emit('fps', (shared_key, self.fps))
 
-    def trigger(self, socket_io) -> None:
+    def trigger(self, socket_io, timeline=None) -> None:
         """
         Trigger the open loop condition. This means, that configuration of stimulus and frame rate
             are sent to the client, then the display is stopped for the duration of the pre-trial
             period, then the trial is triggered, followed by the post-trial duration.
 
         :param Socket socket_io: Socket.IO used for communication with the client.
+        :param Timeline timeline: schedule the durations are placed on
         :rtype: None
         """
         shared_key = time.time_ns()
         socket_io.emit("meta", (shared_key, "openloop-start", 1))
-        self.trigger_fps(socket_io)
-        self.spatial_temporal.trigger_spatial(socket_io)
-        self.spatial_temporal.trigger_stop(socket_io)
+        self.spatial_temporal.trigger_condition_setup(socket_io, self.fps)
         socket_io.emit("meta", (shared_key, "openloop-pretrial-start", 2))
-        self.pretrial_duration.trigger_delay(socket_io)
+        self.pretrial_duration.trigger_delay(socket_io, timeline, "openloop-pretrial")
         socket_io.emit("meta", (shared_key, "openloop-trial-start", 3))
         if self.spatial_temporal.is_oscillation():
             self.spatial_temporal.trigger_oscillation(socket_io)
@@ -71,9 +70,9 @@ class OpenLoopCondition():
             #osc_dur.trigger_delay(socket_io)
         else:
             self.spatial_temporal.trigger_rotation(socket_io)
-        self.trial_duration.trigger_delay(socket_io)
+        self.trial_duration.trigger_delay(socket_io, timeline, "openloop-trial")
         socket_io.emit("meta", (shared_key, "openloop-trial-end", 3))
         self.spatial_temporal.trigger_stop(socket_io)
         socket_io.emit("meta", (shared_key, "openloop-posttrial-start", 4))
-        self.posttrial_duration.trigger_delay(socket_io)
+        self.posttrial_duration.trigger_delay(socket_io, timeline, "openloop-posttrial")
         socket_io.emit("meta", (shared_key, "openloop-end", 1))
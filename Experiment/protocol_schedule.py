@@ -0,0 +1,196 @@
+"""Precompiled protocol schedule that is executed by the client. Part of FlyFlix"""
+
+import time
+
+from .timeline import TimelineStopped
+
+# Messages that stay on the server instead of being sent to the client as part of the schedule
+SERVER_EVENTS = {"condition-update"}
+
+class LiveSegment():
+    """
+    Part of a schedule that runs live on the server: the FicTrac loop of a closed loop condition.
+    """
+
+    def __init__(self, schedule, condition, start_ms) -> None:
+        """
+        Start a live segment while compiling.
+
+        :param ProtocolSchedule schedule: schedule the segment belongs to
+        :param ClosedLoopCondition condition: condition that runs the loop
+        :param float start_ms: start of the segment in ms since the start of the schedule
+        :rtype: None
+        """
+        self.schedule = schedule
+        self.condition = condition
+        self.start_ms = start_ms
+        self.end_ms = None
+        self.loopthread = None
+
+    def join(self) -> None:
+        """
+        End the segment at the current time of the schedule. This mirrors joining the loop
+        thread when the condition runs live.
+
+        :rtype: None
+        """
+        self.end_ms = self.schedule.now_ms
+
+
+class ProtocolSchedule():
+    """
+    Flat, timestamped list of all commands of a protocol.
+
+    The schedule is compiled by triggering the trials with the schedule standing in for both the
+    Socket.IO server and the `Timeline`: every message is recorded with its time since the start
+    instead of being sent, and delays advance the time of the schedule instead of waiting. The
+    whole schedule is then sent to the client before the start and the client applies each
+    command on the frame closest to its scheduled time. While it runs, the server logs the `meta`
+    messages at their scheduled time and runs the closed loop conditions as live segments.
+    """
+
+    def __init__(self) -> None:
+        """
+        Create an empty schedule.
+
+        :rtype: None
+        """
+        self.now_ms = 0
+        self.commands = []
+        self.phases = []
+        self.segments = []
+
+    def emit(self, event, data=(), **kwargs) -> None:
+        """
+        Record a message at the current time of the schedule. Same interface as `SocketIO.emit`.
+
+        :param str event: name of the Socket.IO event
+        :param data: argument, or tuple of arguments, of the message
+        :rtype: None
+        """
+        del kwargs # recipients are set when the schedule is sent
+        args = list(data) if isinstance(data, tuple) else [data]
+        self.commands.append([self.now_ms, event, args])
+
+    def wait(self, duration_ms, phase="duration") -> int:
+        """
+        Advance the time of the schedule by a phase. Same interface as `Timeline.wait`. Phases
+        are kept in order as `(end_ms, phase)`, so phases of length 0 keep their names.
+
+        :param float duration_ms: duration of the phase in ms
+        :param str phase: name of the phase
+        :returns: 0, there is no delay while compiling
+        :rtype: int
+        """
+        self.now_ms += duration_ms
+        self.phases.append((self.now_ms, phase))
+        return 0
+
+    def start_background_task(self, target, *args, **kwargs) -> LiveSegment:
+        """
+        Record the start of a live segment instead of starting a background task. Closed loop
+        conditions start their FicTrac loop this way.
+
+        :param target: bound `loop` method of the closed loop condition
+        :returns: the live segment, which ends when it is joined
+        :rtype: LiveSegment
+        """
+        del args, kwargs
+        segment = LiveSegment(self, target.__self__, self.now_ms)
+        self.segments.append(segment)
+        return segment
+
+    def duration(self) -> float:
+        """
+        Duration of the whole schedule.
+
+        :returns: time of the last command or phase in ms
+        :rtype: float
+        """
+        return max([self.now_ms] + [command[0] for command in self.commands])
+
+    def client_commands(self) -> list:
+        """
+        Commands that are sent to the client.
+
+        :returns: list of `[time_ms, event, args]` lists
+        :rtype: list
+        """
+        return [command for command in self.commands if command[1] not in SERVER_EVENTS]
+
+    def run(self, socket_io, timeline, log_meta, lead_ms=500) -> bool:
+        """
+        Send the schedule to the client and follow it on the server. The client starts the
+        schedule `lead_ms` after it receives `schedule-start`. At the time of each command, the
+        server logs the `meta` messages, sends the `SERVER_EVENTS`, and starts and stops the live
+        segments. The `meta` messages are logged with the time they are followed as shared key,
+        not the time they were compiled.
+
+        :param SocketIO socket_io: Socket.IO used for communication with the client. If it
+            provides `number_schedule`, like the `DisplayGroup`, the stimulus commands get
+            sequence numbers so that the client acknowledges them.
+        :param Timeline timeline: timeline the schedule is placed on
+        :param log_meta: function called with `(shared_key, key, value)` for each `meta` message
+        :param float lead_ms: time for the client to receive the start before the first command
+        :returns: True if the schedule ran to its end, False if the timeline was stopped
+        :rtype: bool
+        """
+        start_ns = time.time_ns() + round(lead_ms * 1_000_000)
+        commands = self.client_commands()
+        number_schedule = getattr(socket_io, "number_schedule", None)
+        if number_schedule is not None:
+            commands = number_schedule(commands, start_ns)
+        socket_io.emit("schedule", (commands,))
+        socket_io.emit("schedule-start", lead_ms, start_ns)
+        try:
+            self._follow(socket_io, timeline, log_meta, lead_ms)
+        except TimelineStopped:
+            socket_io.emit("schedule-cancel", time.time_ns())
+            return False
+        finally:
+            for segment in self.segments:
+                if segment.loopthread is not None:
+                    segment.condition.stop_loop(segment.loopthread)
+                    segment.loopthread = None
+        return True
+
+    def _follow(self, socket_io, timeline, log_meta, lead_ms) -> None:
+        """
+        Follow the schedule on the server, see `run`.
+
+        :rtype: None
+        """
+        timeline.wait(lead_ms, "schedule-lead")
+        # the motion the client applies is kept on the server, so that a pause can restore it
+        remember_motion = getattr(socket_io, "remember_motion", None)
+        starts = {}
+        ends = {}
+        for segment in self.segments:
+            starts.setdefault(segment.start_ms, []).append(segment)
+            ends.setdefault(segment.end_ms, []).append(segment)
+        commands = {}
+        for command in self.commands:
+            commands.setdefault(command[0], []).append(command)
+        phases = {}
+        for end_ms, phase in self.phases:
+            phases.setdefault(end_ms, []).append(phase)
+        previous_ms = 0
+        for at_ms in sorted(set(commands) | set(starts) | set(ends) | set(phases)):
+            for phase in phases.get(at_ms, ["schedule"]):
+                timeline.wait(at_ms - previous_ms, phase)
+                previous_ms = at_ms
+            for segment in ends.get(at_ms, []):
+                if segment.loopthread is not None:
+                    segment.condition.stop_loop(segment.loopthread)
+                    segment.loopthread = None
+            for _, event, args in commands.get(at_ms, []):
+                if event == "meta":
+                    _, key, value = args
+                    log_meta(time.time_ns(), key, value)
+                elif event in SERVER_EVENTS:
+                    socket_io.emit(event, *args)
+                elif remember_motion is not None:
+                    remember_motion(event, args)
+            for segment in starts.get(at_ms, []):
+                if segment.end_ms > at_ms:
+                    segment.loopthread = segment.condition.start_loop(socket_io)
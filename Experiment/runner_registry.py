@@ -0,0 +1,278 @@
+"""Registry of running protocols. Part of FlyFlix"""
+
+import json
+import time
+
+from collections import deque
+from threading import Lock
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# states of a runner that still owns the rig
+ACTIVE_STATES = {"waiting", "running"}
+
+class ProtocolRunner():
+    """
+    State of one protocol that was launched on a rig: `armed` in the queue of the rig, `waiting`
+    for the start of the experiment, `running`, and then `completed`, `stopped`, `failed`, or
+    `replaced` by another protocol before it started.
+    """
+
+    def __init__(self, rig, name) -> None:
+        """
+        Create the runner of a protocol before its task starts.
+
+        :param str rig: rig the protocol runs on
+        :param str name: name of the protocol, for example its route
+        :rtype: None
+        """
+        self.rig = rig
+        self.name = name
+        self.state = "waiting"
+        self.error = None
+        self.launched = time.time()
+        self.started = None
+        self.finished = None
+        self.done = 0
+        self.total = None
+        self._cpu_start = time.process_time()
+        self._cpu = None
+
+    @property
+    def active(self) -> bool:
+        """
+        True while the protocol owns the rig.
+
+        :rtype: bool
+        """
+        return self.state in ACTIVE_STATES
+
+    def start(self) -> None:
+        """
+        Mark the start of the experiment, after the runner waited for it.
+
+        :rtype: None
+        """
+        self.state = "running"
+        self.started = time.time()
+
+    def set_progress(self, done, total=None) -> None:
+        """
+        Update the progress of the protocol.
+
+        :param int done: number of completed steps, for example conditions
+        :param int total: number of steps, unchanged if None
+        :rtype: None
+        """
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    def finish(self, state, error=None) -> None:
+        """
+        Mark the end of the protocol.
+
+        :param str state: `completed`, `stopped`, `failed`, or `replaced`
+        :param str error: description of the error of a failed protocol
+        :rtype: None
+        """
+        self.state = state
+        self.error = error
+        self.finished = time.time()
+        self._cpu = time.process_time() - self._cpu_start
+
+    def status(self) -> dict:
+        """
+        Current state, progress, and resource use of the runner. The CPU time is the time of the
+        whole server process while the runner was active, since the tasks share one thread.
+
+        :returns: dictionary with the `rig`, protocol `name`, `state`, `error`, the times it was
+            `launched`, `started`, and `finished`, the progress as `done` of `total`, the
+            `runtime` and `cpu` time in seconds, and the `max-rss` of the server in kB
+        :rtype: dict
+        """
+        end = self.finished if self.finished is not None else time.time()
+        cpu = self._cpu if self._cpu is not None else time.process_time() - self._cpu_start
+        max_rss = None
+        if resource is not None:
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {
+            "rig": self.rig,
+            "name": self.name,
+            "state": self.state,
+            "error": self.error,
+            "launched": self.launched,
+            "started": self.started,
+            "finished": self.finished,
+            "done": self.done,
+            "total": self.total,
+            "runtime": end - (self.started or self.launched),
+            "cpu": cpu,
+            "max-rss": max_rss}
+
+
+class RunnerRegistry():
+    """
+    Keeps track of the protocol tasks so that each rig runs at most one protocol. Launching a
+    protocol while it is already active on the same rig, for example by reloading its page, does
+    not start a second task, which would otherwise wait for the same start and then send every
+    trial twice. A different protocol replaces one that still waits for the start, but not one
+    that is running.
+
+    The next protocol of a rig can be armed while the current one runs, for example for the next
+    fly. Armed protocols wait in a queue and each one is launched when the previous one ends.
+    """
+
+    def __init__(self, socket_io, log=None) -> None:
+        """
+        Create an empty registry.
+
+        :param SocketIO socket_io: Socket.IO used to start the background tasks
+        :param log: function called with `(sid, key, value)` to store launches and their end
+        :rtype: None
+        """
+        self.socket_io = socket_io
+        self.log = log
+        self.runners = {}
+        self.queues = {}
+        self._lock = Lock()
+
+    def launch(self, rig, name, target, *args) -> bool:
+        """
+        Start a protocol in a background task, unless the same protocol is already active or
+        another one is running on the rig. The target is called with the `ProtocolRunner` as the
+        first argument and should return once its runner is no longer active.
+
+        :param str rig: rig the protocol runs on
+        :param str name: name of the protocol
+        :param target: function that runs the protocol
+        :param args: further arguments of `target`
+        :returns: False if nothing was started
+        :rtype: bool
+        """
+        with self._lock:
+            current = self.runners.get(rig)
+            skip = current is not None and current.active and (
+                current.name == name or current.state == "running")
+            if not skip:
+                if current is not None and current.active:
+                    current.finish("replaced")
+                runner = ProtocolRunner(rig, name)
+                self.runners[rig] = runner
+        if skip:
+            self._log("runner-launch-skipped", {
+                "rig": rig, "name": name, "active": current.name, "state": current.state})
+            return False
+        self._start(runner, target, *args)
+        return True
+
+    def arm(self, rig, name, target, *args) -> ProtocolRunner:
+        """
+        Queue a protocol to be launched after the protocols that are active or armed on the rig.
+        Without any, the protocol is launched right away.
+
+        :param str rig: rig the protocol runs on
+        :param str name: name of the protocol
+        :param target: function that runs the protocol, see `launch`
+        :param args: further arguments of `target`
+        :returns: the armed runner
+        :rtype: ProtocolRunner
+        """
+        runner = ProtocolRunner(rig, name)
+        runner.state = "armed"
+        with self._lock:
+            current = self.runners.get(rig)
+            queue = self.queues.setdefault(rig, deque())
+            launch_now = (current is None or not current.active) and not queue
+            if not launch_now:
+                queue.append((runner, target, args))
+        if launch_now:
+            runner.state = "waiting"
+            self._start(runner, target, *args)
+        else:
+            self._log("runner-armed", {"rig": rig, "name": name, "queued": len(queue)})
+        return runner
+
+    def queued(self, rig) -> list:
+        """
+        Names of the armed protocols of a rig.
+
+        :param str rig: rig the protocols run on
+        :rtype: list
+        """
+        return [runner.name for runner, _, _ in self.queues.get(rig, [])]
+
+    def get(self, rig):
+        """
+        Latest runner of a rig.
+
+        :param str rig: rig the protocol runs on
+        :returns: the runner, or None if no protocol was launched on the rig
+        :rtype: ProtocolRunner
+        """
+        return self.runners.get(rig)
+
+    def status(self) -> dict:
+        """
+        Status of the latest runner of every rig.
+
+        :returns: `ProtocolRunner.status()` by rig, with the names of the armed protocols as
+            `queued`
+        :rtype: dict
+        """
+        return {rig: dict(runner.status(), queued=self.queued(rig))
+                for rig, runner in self.runners.items()}
+
+    def _start(self, runner, target, *args) -> None:
+        """
+        Make the runner the current one of its rig and start its task.
+
+        :rtype: None
+        """
+        with self._lock:
+            self.runners[runner.rig] = runner
+        self._log("runner-launch", {"rig": runner.rig, "name": runner.name})
+        self.socket_io.start_background_task(self._run, runner, target, *args)
+
+    def _run(self, runner, target, *args) -> None:
+        """
+        Run the protocol and record how it ended. A protocol that returns without calling
+        `finish` is completed, an exception marks it as failed. Afterwards, the next armed
+        protocol of the rig is launched.
+
+        :rtype: None
+        """
+        try:
+            target(runner, *args)
+        except Exception as exc:
+            runner.finish("failed", repr(exc))
+            raise
+        finally:
+            if runner.active:
+                runner.finish("completed")
+            self._log("runner-end", {
+                "rig": runner.rig, "name": runner.name, "state": runner.state})
+            upcoming = None
+            with self._lock:
+                queue = self.queues.get(runner.rig)
+                if queue and self.runners.get(runner.rig) is runner:
+                    upcoming = queue.popleft()
+            if upcoming is not None:
+                armed, armed_target, armed_args = upcoming
+                armed.state = "waiting"
+                armed.launched = time.time()
+                self._start(armed, armed_target, *armed_args)
+
+    def _log(self, key, value) -> None:
+        """
+        Log a change of the registry on behalf of the server.
+
+        :param str key: key of the key-value pair
+        :param dict value: stored as JSON
+        :rtype: None
+        """
+        if self.log is not None:
+            self.log("server", key, json.dumps(value))
@@ -0,0 +1,129 @@
+"""State of one experiment session. Part of FlyFlix"""
+
+import time
+
+from .timeline import Timeline
+
+class Session():
+    """
+    One experiment with one fly. The session owns everything that used to be process-wide: the
+    start of the experiment, a snapshot of the metadata, the log and FicTrac writers, the tags of
+    the recorded FicTrac frames, the FicTrac recording, the timeline of the protocol, and the
+    latency statistics. A new session starts with fresh state, so several flies can run one after
+    the other without restarting the server.
+
+    A session is `waiting` for the start of the experiment, then `running`, and finally
+    `completed` or `stopped`. Its timeline exists from the beginning, so that it stops and
+    pauses the session while it waits for the displays, before the first phase.
+    """
+
+    def __init__(self, rig, protocol, log=None) -> None:
+        """
+        Create a session that waits for the start of the experiment.
+
+        :param str rig: rig the session runs on
+        :param str protocol: name of the protocol
+        :param log: function called with `(shared_key, key, value)` to store the phases of the
+            timeline, see `Timeline`
+        :rtype: None
+        """
+        self.rig = rig
+        self.protocol = protocol
+        self.state = "waiting"
+        self.metadata = {}
+        self.log_name = None
+        self.log_writer = None
+        self.fictrac_writer = None
+        self.fictrac_tags = {"trial": -1, "condition": -1}
+        self.recording = False
+        self.timeline = Timeline(log)
+        self.onset_stats = {}
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def is_started(self) -> bool:
+        """
+        True once the experiment was started, also after it ended.
+
+        :rtype: bool
+        """
+        return self.started is not None
+
+    def start(self, metadata, log_name, log_writer, fictrac_writer) -> bool:
+        """
+        Start the experiment with a snapshot of the metadata and the writers of its log.
+
+        :param dict metadata: metadata at the start, later changes do not affect the session
+        :param str log_name: path of the log files without the suffix
+        :param LogWriter log_writer: writer of the data log
+        :param LogWriter fictrac_writer: writer of the FicTrac recording
+        :returns: False if the session was not waiting for the start
+        :rtype: bool
+        """
+        if self.state != "waiting":
+            return False
+        self.metadata = dict(metadata)
+        self.log_name = log_name
+        self.log_writer = log_writer
+        self.fictrac_writer = fictrac_writer
+        self.started = time.time()
+        self.state = "running"
+        return True
+
+    def stop(self) -> None:
+        """
+        Stop the session: a waiting session does not start anymore, the timeline of a running
+        session raises `TimelineStopped`, also before its first phase.
+
+        :rtype: None
+        """
+        self.timeline.stop()
+        if self.state == "waiting":
+            self.finish("stopped")
+
+    def finish(self, state) -> None:
+        """
+        End the session and its FicTrac recording.
+
+        :param str state: `completed` or `stopped`
+        :rtype: None
+        """
+        self.recording = False
+        self.state = state
+        self.finished = time.time()
+
+    def tag_fictrac(self, key, value) -> None:
+        """
+        Update the trial and condition of the recorded FicTrac frames from a `meta` message.
+
+        :param str key: key of the `meta` message
+        :param value: value of the `meta` message
+        :rtype: None
+        """
+        if key == "trial-start":
+            self.fictrac_tags["trial"] = value if isinstance(value, int) else -1
+        elif key == "trial-end":
+            self.fictrac_tags["trial"] = -1
+        elif key == "condition-start":
+            self.fictrac_tags["condition"] = int(str(value).rpartition(".")[2])
+        elif key == "condition-end":
+            self.fictrac_tags["condition"] = -1
+
+    def status(self) -> dict:
+        """
+        Summary of the session, for example to be logged or shown on the control panel.
+
+        :returns: dictionary with the `rig`, `protocol`, `state`, `log` name, and the times the
+            session was `created`, `started`, and `finished`
+        :rtype: dict
+        """
+        return {
+            "rig": self.rig,
+            "protocol": self.protocol,
+            "state": self.state,
+            "log": self.log_name,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished}
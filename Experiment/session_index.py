@@ -0,0 +1,117 @@
+"""Sidecar index of trials, conditions, and block repetitions in a session log. Part of FlyFlix"""
+
+import json
+
+INDEX_KEYS = {"block-repetition", "trial-start", "trial-end", "condition-start", "condition-end"}
+KEY_COLUMN = 4
+
+class SessionIndex():
+    """
+    Index written next to a log file while the log is written. Every `block-repetition`,
+    `trial-start`, `trial-end`, `condition-start`, and `condition-end` row is appended as one JSON
+    line with the byte offsets of the row, so a file from a crashed session still has a usable
+    index. Use `load_session_index` to turn it into ranges per trial, condition, and block.
+    """
+
+    def __init__(self, filename, chunked=False) -> None:
+        """
+        Open the index for writing.
+
+        :param str filename: path of the index, by convention the log file name plus `.idx`
+        :param bool chunked: set if the offsets refer to chunks instead of rows
+        :rtype: None
+        """
+        self.filename = filename
+        self.stream = open(filename, "a", encoding="utf-8")
+        self.stream.write(json.dumps({"chunked": chunked}) + "\n")
+        self.stream.flush()
+
+    @staticmethod
+    def is_indexed(row) -> bool:
+        """
+        Check if a log row needs to be in the index.
+
+        :param list row: log row, starting with the server timestamp
+        :rtype: bool
+        """
+        return len(row) > KEY_COLUMN and row[KEY_COLUMN] in INDEX_KEYS
+
+    def add(self, row, start, end, row_number) -> None:
+        """
+        Add an index entry.
+
+        :param list row: log row, starting with the server timestamp
+        :param int start: offset where reading has to start to get this row. For CSV files this
+            is the byte offset of the row, for binary logs the offset of the chunk containing it.
+            Offsets refer to the uncompressed data.
+        :param int end: offset after the row (CSV) or after the chunk containing it (binary)
+        :param int row_number: number of the row in the file, starting with 0 for the header
+        :rtype: None
+        """
+        value = row[KEY_COLUMN + 1] if len(row) > KEY_COLUMN + 1 else None
+        entry = {
+            "key": row[KEY_COLUMN], "value": value,
+            "ns": row[0], "start": start, "end": end, "row": row_number}
+        self.stream.write(json.dumps(entry, default=str) + "\n")
+        self.stream.flush()
+
+    def close(self) -> None:
+        """
+        Close the index.
+
+        :rtype: None
+        """
+        self.stream.close()
+
+
+def load_session_index(filename) -> dict:
+    """
+    Read an index and combine start and end entries into ranges.
+
+    :param str filename: path of the index
+    :returns: dictionary with the keys `trials`, `conditions`, and `blocks`. Each maps the
+        trial id, condition id (`{trial_id}.{count}`), or block repetition to a dictionary with
+        `start`/`end` offsets, `start_row`/`end_row`, and `start_ns`/`end_ns` server timestamps.
+        A block ends where the next block starts; ranges without an end entry (for example
+        after a crash) have None as end values.
+    :rtype: dict
+    """
+    index = {"trials": {}, "conditions": {}, "blocks": {}}
+    groups = {"trial": index["trials"], "condition": index["conditions"]}
+    last_block = None
+    last_value = None
+    with open(filename, "r", encoding="utf-8") as stream:
+        chunked = json.loads(stream.readline())["chunked"]
+        for line in stream:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break # incomplete last line
+            key, value = entry["key"], entry["value"]
+            if key == "block-repetition":
+                if last_block is not None and value != last_value:
+                    _close_range(last_block, entry, before=True, chunked=chunked)
+                last_block = index["blocks"].setdefault(value, _open_range(entry))
+                last_value = value
+                continue
+            group, _, boundary = key.rpartition("-")
+            ranges = groups[group]
+            if boundary == "start":
+                ranges.setdefault(value, _open_range(entry))
+            elif value in ranges:
+                _close_range(ranges[value], entry)
+    return index
+
+
+def _open_range(entry) -> dict:
+    """(private) New range starting at an index entry."""
+    return {
+        "start": entry["start"], "start_row": entry["row"], "start_ns": entry["ns"],
+        "end": None, "end_row": None, "end_ns": None}
+
+
+def _close_range(current, entry, before=False, chunked=False) -> None:
+    """(private) Close a range at an index entry, or just before it if `before` is set."""
+    current["end"] = entry["start"] if before and not chunked else entry["end"]
+    current["end_row"] = entry["row"] - 1 if before else entry["row"]
+    current["end_ns"] = entry["ns"]
@@ -8,6 +8,9 @@ import time
 
 from . import Duration
 
+# Version of the `condition-setup` message, increase when its fields change
+CONDITION_SETUP_VERSION = 1
+
 class SpatialTemporal():
     """
     Description of spatial and temporal stimulation.
@@ -167,16 +170,42 @@ class SpatialTemporal():
             self.bar_height))
         socket_io.emit('camera-flip', (shared_key, self.flip_camera))
 
-    def trigger_sweep_start_position(self, socket_io) -> None:
+    def trigger_condition_setup(self, socket_io, fps, start_deg=None) -> None:
         """
-        Rotates the pattern to the starting position for a single sweep. The starting position is
-        estimated based on the assumed viewing port size of roughly 180°, the size of bars (bright)
-        and space (dark), and the direction of movement.
+        Sends the complete stimulus state for a condition as a single `condition-setup` message:
+        frame rate, spatial setup, camera orientation, stopped movement, and optionally the start
+        position. The client applies it at once at the next frame, so no frame shows a partly
+        configured stimulus.
 
-        :param socket socket_io: Socket for sending the update to the client.
+        :param socket socket_io: Socket for sending the update.
+        :param float fps: client frame rate
+        :param float start_deg: rotation of the pattern in degree, None to keep the rotation
         :rtype: None
         """
         shared_key = time.time_ns()
+        socket_io.emit('condition-setup', (shared_key, {
+            "version": CONDITION_SETUP_VERSION,
+            "fps": fps,
+            "bar": math.radians(self.bar_deg),
+            "space": math.radians(self.space_deg),
+            "mask-start": math.radians(self.start_mask_deg),
+            "mask-end": math.radians(self.end_mask_deg),
+            "fg-color": self.fg_color,
+            "bg-color": self.bg_color,
+            "bar-height": self.bar_height,
+            "camera-flip": self.flip_camera,
+            "speed": 0,
+            "oscillation": [0, 0],
+            "rotation": None if start_deg is None else math.radians(start_deg)}))
+
+    def get_sweep_start_deg(self) -> float:
+        """
+        Starting position for a single sweep. The starting position is estimated based on the
+        assumed viewing port size of roughly 180°, the size of bars (bright) and space (dark), and
+        the direction of movement.
+
+        :rtype: float
+        """
         start_angle = 0
         if self.is_bar_sweep():
             if self.rotate_deg_hz > 0:
@@ -190,17 +219,15 @@ class SpatialTemporal():
                 start_angle = 220 + self.space_deg
         else:
             warnings.warn("not 2 item pattern. Rotate to 0")
-        socket_io.emit('rotate-to', (shared_key, math.radians(start_angle)))
+        return start_angle
 
-    def trigger_closedloop_start_position(self, socket_io) -> None:
+    def get_closedloop_start_deg(self) -> float:
         """
-        Rotates the pattern to a sensible starting position for a closed loop experiment, which
-        means that there is an edge between dark and bright in front of the animal.
+        Sensible starting position for a closed loop experiment, which means that there is an
+        edge between dark and bright in front of the animal.
 
-        :param socket socket_io: Socket for sending the update to the client.
-        :rtype: None
+        :rtype: float
         """
-        shared_key = time.time_ns()
         start_angle = 0
         if self.is_bar_sweep():
             start_angle = 180
@@ -210,4 +237,26 @@ class SpatialTemporal():
             start_angle = 112
         else:
             warnings.warn("not 2 item pattern. Rotate to 0")
-        socket_io.emit('rotate-to', (shared_key, math.radians(start_angle)))
+        return start_angle
+
+    def trigger_sweep_start_position(self, socket_io) -> None:
+        """
+        Rotates the pattern to the starting position for a single sweep, see
+        `get_sweep_start_deg`.
+
+        :param socket socket_io: Socket for sending the update to the client.
+        :rtype: None
+        """
+        shared_key = time.time_ns()
+        socket_io.emit('rotate-to', (shared_key, math.radians(self.get_sweep_start_deg())))
+
+    def trigger_closedloop_start_position(self, socket_io) -> None:
+        """
+        Rotates the pattern to a sensible starting position for a closed loop experiment, see
+        `get_closedloop_start_deg`.
+
+        :param socket socket_io: Socket for sending the update to the client.
+        :rtype: None
+        """
+        shared_key = time.time_ns()
+        socket_io.emit('rotate-to', (shared_key, math.radians(self.get_closedloop_start_deg())))
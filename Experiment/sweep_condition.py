@@ -49,18 +49,19 @@ class SweepCondition():
         shared_key = time.time_ns()
         socket_io.emit('fps', (shared_key, self.fps))
 
-    def trigger(self, socket_io):
+    def trigger(self, socket_io, timeline=None):
         """
         Trigger the condition. Specifically, this means setting the client's frame rate and show
         the stimulus without moving it for the duration of the pre-trial. Then run the sweep,
         followed by stopping the stimulus for the duration of the post-trial period.
+
+        :param Socket socket_io: The Socket.IO used for communicating with the client.
+        :param Timeline timeline: schedule the durations are placed on
         """
-        self.trigger_fps(socket_io)
-        self.spatial_temporal.trigger_spatial(socket_io)
-        self.spatial_temporal.trigger_stop(socket_io)
-        self.spatial_temporal.trigger_sweep_start_position(socket_io)
-        self.pretrial_duration.trigger_delay(socket_io)
+        self.spatial_temporal.trigger_condition_setup(
+            socket_io, self.fps, self.spatial_temporal.get_sweep_start_deg())
+        self.pretrial_duration.trigger_delay(socket_io, timeline, "sweep-pretrial")
         self.spatial_temporal.trigger_rotation(socket_io)
-        self.trial_duration.trigger_delay(socket_io)
+        self.trial_duration.trigger_delay(socket_io, timeline, "sweep-trial")
         self.spatial_temporal.trigger_stop(socket_io)
-        self.posttrial_duration.trigger_delay(socket_io)
+        self.posttrial_duration.trigger_delay(socket_io, timeline, "sweep-posttrial")
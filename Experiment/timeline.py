@@ -0,0 +1,188 @@
+"""Deadline-based scheduling of experiment phases. Part of FlyFlix"""
+
+import json
+import threading
+import time
+
+class TimelineStopped(Exception):
+    """Raised by `Timeline.wait` once the timeline was stopped."""
+
+
+class Timeline():
+    """
+    Absolute schedule of an experiment on a monotonic clock.
+
+    Each phase ends at a deadline computed from the start of the timeline and the sum of all
+    previous phase durations, not from the time the previous phase actually ended. Delays from
+    sending messages between phases and from late wake-ups are therefore absorbed by the next
+    phase instead of adding up over a protocol.
+
+    The timeline is also the stop token of a running protocol: after `stop`, the current and
+    every later `wait` raise `TimelineStopped`, as do waits outside of the schedule with
+    `wait_for` and `sleep`. `pause` holds the current phase until `resume` and moves all later
+    deadlines by the paused interval.
+    """
+
+    def __init__(self, log=None) -> None:
+        """
+        Create a timeline. It starts with the first `wait` or an explicit `start`.
+
+        :param log: function called with `(shared_key, key, value)` to store the scheduled and
+            actual end of each phase, for example `log_meta` in flyflix.py
+        :rtype: None
+        """
+        self.log = log
+        self.start_ns = None
+        self.deadline_ns = None
+        self.phases = 0
+        self.phase = None
+        self.stopped = False
+        self.paused_ns = None
+        # Created here instead of at import, so that the events are green after monkey patching.
+        self._wake = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        # events of running `wait_for` calls, set by `stop`
+        self._waiting = set()
+
+    def start(self) -> None:
+        """
+        Start the timeline now. Deadlines are relative to this point in time.
+
+        :rtype: None
+        """
+        self.start_ns = time.monotonic_ns()
+        self.deadline_ns = self.start_ns
+        if self.paused_ns is not None:
+            # paused before the start, only the time after the start moves the deadlines
+            self.paused_ns = self.start_ns
+
+    def wait(self, duration_ms, phase="duration") -> int:
+        """
+        Wait until the end of a phase that lasts `duration_ms` after the end of the previous
+        phase. The wait is a single timed wait, not a polling loop. It only wakes up early to
+        stop or pause.
+
+        :param float duration_ms: scheduled duration of the phase in ms
+        :param str phase: name of the phase in the log
+        :returns: difference between the actual and the scheduled end of the phase in ns
+        :rtype: int
+        :raises TimelineStopped: if the timeline is stopped before or during the wait
+        """
+        if self.deadline_ns is None:
+            self.start()
+        self.deadline_ns += round(duration_ms * 1_000_000)
+        self.phase = phase
+        while True:
+            self._wake.clear()
+            if self.stopped:
+                raise TimelineStopped(phase)
+            if self.paused_ns is not None:
+                self._resumed.wait()
+                continue
+            remaining = self.deadline_ns - time.monotonic_ns()
+            if remaining <= 0:
+                break
+            self._wake.wait(remaining / 1e9)
+        actual_ns = time.monotonic_ns()
+        self.phases += 1
+        if self.log is not None:
+            self.log(time.time_ns(), "timeline-phase", json.dumps({
+                "phase": phase,
+                "count": self.phases,
+                "scheduled": self.deadline_ns - self.start_ns,
+                "actual": actual_ns - self.start_ns}))
+        return actual_ns - self.deadline_ns
+
+    def wait_for(self, event, timeout=None) -> bool:
+        """
+        Wait until an event is set, outside of the schedule: the deadlines do not move and no
+        phase ends. The wait ends early to stop, but not to pause.
+
+        :param threading.Event event: event to wait for
+        :param float timeout: longest time to wait in seconds, None to wait until the event is set
+        :returns: False if the wait timed out
+        :rtype: bool
+        :raises TimelineStopped: if the timeline is stopped before or during the wait
+        """
+        self._waiting.add(event)
+        try:
+            if not self.stopped:
+                event.wait(timeout)
+        finally:
+            self._waiting.discard(event)
+        if self.stopped:
+            raise TimelineStopped(self.phase)
+        return event.is_set()
+
+    def sleep(self, seconds) -> None:
+        """
+        Sleep outside of the schedule, see `wait_for`.
+
+        :param float seconds: time to sleep
+        :rtype: None
+        :raises TimelineStopped: if the timeline is stopped before or during the sleep
+        """
+        self.wait_for(threading.Event(), seconds)
+
+    def stop(self) -> None:
+        """
+        Stop the timeline. A running `wait` or `wait_for` raises `TimelineStopped` right away.
+
+        :rtype: None
+        """
+        self.stopped = True
+        self._resumed.set()
+        self._wake.set()
+        for event in list(self._waiting):
+            event.set()
+
+    def pause(self) -> bool:
+        """
+        Hold the timeline at the current phase until `resume`.
+
+        :returns: False if the timeline was already paused or stopped
+        :rtype: bool
+        """
+        if self.paused_ns is not None or self.stopped:
+            return False
+        self.paused_ns = time.monotonic_ns()
+        self._resumed.clear()
+        self._wake.set()
+        if self.log is not None:
+            self.log(time.time_ns(), "timeline-pause", json.dumps({
+                "phase": self.phase, "at": self._since_start(self.paused_ns)}))
+        return True
+
+    def resume(self) -> bool:
+        """
+        Continue a paused timeline. The current and all later deadlines move by the time the
+        timeline was paused, so the remaining phase keeps its remaining duration.
+
+        :returns: False if the timeline was not paused
+        :rtype: bool
+        """
+        if self.paused_ns is None:
+            return False
+        paused = time.monotonic_ns() - self.paused_ns
+        paused_at = self._since_start(self.paused_ns)
+        if self.deadline_ns is not None:
+            self.deadline_ns += paused
+            self.start_ns += paused
+        if self.log is not None:
+            self.log(time.time_ns(), "timeline-resume", json.dumps({
+                "phase": self.phase, "at": paused_at, "paused": paused}))
+        self.paused_ns = None
+        self._resumed.set()
+        return True
+
+    def _since_start(self, monotonic_ns):
+        """
+        Time since the start of the timeline, None if the timeline has not started.
+
+        :param int monotonic_ns: time on the monotonic clock
+        :rtype: int
+        """
+        if self.start_ns is None:
+            return None
+        return monotonic_ns - self.start_ns
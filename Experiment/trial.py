@@ -14,6 +14,7 @@ class Trial():
                  start_mask_deg=0, end_mask_deg=0,
                  openloop_duration=Duration(3000), sweep=None,
                  closedloop_bar_deg = None, closedloop_duration=Duration(5000), gain=1,
+                 skip_backlog=False, predict=False, horizon_ms=50,
                  fg_color=0x00ff00, bg_color=0x000000,
                  osc_freq=0, osc_width=0,
                  bar_height=0.8,
@@ -35,6 +36,12 @@ class Trial():
             in degree
         :param Duration closedloop_duration: duration of the closed loop condition
         :param float gain: multiplier for orientation change read from the FicTrac instance
+        :param bool skip_backlog: the closed loop condition only forwards the newest FicTrac
+            frame if it falls behind, see `ClosedLoopCondition`
+        :param bool predict: the client extrapolates the heading of the closed loop condition to
+            the time it renders a frame, see `ClosedLoopCondition`
+        :param float horizon_ms: longest extrapolation in ms beyond the newest FicTrac frame in
+            `predict` mode
         :param float fps: client frame rate
         :param Duration pretrial_duration: duration of the pre-trial, where the stimulus is shown
             but not animated. Applies to open loop and closed loop conditions.
@@ -89,16 +96,19 @@ class Trial():
             clc = ClosedLoopCondition(
                 spatial_temporal=closedloop_spatial_temporal, trial_duration=closedloop_duration,
                 gain=gain, fps=fps,
-                pretrial_duration=pretrial_duration, posttrial_duration=posttrial_duration)
+                pretrial_duration=pretrial_duration, posttrial_duration=posttrial_duration,
+                skip_backlog=skip_backlog, predict=predict, horizon_ms=horizon_ms)
             self.conditions.append(clc)
 
 
-    def trigger(self, socket_io) -> None:
+    def trigger(self, socket_io, timeline=None) -> None:
         """
         Execute Trial. This consists of sending a number of logging-related messages to the client
         before iterating through the list of conditions and trigger one after another.
 
         :param Socket socket_id: Socket.IO used for communication with the client.
+        :param Timeline timeline: schedule of the experiment. Without a timeline, each delay
+            starts when the previous step finished.
         :rtype: None
         """
         shared_key = time.time_ns()
@@ -113,7 +123,7 @@ class Trial():
             elif isinstance(condition, ClosedLoopCondition):
                 socket_io.emit("meta", (shared_key, "condition-type", "closed-loop"))
             socket_io.emit("meta", (shared_key, "condition-start", f"{self.trial_id}.{count}"))
-            condition.trigger(socket_io)
+            condition.trigger(socket_io, timeline)
             socket_io.emit("meta", (shared_key, "condition-end", f"{self.trial_id}.{count}"))
         socket_io.emit("meta", (shared_key, "trial-end", self.trial_id))
 
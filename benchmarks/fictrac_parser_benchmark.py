@@ -0,0 +1,95 @@
+"""
+Benchmark the parsing of FicTrac datagrams at high frame rates.
+
+The benchmark feeds one second of synthetic FicTrac output at each frame rate to the receive
+loop that the closed loop used before `Experiment.FicTracParser`, which takes one line per
+datagram from a `str` buffer and splits every column, and to the parser, which drains every
+line of a datagram from the bytes and converts only the counter, heading, and timestamp. With
+`--lines` above 1, FicTrac lines arrive together in one datagram, as they do when the sender
+or the network bunches them. For each loop it prints the CPU time per frame, the share of one
+core it needs at that frame rate, and the lines that are still waiting after the last datagram.
+
+    python benchmarks/fictrac_parser_benchmark.py --rates 100 500 1000 --lines 1 3
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Experiment import FicTracParser
+
+
+def datagrams(rate, lines):
+    """One second of FicTrac output at `rate` frames per second, `lines` frames per datagram."""
+    frames = []
+    for counter in range(1, rate + 1):
+        columns = [counter] + [0.0123456789 * (counter + column) for column in range(2, 24)]
+        columns[16] = 0.001 * counter
+        columns[21] = 1000.0 * counter / rate
+        frames.append(("FT, " + ", ".join(str(value) for value in columns) + "\n").encode())
+    return [b"".join(frames[i:i + lines]) for i in range(0, len(frames), lines)]
+
+
+def legacy_loop(packets):
+    """The former receive loop: at most one line per datagram, all columns split."""
+    data = ""
+    parsed = 0
+    for new_data in packets:
+        data += new_data.decode('UTF-8')
+        endline = data.find("\n")
+        line = data[:endline]
+        data = data[endline+1:]
+        toks = line.split(", ")
+        if (len(toks) < 24) | (toks[0] != "FT"):
+            continue
+        _ = int(toks[1]), float(toks[17]), float(toks[22])
+        parsed += 1
+    return parsed, data.count("\n")
+
+
+def parser_loop(packets):
+    """`FicTracParser.feed` on every datagram."""
+    parser = FicTracParser()
+    parsed = 0
+    for new_data in packets:
+        parsed += len(parser.feed(new_data, 0))
+    return parsed, parser.pending.count(b"\n")
+
+
+def measure(loop, packets, repeat):
+    """Run the loop `repeat` times, return the frames parsed, lines left, and CPU time per run."""
+    best = None
+    for _ in range(repeat):
+        cpu = time.process_time()
+        parsed, waiting = loop(packets)
+        cpu = time.process_time() - cpu
+        best = cpu if best is None else min(best, cpu)
+    return parsed, waiting, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rates", type=int, nargs="+", default=[100, 250, 500, 1000],
+                        help="FicTrac frame rates in Hz")
+    parser.add_argument("--lines", type=int, nargs="+", default=[1, 2, 4],
+                        help="FicTrac lines per datagram")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    loops = {"legacy": legacy_loop, "parser": parser_loop}
+    print(f"{'rate Hz':>8} {'lines':>6} {'loop':<8} {'parsed':>7} {'waiting':>8} "
+          f"{'CPU us/frame':>13} {'core %':>7}")
+    for rate in args.rates:
+        for lines in args.lines:
+            packets = datagrams(rate, lines)
+            for name, loop in loops.items():
+                parsed, waiting, cpu = measure(loop, packets, args.repeat)
+                per_frame = cpu / max(parsed, 1) * 1e6
+                print(f"{rate:>8} {lines:>6} {name:<8} {parsed:>7} {waiting:>8} "
+                      f"{per_frame:>13.2f} {cpu * 100:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark the indexed `LogReader` against parsing the whole session log.
+
+A synthetic session with per-frame client logging is written with `CsvSink` and `BinarySink`.
+The benchmark then extracts `fictrac-frame` for a single trial with a full CSV parse (the way
+our analysis scripts did it), with pandas if it is installed, and with `LogReader` on the first
+(index building) and a later (cached index) open.
+
+    python benchmarks/log_reader_benchmark.py --trials 200 --frames 600
+"""
+
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+
+from Experiment import CsvSink, BinarySink, LogReader
+
+def write_session(prefix, trials, frames):
+    """Write a synthetic session with three per-frame keys from two clients and the server."""
+    rng = np.random.default_rng(1)
+    sinks = [CsvSink(f"{prefix}.csv"), BinarySink(f"{prefix}.ffb")]
+    ns = time.time_ns()
+    rows = [[ns, "client_id", "client_timestamp", "request_timestamp", "key", "value"]]
+    for trial in range(1, trials + 1):
+        rows.append([ns, "server", 0, ns, "trial-start", trial])
+        rows.append([ns, "server", 0, ns, "condition-start", f"{trial}.0"])
+        rotation = rng.random(frames) * 6
+        for frame in range(frames):
+            ns += 16_666_667
+            rows.append([ns, "display-1", frame * 16.667, ns, "panels-tick-rotation",
+                         float(rotation[frame])])
+            rows.append([ns, "display-1", frame * 16.667, ns, "loop-tick-delta", 0.016667])
+            rows.append([ns, "server", 0, ns, "fictrac-frame", trial * frames + frame])
+        rows.append([ns, "server", 0, ns, "condition-end", f"{trial}.0"])
+        rows.append([ns, "server", 0, ns, "trial-end", trial])
+        if len(rows) > 10000:
+            for sink in sinks:
+                sink.write(rows)
+            rows = []
+    for sink in sinks:
+        sink.write(rows)
+        sink.close()
+
+
+def naive(filename, trial):
+    """Parse every row, then filter for the trial and key."""
+    with open(filename, newline="") as stream:
+        rows = list(csv.reader(stream))
+    in_trial = False
+    values = []
+    for row in rows[1:]:
+        if row[4] == "trial-start":
+            in_trial = row[5] == str(trial)
+        elif in_trial and row[4] == "fictrac-frame":
+            values.append(float(row[5]))
+        elif row[4] == "trial-end" and row[5] == str(trial):
+            in_trial = False
+    return np.array(values)
+
+
+def with_pandas(filename, trial):
+    """Load everything into a DataFrame, then filter for the trial and key."""
+    import pandas # pylint: disable=import-outside-toplevel
+    frame = pandas.read_csv(filename)
+    starts = frame.index[(frame["key"] == "trial-start") & (frame["value"] == str(trial))]
+    ends = frame.index[(frame["key"] == "trial-end") & (frame["value"] == str(trial))]
+    part = frame.loc[starts[0]:ends[-1]]
+    return part.loc[part["key"] == "fictrac-frame", "value"].astype(float).to_numpy()
+
+
+def indexed(filename, trial):
+    """Use the LogReader with its cached index."""
+    with LogReader(filename) as reader:
+        return reader.values("fictrac-frame", trial=trial)
+
+
+def measure(label, function, *args):
+    """Run the function once and print the wall time."""
+    start = time.perf_counter()
+    result = function(*args)
+    print(f"{label:<36} {time.perf_counter() - start:8.3f} s  ({len(result)} values)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--trials", type=int, default=100)
+    parser.add_argument("--frames", type=int, default=600)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        prefix = os.path.join(directory, "session")
+        write_session(prefix, args.trials, args.frames)
+        for suffix in ("csv", "ffb"):
+            size = os.path.getsize(f"{prefix}.{suffix}") / 1024**2
+            print(f"{suffix}: {size:.1f} MiB")
+        trial = args.trials // 2
+        expected = measure("full csv parse", naive, f"{prefix}.csv", trial)
+        try:
+            measure("pandas.read_csv", with_pandas, f"{prefix}.csv", trial)
+        except ImportError:
+            print(f"{'pandas.read_csv':<36} not installed")
+        for suffix in ("csv", "ffb"):
+            measure(f"LogReader {suffix}, first open", indexed, f"{prefix}.{suffix}", trial)
+            result = measure(f"LogReader {suffix}, cached index", indexed, f"{prefix}.{suffix}",
+                             trial)
+            assert np.array_equal(result, expected)
+
+
+if __name__ == "__main__":
+    main()
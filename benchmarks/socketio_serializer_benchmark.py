@@ -0,0 +1,78 @@
+"""
+Benchmark the JSON and msgpack serializers of Socket.IO for FlyFlix traffic.
+
+Each message is encoded and decoded as a Socket.IO packet, the way the server handles it with
+`--serializer json` and `--serializer msgpack`. The message types are the closed-loop `speed`
+update, a `dlb` batch of per-frame client logs, and a `condition-setup`. For each serializer the
+benchmark prints the messages per second, the CPU time per message, and the bytes per message
+on a websocket and on long-polling, where binary packets are sent as base64.
+
+    python benchmarks/socketio_serializer_benchmark.py --messages 20000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from socketio import packet, msgpack_packet
+
+SERIALIZERS = {"json": packet.Packet, "msgpack": msgpack_packet.MsgPackPacket}
+
+def messages(batch):
+    """Typical messages as `[event, *args]` lists, like the data of an EVENT packet."""
+    shared_key = time.time_ns()
+    return {
+        "speed": ["speed", 123456, -1.2345678901234, 98765],
+        "dlb": ["dlb", [
+            [1234.5 + frame * 16.667, shared_key, key, 0.0123456789 * frame]
+            for frame in range(batch // 3)
+            for key in ("loop-tick-delta", "panels-tick-rotation", "loop-render")]],
+        "condition-setup": ["condition-setup", shared_key, {
+            "version": 1, "fps": 60, "bar": 0.2617993877991494, "space": 0.2617993877991494,
+            "mask-start": 0.0, "mask-end": 0.0, "fg-color": 0x00ff00, "bg-color": 0x000000,
+            "bar-height": 1.0, "camera-flip": False, "speed": 2.0943951023931953,
+            "oscillation": [0, 0], "rotation": None}, 42],
+    }
+
+
+def wire_bytes(encoded):
+    """Bytes of an encoded packet in an Engine.IO websocket frame and in a polling payload."""
+    if isinstance(encoded, str):
+        size = len(("4" + encoded).encode("utf-8"))
+        return size, size
+    return len(encoded), 1 + (len(encoded) + 2) // 3 * 4
+
+
+def measure(packet_class, data, count):
+    """Encode and decode the message `count` times, return the wall and CPU time."""
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(count):
+        encoded = packet_class(packet.EVENT, data=data, namespace="/").encode()
+        packet_class(encoded_packet=encoded)
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=500, help="records per dlb batch")
+    args = parser.parse_args()
+    print(f"{'message':<16} {'serializer':<10} {'msg/s':>10} {'CPU us/msg':>11} "
+          f"{'ws B/msg':>9} {'poll B/msg':>11}")
+    for name, data in messages(args.batch).items():
+        count = args.messages if name != "dlb" else max(args.messages // 100, 10)
+        for serializer, packet_class in SERIALIZERS.items():
+            encoded = packet_class(packet.EVENT, data=data, namespace="/").encode()
+            assert packet_class(encoded_packet=encoded).data == data
+            websocket, polling = wire_bytes(encoded)
+            wall, cpu = measure(packet_class, data, count)
+            print(f"{name:<16} {serializer:<10} {count / wall:>10.0f} {cpu / count * 1e6:>11.2f} "
+                  f"{websocket:>9} {polling:>11}")
+
+
+if __name__ == "__main__":
+    main()
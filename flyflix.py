@@ -7,18 +7,21 @@ import random
 import inspect
 import warnings
 import json
+import glob
+import argparse
+import itertools
 import netifaces
 from threading import Lock
 
 
 from pathlib import Path
-from logging import FileHandler
 
 import yaml
 import datetime
 
 
 import eventlet
+from eventlet import tpool
 
 
 
@@ -28,18 +31,25 @@ from flask_socketio import SocketIO
 
 from engineio.payload import Payload
 
-from Experiment import Duration, Trial, CsvFormatter
+from Experiment import TimelineStopped, Duration, Trial, ProtocolSchedule, CsvSink, BinarySink, LogWriter, FicTracRecorder, ExperimentSocket, ClockSyncService, LatencyStats, DisplayGroup, RunnerRegistry, Session, FicTracService, ClosedLoopTrace, FakeFicTrac
+from Experiment.closed_loop_trace import CLOSED_LOOP_EVENTS
+from Experiment.compressed_stream import COMPRESSIONS
 
 app = Flask(__name__)
 
-start = False
 SWEEPCOUNTERREACHED = False
-RUN_FICTRAC = False
+# writers of the log that is currently open, the log of the latest session once it started
+log_writer = None
+fictrac_writer = None
+# session of the latest protocol and the one before, None before the first protocol
+current_session = None
+previous_session = None
 
 # metadata variable - DO NOT CHANGE
 # use control panel to update values or defaultsconfig.yaml to set defaults
 metadata = {}
 metadata_lock = Lock()
+LOG_LEVELS = ("minimal", "standard", "full")
 
 Payload.max_decode_packets = 1500
 
@@ -55,9 +65,8 @@ metadata_lock = Lock()
 # `socketio = SocketIO(app, async_mode='threading')`
 
 eventlet.monkey_patch()
-# socketio = SocketIO(app)
-# FIXME: find out if CORS is needed
-socketio = SocketIO(app, cors_allowed_origins='*')
+# The server is created in `before_first_request`, once the serializer and transports are known.
+socketio = SocketIO()
 
 # socketio = SocketIO(app, async_mode='threading')
 
@@ -117,10 +126,18 @@ def before_first_request():
     """
     Server initiator: check for paths  and initialize logger.
     """
-    app.config.update(
-        FICTRAC_HOST = '127.0.0.1',
-        FICTRAC_PORT = 1717
-    )
+    app.config.setdefault("FICTRAC_HOST", "127.0.0.1")
+    app.config.setdefault("FICTRAC_PORT", 1717)
+    app.config.setdefault("LOG_FORMAT", "csv")
+    app.config.setdefault("LOG_COMPRESSION", None)
+    app.config.setdefault("SCHEDULE", "server")
+    app.config.setdefault("DISPLAY_LEAD", 50)
+    app.config.setdefault("RIG", socket.gethostname())
+    app.config.setdefault("SERIALIZER", "json")
+    app.config.setdefault("WEBSOCKET_ONLY", False)
+    # FIXME: find out if CORS is needed
+    socketio.init_app(app, cors_allowed_origins='*', **socketio_options())
+    display_group.lead_ms = app.config["DISPLAY_LEAD"]
     data_path = Path("data")
     if data_path.exists():
         if not data_path.is_dir():
@@ -130,18 +147,83 @@ def before_first_request():
     else:
         data_path.mkdir()
     read_metadata()
-    csv_handler = FileHandler("data/repeater_{}.csv".format(time.strftime("%Y%m%d_%H%M%S")))
-    csv_handler.setFormatter(CsvFormatter())
     app.logger.removeHandler(default_handler)
     app.logger.setLevel(logging.INFO)
-    app.logger.addHandler(csv_handler)
+    open_log()
+    socketio.start_background_task(clock_sync.run)
+    fictrac_service.start(app.config["FICTRAC_HOST"], app.config["FICTRAC_PORT"])
+    if app.config.get("FAKE_FICTRAC"):
+        fake_fictrac = FakeFicTrac(
+            app.config["FICTRAC_HOST"], app.config["FICTRAC_PORT"], app.config["FAKE_FICTRAC"])
+        socketio.start_background_task(fake_fictrac.run)
+
+
+def socketio_options():
+    """
+    Socket.IO server options for the configured serializer and transports. With `msgpack`,
+    messages are sent as binary msgpack instead of JSON text. With `WEBSOCKET_ONLY`, clients
+    cannot fall back to long-polling, which would send msgpack as base64 text.
+
+    :returns: keyword arguments for `SocketIO.init_app`
+    :rtype: dict
+    """
+    options = {}
+    if app.config["SERIALIZER"] == "msgpack":
+        options["serializer"] = "msgpack"
+    if app.config["WEBSOCKET_ONLY"]:
+        options["transports"] = ["websocket"]
+    return options
+
+
+@app.context_processor
+def socket_config():
+    """
+    Socket.IO configuration for the pages, which connect with `socketOptions(socketConfig)`.
+    """
+    return {"socket_config": {
+        "serializer": app.config["SERIALIZER"],
+        "transports": ["websocket"] if app.config["WEBSOCKET_ONLY"] else None}}
+
+
+def open_log():
+    """
+    Start a new data log file. The previous log, if any, is closed in a separate thread once all
+    its queued records are written. Each log has a sidecar index with the byte offsets and
+    time ranges of trials, conditions, and block repetitions, and a FicTrac recording.
+
+    :returns: path of the log files without the suffix
+    :rtype: str
+    """
+    global log_writer, fictrac_writer
+    log_name = "data/repeater_{}".format(time.strftime("%Y%m%d_%H%M%S"))
+    for count in itertools.count(1):
+        if not glob.glob(f"{log_name}.*"):
+            break
+        log_name = "data/repeater_{}_{}".format(time.strftime("%Y%m%d_%H%M%S"), count)
+    compression = app.config["LOG_COMPRESSION"]
+    suffix = COMPRESSIONS.get(compression, "")
+    sinks = []
+    if app.config["LOG_FORMAT"] in ("csv", "both"):
+        sinks.append(CsvSink(f"{log_name}.csv{suffix}", compression=compression, index=True))
+    if app.config["LOG_FORMAT"] in ("binary", "both"):
+        sinks.append(BinarySink(f"{log_name}.ffb{suffix}", compression=compression, index=True))
+    previous_writers = [log_writer, fictrac_writer]
+    if log_writer is not None:
+        app.logger.removeHandler(log_writer)
+    log_writer = LogWriter(sinks)
+    app.logger.addHandler(log_writer)
     app.logger.info(["client_id", "client_timestamp", "request_timestamp", "key", "value"])
+    fictrac_writer = LogWriter([FicTracRecorder(f"{log_name}.fictrac")])
+    for previous_writer in previous_writers:
+        if previous_writer is not None:
+            tpool.execute(previous_writer.close)
+    return log_name
 
 
 def savedata(sid, shared, key, value=0):
     """
     Store data on disk. It is intended to be key-value pairs, together with a shared knowledge
-    item. Data storage is done through the logging.FileHandler.
+    item. Data storage is done through the queued `LogWriter`.
 
     :param str shared: intended for shared knowledge between client and server
     :param str key: Key from the key-value pair
@@ -164,12 +246,108 @@ def logdata(sid, client_timestamp, request_timestamp, key, value):
     app.logger.info([sid, client_timestamp, request_timestamp, key, value])
 
 
+def log_meta(shared_key, key, value):
+    """
+    Store a `meta` message on disk at the time the server sends it. The client ID is `server`.
+    Trial and condition starts and ends also update the tags of the FicTrac frames recorded in
+    the current session.
+
+    :param shared_key: server timestamp the message was sent with
+    :param str key: key of the key-value pair
+    :param str value: value of the key-value pair
+    """
+    logdata("server", 0, shared_key, key, value)
+    if current_session is not None:
+        current_session.tag_fictrac(key, value)
+    closed_loop_trace.follow(key, value)
+    display_group.follow(key, value)
+
+
+# experiments send their messages through `experiment_io`, which logs `meta` messages on the server
+experiment_io = ExperimentSocket(socketio, log_meta)
+
+
+def log_client(sid, key, value):
+    """
+    Store a value about a client that is determined on the server, for example its clock model.
+
+    :param str sid: session ID of the client
+    :param str key: key of the key-value pair
+    :param str value: value of the key-value pair
+    """
+    logdata(sid, 0, time.time_ns(), key, value)
+
+
+clock_sync = ClockSyncService(socketio, log_client)
+# the only socket that receives FicTrac frames, shared by the recorder and closed loop conditions
+fictrac_service = FicTracService(socketio, log_client)
+experiment_io.fictrac = fictrac_service
+# end-to-end latency of closed loop updates, from the FicTrac capture to the rendered frame
+closed_loop_trace = ClosedLoopTrace(socketio, log_client)
+experiment_io.closed_loop_trace = closed_loop_trace
+# displays that apply stimulus changes at a shared time, protocols send their messages through it
+display_group = DisplayGroup(experiment_io, clock_sync, log_client)
+# protocol tasks, at most one per rig
+protocol_runners = RunnerRegistry(socketio, log_client)
+
+
+def logdatabatch(sid, records):
+    """
+    Store a batch of client records on disk with a single write. Each record contains the same
+    fields as the parameters of `logdata` after `sid`, so the resulting rows are identical to the
+    ones written by individual `logdata` calls.
+
+    :param str sid: client ID the records were received from
+    :param list records: list of `[client_timestamp, request_timestamp, key, value]` lists
+    """
+    app.logger.info([[sid] + list(record) for record in records], extra={"batch": True})
+
+
+def log_policy():
+    """
+    Client log policy from the `log-level` and `log-sample` metadata. `log-level` is one of
+    `minimal`, `standard`, or `full`. `log-sample` is a comma separated list of `key:n` pairs to
+    log only every n-th record of that key, `key:0` turns the key off.
+
+    :returns: dictionary with the `level` and the `sample` rate per key
+    :rtype: dict
+    """
+    with metadata_lock:
+        level = str(metadata.get("log-level") or "full")
+        sample = str(metadata.get("log-sample") or "")
+    if level not in LOG_LEVELS:
+        warnings.warn(f"Unknown log-level {level}, logging everything")
+        level = "full"
+    rates = {}
+    for item in sample.split(","):
+        key, _, every = item.strip().rpartition(":")
+        if not key:
+            continue
+        try:
+            rates[key.strip()] = max(int(every), 0)
+        except ValueError:
+            warnings.warn(f"Ignoring log-sample {item.strip()}, the rate must be an integer")
+    return {"level": level, "sample": rates}
+
+
+def send_log_policy(to=None):
+    """
+    Send the client log policy and store it in the log.
+
+    :param str to: session ID of the client, all clients if None
+    """
+    policy = log_policy()
+    socketio.emit("log-policy", policy, to=to)
+    logdata("server", 0, time.time_ns(), "log-policy", json.dumps(policy))
+
+
 @socketio.on("connect")
 def connect():
     """
-    Confirm SocketIO connection by printing "Client connected"
+    Confirm SocketIO connection by printing "Client connected" and send the client log policy.
     """
     print("Client connected", request.sid)
+    send_log_policy(request.sid)
 
 
 @socketio.on("disconnect")
@@ -178,6 +356,39 @@ def disconnect():
     Verify SocketIO disconnect
     """
     print("Client disconnected", request.sid)
+    clock_sync.unregister(request.sid)
+    display_group.leave(request.sid)
+
+
+@socketio.on("clock-sync-start")
+def clock_sync_start():
+    """
+    Start the clock synchronisation with a display client.
+    """
+    clock_sync.register(request.sid)
+
+
+@socketio.on("display-join")
+def display_join(name):
+    """
+    Add a display client to the display group.
+
+    :param str name: name of the display, for example its page
+    """
+    display_group.join(request.sid, name)
+
+
+@socketio.on("clock-pong")
+def clock_pong(sequence, client_ms):
+    """
+    Answer of a client to a `clock-ping` of the clock synchronisation.
+
+    :param int sequence: sequence number of the ping
+    :param float client_ms: client time when the ping was answered
+    """
+    clock_sync.pong(request.sid, sequence, client_ms)
+    if clock_sync.is_synchronised(request.sid):
+        display_group.synchronised(request.sid)
 
 
 @socketio.on('stop-pressed')
@@ -204,15 +415,29 @@ def manual_restart(empty):
 @socketio.on('start-experiment')
 def finally_start(number):
     """
-    When the server receives a `start-experiment` message via SocketIO, the global variable start
-    is set to true
+    When the server receives a `start-experiment` message via SocketIO, the current session starts
+    if it waits for the start. The session gets a new log and a snapshot of the metadata. The
+    time since the end of the previous session is logged as `session-turnaround`.
 
     :param number: TODO find out what it does
     """
-    # FIXME: bad practice. Will break at some point
-    print("Started at {}".format(time.strftime("%Y%m%d_%H%M%S")))
-    global start
-    start = True
+    session = current_session
+    if session is not None and session.state == "waiting":
+        print("Started at {}".format(time.strftime("%Y%m%d_%H%M%S")))
+        log_name = open_log()
+        with metadata_lock:
+            snapshot = dict(metadata)
+        session.start(snapshot, log_name, log_writer, fictrac_writer)
+        # latencies of stimulus messages: from sending to receiving (emit-receive) and rendering
+        # (emit-render) on the client, and from receiving to rendering (receive-render)
+        session.onset_stats.update({
+            "emit-receive": LatencyStats(), "emit-render": LatencyStats(),
+            "receive-render": LatencyStats()})
+        shared_key = time.time_ns()
+        logdata("server", 0, shared_key, "session-start", json.dumps(session.status()))
+        if previous_session is not None and previous_session.finished is not None:
+            logdata("server", 0, shared_key, "session-turnaround",
+                    session.started - previous_session.finished)
     socketio.emit('experiment-started')
 
 
@@ -254,6 +479,93 @@ def data_logger(client_timestamp, request_timestamp, key, value):
     logdata(request.sid, client_timestamp, request_timestamp, key, value)
 
 
+@socketio.on('dlb')
+def data_logger_batch(records):
+    """
+    Batched data logger routine for data sent from the client. The client buffers the records it
+    would otherwise send as individual `dl` messages and sends them as one list.
+
+    :param list records: list of `[client_timestamp, request_timestamp, key, value]` records
+    """
+    if records:
+        logdatabatch(request.sid, records)
+
+
+@socketio.on('frame-stats')
+def frame_stats(client_timestamp, request_timestamp, trial_id, summary):
+    """
+    Store the frame time summary of a trial and show it on the control panel.
+
+    :param client_timestamp: timestamp from the client
+    :param request_timestamp: timestamp of the `trial-end` message
+    :param trial_id: trial the summary belongs to
+    :param dict summary: frame counts, longest frame, and p50, p95, p99 frame times in ms,
+        and the frame time histogram
+    """
+    summary = dict(summary, trial=trial_id)
+    logdata(request.sid, client_timestamp, request_timestamp, "frame-stats", json.dumps(summary))
+    socketio.emit('frame-stats-update', (request.sid, summary))
+
+
+@socketio.on('schedule-progress')
+def schedule_progress(client_timestamp, request_timestamp, index, late_ms):
+    """
+    Log the progress of a schedule on the client.
+
+    :param client_timestamp: timestamp from the client
+    :param request_timestamp: timestamp of the last applied command
+    :param int index: index of the last applied command in the schedule
+    :param float late_ms: time between the scheduled and the actual frame of the command
+    """
+    logdata(request.sid, client_timestamp, request_timestamp, "schedule-progress",
+            json.dumps({"index": index, "late": late_ms}))
+    runner = protocol_runners.get(app.config["RIG"])
+    if runner is not None and runner.active:
+        runner.set_progress(index + 1)
+
+
+@socketio.on('onset-ack')
+def onset_ack(onsets):
+    """
+    Log when stimulus messages were received and first rendered by the client, and add the
+    latencies to the session statistics. Client times are mapped to server time with the clock
+    synchronisation, the emit latencies are missing until the client clock is synchronised, and
+    for commands of a schedule, which are not sent on their own.
+    Messages of the display group also log the time between their shared time and the frame
+    as `apply-render`. Closed loop updates add the latency of each stage from the FicTrac
+    capture to the rendered frame as `trace`, see `ClosedLoopTrace`.
+
+    :param list onsets: list of `[sequence, receive_ms, render_ms]` with the sequence number of
+        the message, the time it was received, and the requestAnimationFrame timestamp of the
+        first frame rendered afterwards
+    """
+    session = current_session
+    onset_stats = session.onset_stats if session is not None else {}
+    for sequence, receive_ms, render_ms in onsets:
+        sent = experiment_io.acknowledge(sequence)
+        if sent is None:
+            continue
+        event, shared_key, emit_ns, apply_ns = sent
+        latencies = {"receive-render": render_ms - receive_ms}
+        receive_ns = clock_sync.to_server_ns(request.sid, receive_ms)
+        render_ns = clock_sync.to_server_ns(request.sid, render_ms)
+        if receive_ns is not None and emit_ns is not None:
+            latencies["emit-receive"] = (receive_ns - emit_ns) / 1e6
+            latencies["emit-render"] = (render_ns - emit_ns) / 1e6
+        for key, latency in latencies.items():
+            if key in onset_stats:
+                onset_stats[key].add(latency)
+        row = dict(latencies, sequence=sequence, event=event)
+        if apply_ns is not None and render_ns is not None:
+            row["apply-render"] = display_group.rendered(request.sid, apply_ns, render_ns)
+        if event in CLOSED_LOOP_EVENTS:
+            trace = closed_loop_trace.rendered(
+                request.sid, shared_key, emit_ns, receive_ns, render_ns)
+            if trace is not None:
+                row["trace"] = trace
+        logdata(request.sid, render_ms, shared_key, "onset", json.dumps(row))
+
+
 @socketio.on('display')
 def display_event(data):
     savedata(request.sid, data['cnt'], "display-offset", data['counter'])
@@ -263,8 +575,37 @@ def display_event(data):
 def trigger_stop(empty):
     socketio.emit('stop-triggered', empty)
     print("Stopped")
-    global start
-    start = False
+    if current_session is not None:
+        current_session.stop()
+    experiment_io.thaw(restore=False)
+
+
+@socketio.on('pause-pressed')
+def trigger_pause(empty):
+    """
+    Pause the running protocol at the current phase, or before its first phase while it waits
+    for the displays. The client holds its schedule as well, and the stimulus is frozen: the pattern stops rotating and oscillating, and closed loop
+    conditions hold their updates.
+    """
+    session = current_session
+    if session is not None and session.state == "running" and session.timeline.pause():
+        print("Paused")
+        socketio.emit('schedule-pause', time.time_ns())
+        experiment_io.freeze()
+        socketio.emit('condition-update', "Paused")
+
+
+@socketio.on('resume-pressed')
+def trigger_resume(empty):
+    """
+    Resume a paused protocol. All remaining phases move by the paused interval, and the stimulus
+    continues with the rotation and oscillation from before the pause.
+    """
+    if current_session is not None and current_session.timeline.resume():
+        print("Resumed")
+        experiment_io.thaw()
+        socketio.emit('schedule-resume', time.time_ns())
+        socketio.emit('condition-update', "Resumed")
 
 
 @socketio.on('start-pressed')
@@ -278,39 +619,146 @@ def trigger_restart(empty):
     socketio.emit('restart-triggered', empty)
 
 
-def log_fictrac_timestamp():
+def log_fictrac_timestamp(session):
+    """
+    Record the FicTrac frames of the `fictrac_service` while the session is recording. Every
+    frame is recorded with all columns, the receive time, and the current trial and condition in
+    the session's `.fictrac` file. The frame counter is also logged as `fictrac-frame` without
+    sending it to the client. If FicTrac does not send at the start, this is logged as
+    `fictrac-connect-fail` and frames are recorded once FicTrac starts sending.
+
+    :param Session session: session that owns the recording
+    """
     shared_key = time.time_ns()
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(0.1)
-        data = ""
-        try:
-            sock.bind(( '127.0.0.1', 1717))
-            new_data = sock.recv(1)
-            data = new_data.decode('UTF-8')
-            socketio.emit("meta", (shared_key, "fictrac-connect-ok", 1))
-        except: # If Fictrac doesn't exist # FIXME: catch specific exception
-            socketio.emit("meta", (shared_key, "fictrac-connect-fail", 0))
-            warnings.warn("Fictrac is not running on 127.0.0.1:1717")
+    subscription = fictrac_service.subscribe("recorder")
+    if subscription.connect():
+        experiment_io.emit("meta", (shared_key, "fictrac-connect-ok", 1))
+    else:
+        experiment_io.emit("meta", (shared_key, "fictrac-connect-fail", 0))
+        warnings.warn("Fictrac is not sending to {}:{}".format(
+            app.config["FICTRAC_HOST"], app.config["FICTRAC_PORT"]))
+    try:
+        while session.recording:
+            if not subscription.wait(0.1):
+                continue
+            for frame in subscription.read():
+                session.fictrac_writer.push(
+                    [frame.receive_ns, session.fictrac_tags["trial"],
+                     session.fictrac_tags["condition"]] + frame.values)
+                logdata("server", 0, shared_key, "fictrac-frame", frame.counter)
+    finally:
+        subscription.close()
+
+
+def trigger_block(socket_io, timeline, block, repetitions, shuffle=False, on_progress=None):
+    """
+    Trigger all repetitions of a block of trials after a short black screen. The trials are
+    numbered in the order they are shown.
+
+    :param socket_io: Socket.IO used for communication with the client, or the `ProtocolSchedule`
+        that records the messages
+    :param timeline: `Timeline` of the experiment, or the `ProtocolSchedule` being compiled
+    :param list block: `Trial` objects of the block
+    :param int repetitions: number of times the block is shown
+    :param bool shuffle: shuffle the trials for each repetition
+    :param on_progress: function called with `(done, total)` before each trial
+    :raises TimelineStopped: if the experiment is stopped
+    """
+    compiling = isinstance(socket_io, ProtocolSchedule)
+    counter = 0
+    opening_black_screen = Duration(100)
+    opening_black_screen.trigger_delay(socket_io, timeline, "opening")
+    for i in range(repetitions):
+        socket_io.emit("meta", (time.time_ns(), "block-repetition", i))
+        if shuffle:
+            block = random.sample(block, k=len(block))
+        for current_trial in block:
+            counter = counter + 1
+            progress = f"Condition {counter} of {len(block*repetitions)}"
+            if not compiling:
+                print(progress)
+            if on_progress is not None:
+                on_progress(counter - 1, len(block*repetitions))
+            socket_io.emit("condition-update", progress)
+            current_trial.set_id(counter)
+            current_trial.trigger(socket_io, timeline)
+
+
+def run_protocol(runner, block, repetitions, shuffle=False):
+    """
+    Open a new session and wait for its start, then run all repetitions of a block of trials while
+    recording FicTrac. The protocol starts once all displays of the `display_group` are ready and
+    its messages are applied by all displays at the same time. If they are not ready within 10 s,
+    the protocol starts anyway and the control panel shows the displays that apply its messages
+    on arrival instead. With `--schedule client` the
+    block is compiled into a `ProtocolSchedule` that the client executes, otherwise each message
+    is sent at the time it is due. The session is the `current_session` until the next protocol
+    opens one, so that the control panel can stop, pause, and resume it. The progress and the end
+    of the protocol are tracked in its runner. A runner that is replaced by another protocol
+    before the start returns without running.
+
+    :param ProtocolRunner runner: runner of the protocol in `protocol_runners`
+    :param list block: `Trial` objects of the block
+    :param int repetitions: number of times the block is shown
+    :param bool shuffle: shuffle the trials for each repetition
+    """
+    global current_session, previous_session
+    session = Session(runner.rig, runner.name, log_meta)
+    previous_session, current_session = current_session, session
+    socketio.emit("session-ready", session.status())
+    while not session.is_started:
+        if not runner.active:
+            session.finish("stopped")
+            return
+        if session.state != "waiting":
+            runner.finish("stopped")
             return
+        time.sleep(0.05)
+    timeline = session.timeline
+    runner.start()
+    session.recording = True
+    log_metadata(session)
+    _ = socketio.start_background_task(log_fictrac_timestamp, session)
+
+    display_group.timeline = timeline
+    try:
+        if not display_group.wait_ready(timeline):
+            waiting = display_group.waiting()
+            socketio.emit("condition-update", (
+                f"Started without clock model on {', '.join(waiting)}" if waiting else
+                "Started without displays"))
+        if app.config["SCHEDULE"] == "client":
+            schedule = ProtocolSchedule()
+            trigger_block(schedule, schedule, block, repetitions, shuffle)
+            print(f"Compiled {len(schedule.commands)} commands, {schedule.duration()/1000:.1f} s")
+            runner.set_progress(0, len(schedule.client_commands()))
+            completed = schedule.run(display_group, timeline, log_meta)
+        else:
+            trigger_block(
+                display_group, timeline, block, repetitions, shuffle, runner.set_progress)
+            completed = True
+    except TimelineStopped:
+        completed = False
+    finally:
+        display_group.timeline = None
+        session.recording = False
+    if not completed:
+        log_meta(time.time_ns(), "experiment-stopped", timeline.phase)
+        session.finish("stopped")
+        runner.finish("stopped")
+        return
+
+    log_writer_stats()
+    log_onset_stats(session)
+    if runner.total is not None:
+        runner.set_progress(runner.total)
+    session.finish("completed")
+    runner.finish("completed")
+    socketio.emit("condition-update", "Completed")
+    print(time.strftime("%H:%M:%S", time.localtime()))
+
 
-        while RUN_FICTRAC:
-            new_data = sock.recv(1024)
-            if not new_data:
-                break
-            data += new_data.decode('UTF-8')
-            endline = data.find("\n")
-            line = data[:endline]
-            data = data[endline+1:]
-            toks = line.split(", ")
-            if (len(toks) < 24) | (toks[0] != "FT"):
-                continue # This is not the expected fictrac data package
-            cnt = int(toks[1])
-            #if cnt-prevfrm > 100:
-            socketio.emit("meta", (shared_key, "fictrac-frame", cnt))
-            #    prevfrm = cnt
-
-
-def proto_optomotor_4dir():
+def proto_optomotor_4dir(runner):
     print(time.strftime("%H:%M:%S", time.localtime()))
     block = []
     counter = 0
@@ -338,35 +786,9 @@ def proto_optomotor_4dir():
                         block.append(trial)
                         counter += 1
 
-    while not start:
-        time.sleep(0.1)
-    global RUN_FICTRAC
-    RUN_FICTRAC = True
-    log_metadata()
-    _ = socketio.start_background_task(target = log_fictrac_timestamp)
+    run_protocol(runner, block, repetitions=4)
 
-    repetitions = 4
-    counter = 0
-    opening_black_screen = Duration(100)
-    opening_black_screen.trigger_delay(socketio)
-    for i in range(repetitions):
-        socketio.emit("meta", (time.time_ns(), "block-repetition", i))
-        #block = random.sample(block, k=len(block))
-        for current_trial in block:
-            counter = counter + 1
-            progress = f"Condition {counter} of {len(block*repetitions)}"
-            print(progress)
-            socketio.emit("condition-update", progress)
-            current_trial.set_id(counter)
-            current_trial.trigger(socketio)
-            if not start:
-                return
-
-    RUN_FICTRAC = False
-    socketio.emit("condition-update", "Completed")
-    print(time.strftime("%H:%M:%S", time.localtime()))
-
-def proto_grating():
+def proto_grating(runner):
     print(time.strftime("%H:%M:%S", time.localtime()))
     block = []
     counter = 0
@@ -393,36 +815,10 @@ def proto_grating():
                         block.append(trial)
                         counter += 1
 
-    while not start:
-        time.sleep(0.1)
-    global RUN_FICTRAC
-    RUN_FICTRAC = True
-    log_metadata()
-    _ = socketio.start_background_task(target = log_fictrac_timestamp)
-
-    repetitions = 2
-    counter = 0
-    opening_black_screen = Duration(100)
-    opening_black_screen.trigger_delay(socketio)
-    for i in range(repetitions):
-        socketio.emit("meta", (time.time_ns(), "block-repetition", i))
-        #block = random.sample(block, k=len(block))
-        for current_trial in block:
-            counter = counter + 1
-            progress = f"Condition {counter} of {len(block*repetitions)}"
-            print(progress)
-            socketio.emit("condition-update", progress)
-            current_trial.set_id(counter)
-            current_trial.trigger(socketio)
-            if not start:
-                return
-
-    RUN_FICTRAC = False
-    socketio.emit("condition-update", "Completed")
-    print(time.strftime("%H:%M:%S", time.localtime()))
+    run_protocol(runner, block, repetitions=2)
 
 
-def proto_smallfield():
+def proto_smallfield(runner):
     print(time.strftime("%H:%M:%S", time.localtime()))
     block = []
     counter = 0
@@ -474,36 +870,10 @@ def proto_smallfield():
                         block.append(trial)
                         counter += 1
 
-    while not start:
-        time.sleep(0.1)
-    global RUN_FICTRAC
-    RUN_FICTRAC = True
-    log_metadata()
-    _ = socketio.start_background_task(target = log_fictrac_timestamp)
-
-    repetitions = 4
-    counter = 0
-    opening_black_screen = Duration(100)
-    opening_black_screen.trigger_delay(socketio)
-    for i in range(repetitions):
-        socketio.emit("meta", (time.time_ns(), "block-repetition", i))
-        #block = random.sample(block, k=len(block))
-        for current_trial in block:
-            counter = counter + 1
-            progress = f"Condition {counter} of {len(block*repetitions)}"
-            print(progress)
-            socketio.emit("condition-update", progress)
-            current_trial.set_id(counter)
-            current_trial.trigger(socketio)
-            if not start:
-                return
-
-    RUN_FICTRAC = False
-    socketio.emit("condition-update", "Completed")
-    print(time.strftime("%H:%M:%S", time.localtime()))
+    run_protocol(runner, block, repetitions=4)
 
 
-def proto_cshlfly22():
+def proto_cshlfly22(runner):
     print(time.strftime("%H:%M:%S", time.localtime()))
     block = []
     counter = 0
@@ -571,33 +941,71 @@ def proto_cshlfly22():
                     block.append(trial)
                     counter += 1
 
-    while not start:
-        time.sleep(0.1)
-    global RUN_FICTRAC
-    RUN_FICTRAC = True
-    log_metadata()
-    _ = socketio.start_background_task(target = log_fictrac_timestamp)
+    run_protocol(runner, block, repetitions=3, shuffle=True)
 
-    repetitions = 3
-    counter = 0
-    opening_black_screen = Duration(100)
-    opening_black_screen.trigger_delay(socketio)
-    for i in range(repetitions):
-        socketio.emit("meta", (time.time_ns(), "block-repetition", i))
-        block = random.sample(block, k=len(block))
-        for current_trial in block:
-            counter = counter + 1
-            progress = f"Condition {counter} of {len(block*repetitions)}"
-            print(progress)
-            socketio.emit("condition-update", progress)
-            current_trial.set_id(counter)
-            current_trial.trigger(socketio)
-            if not start:
-                return
 
-    RUN_FICTRAC = False
-    socketio.emit("condition-update", "Completed")
-    print(time.strftime("%H:%M:%S", time.localtime()))
+def proto_closedloop_latency(runner):
+    """
+    Closed loop trials to measure the latency from the FicTrac capture to the rendered frame,
+    for example on the bench with `--fake-fictrac`. Each trial is reported as
+    `closedloop-latency` and on the control panel. Trials with an even number send `predict`
+    updates that the client extrapolates, the others send the rotation speed.
+    """
+    block = []
+    for counter in range(1, 7):
+        trial = Trial(
+            counter,
+            bar_deg=15, space_deg=165,
+            openloop_duration=Duration(500),
+            closedloop_bar_deg=15, closedloop_duration=Duration(10000),
+            predict=counter % 2 == 0, horizon_ms=50,
+            pretrial_duration=Duration(250), posttrial_duration=Duration(250),
+            comment="Closed loop latency")
+        block.append(trial)
+    run_protocol(runner, block, repetitions=1)
+
+
+def launch_protocol(name, target):
+    """
+    Start a protocol on this rig, unless it is already active there. Reloading the page of a
+    running protocol or opening it in a second tab therefore does not start another runner.
+
+    :param str name: name of the protocol
+    :param target: function that runs the protocol, called with its `ProtocolRunner`
+    """
+    if not protocol_runners.launch(app.config["RIG"], name, target):
+        runner = protocol_runners.get(app.config["RIG"])
+        print(f"Not starting {name}, {runner.name} is {runner.state}")
+
+
+# protocols that can be armed from the control panel, by the name of their route
+PROTOCOLS = {
+    "optomotor_4-directions": proto_optomotor_4dir,
+    "grating": proto_grating,
+    "smallfield": proto_smallfield,
+    "cshlfly22": proto_cshlfly22,
+    "closedloop-latency": proto_closedloop_latency}
+
+
+@socketio.on('arm-pressed')
+def arm_next(name=None):
+    """
+    Arm the next session on this rig while the current one runs, for example for the next fly.
+    The armed protocol waits for the start of the experiment as soon as the current one ends,
+    without reloading the stimulus page.
+
+    :param str name: protocol in `PROTOCOLS`, the latest protocol of the rig if None
+    """
+    rig = app.config["RIG"]
+    if name not in PROTOCOLS:
+        runner = protocol_runners.get(rig)
+        name = runner.name if runner is not None else None
+    if name not in PROTOCOLS:
+        socketio.emit("condition-update", "No protocol to arm")
+        return
+    protocol_runners.arm(rig, name, PROTOCOLS[name])
+    queued = protocol_runners.queued(rig)
+    socketio.emit("condition-update", f"Armed {name}, {len(queued)} queued")
 
 
 @app.route('/control-panel/')
@@ -613,7 +1021,7 @@ def optomotor_4dir():
     """
     Short protocol with optomotor responses moving into four different directions. (~0:50)
     """
-    _ = socketio.start_background_task(target=proto_optomotor_4dir)
+    launch_protocol("optomotor_4-directions", proto_optomotor_4dir)
     return render_template('cshlfly.html')
 
 @app.route('/grating/')
@@ -621,7 +1029,7 @@ def grating():
     """
     Protocol with different contrasts, bar widths, and movement speed (~7:00)
     """
-    _ = socketio.start_background_task(target=proto_grating)
+    launch_protocol("grating", proto_grating)
     return render_template('cshlfly.html')
 
 
@@ -630,7 +1038,7 @@ def smallfield():
     """
     Small field stimuli: first a 15° dark bar and then a small square moves 3× left/rigth at 4 different velocities (~4:30)
     """
-    _ = socketio.start_background_task(target=proto_smallfield)
+    launch_protocol("smallfield", proto_smallfield)
     return render_template('cshlfly.html')
 
 
@@ -639,21 +1047,17 @@ def cshfly22():
     """
     An example protocol from CSHL 2022
     """
-    _ = socketio.start_background_task(target=proto_cshlfly22)
+    launch_protocol("cshlfly22", proto_cshlfly22)
     return render_template('cshlfly.html')
 
 
-@socketio.on('metadata-submit')
-def handle_data(data):
+@app.route('/closedloop-latency/')
+def closedloop_latency():
     """
-    Triggered when metadata is submitted via the control panel
-    takes the javascript objects and converts it to a python dictionary
-    stores the dictionary in the metadata variable that is used in log_metadata()
+    Closed loop trials that measure the latency from the FicTrac capture to the rendered frame (~1:05)
     """
-    metadata_string = json.dumps(data)
-    global metadata
-    with metadata_lock:
-        metadata.update(json.loads(metadata_string))
+    launch_protocol("closedloop-latency", proto_closedloop_latency)
+    return render_template('cshlfly.html')
 
 
 @socketio.on('metadata-submit')
@@ -664,23 +1068,90 @@ def handle_data(data):
     stores the dictionary in the metadata variable that is used in log_metadata()
     """
     metadata_string = json.dumps(data)
-    print(metadata_string)
     global metadata
-    metadata.update(json.loads(metadata_string))
-    print(metadata)
-
+    with metadata_lock:
+        metadata.update(json.loads(metadata_string))
+    send_log_policy()
 
 
-def log_metadata():
+def log_metadata(session):
     """
-    The content of the `metadata` dictionary gets logged.
+    The snapshot of the `metadata` dictionary that the session took at its start gets logged.
 
     This is a rudimentary way to save information related to the experiment to a file. Edit the
     content of the dictionary for each experiment.
+
+    :param Session session: session that started
     """
     shared_key = time.time_ns()
-    for key, value in metadata.items():
+    for key, value in session.metadata.items():
         logdata(1, 0, shared_key, key, value)
+    logdata("server", 0, shared_key, "log-policy", json.dumps(log_policy()))
+
+
+def log_writer_stats():
+    """
+    The current statistics of the log writer get logged.
+    """
+    shared_key = time.time_ns()
+    for key, value in log_writer.stats().items():
+        logdata(1, 0, shared_key, f"log-writer-{key}", value)
+
+
+def log_onset_stats(session):
+    """
+    The latency statistics of stimulus messages in the session get logged.
+
+    :param Session session: session that ends
+    """
+    shared_key = time.time_ns()
+    for key, stats in session.onset_stats.items():
+        logdata("server", 0, shared_key, f"onset-stats-{key}", json.dumps(stats.summary()))
+
+
+@app.route('/onset-stats/')
+def onset_stats_summary():
+    """
+    Percentiles of the latencies of stimulus messages in the current session, in ms.
+    """
+    if current_session is None:
+        return {}
+    return {key: stats.summary() for key, stats in current_session.onset_stats.items()}
+
+
+@app.route('/session/')
+def session_status():
+    """
+    State of the current and the previous session, and the protocols armed on this rig.
+    """
+    return {
+        "current": current_session.status() if current_session is not None else None,
+        "previous": previous_session.status() if previous_session is not None else None,
+        "queued": protocol_runners.queued(app.config["RIG"])}
+
+
+@app.route('/runners/')
+def runner_status():
+    """
+    State, progress, and resource use of the latest protocol on each rig.
+    """
+    return protocol_runners.status()
+
+
+@app.route('/fictrac/')
+def fictrac_status():
+    """
+    State of the FicTrac socket, and the read, missed, and pending frames of each subscriber.
+    """
+    return fictrac_service.status()
+
+
+@app.route('/log-stats/')
+def log_stats():
+    """
+    Queue depth, written and dropped records of the data log writer.
+    """
+    return log_writer.stats()
 
 
 @app.route("/")
@@ -706,6 +1177,45 @@ def print_ip(port=17000):
                         print(f"FlyFlix is available at http://{ip_add}:{port}")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="FlyFlix server")
+    parser.add_argument(
+        "--log-format", choices=["csv", "binary", "both"], default="csv",
+        help="write the data log as CSV, as columnar binary (.ffb), or both")
+    parser.add_argument(
+        "--log-compression", choices=["gzip", "zstd"], default=None,
+        help="compress the data log while writing it")
+    parser.add_argument(
+        "--schedule", choices=["server", "client"], default="server",
+        help="send each stimulus change when it is due, or compile the protocol and send it to "
+             "the client before the start")
+    parser.add_argument(
+        "--serializer", choices=["json", "msgpack"], default="json",
+        help="send Socket.IO messages as JSON text or as binary msgpack")
+    parser.add_argument(
+        "--websocket-only", action="store_true",
+        help="only accept websocket connections, without the long-polling fallback")
+    parser.add_argument(
+        "--rig", default=socket.gethostname(),
+        help="name of the rig, each rig runs at most one protocol at a time")
+    parser.add_argument(
+        "--fictrac-host", default="127.0.0.1",
+        help="address the server receives FicTrac frames on, `sock_host` in FicTrac")
+    parser.add_argument(
+        "--fictrac-port", type=int, default=1717,
+        help="UDP port the server receives FicTrac frames on, `sock_port` in FicTrac")
+    parser.add_argument(
+        "--fake-fictrac", type=float, default=0, metavar="HZ",
+        help="send synthetic FicTrac frames at this rate to the server itself, for example to "
+             "measure the closed loop latency with /closedloop-latency/ without a fly")
+    parser.add_argument(
+        "--display-lead", type=float, default=50,
+        help="time in ms between sending a stimulus change and applying it on all displays")
+    args = parser.parse_args()
+    app.config.update(
+        LOG_FORMAT=args.log_format, LOG_COMPRESSION=args.log_compression, SCHEDULE=args.schedule,
+        DISPLAY_LEAD=args.display_lead, RIG=args.rig, SERIALIZER=args.serializer,
+        WEBSOCKET_ONLY=args.websocket_only, FICTRAC_HOST=args.fictrac_host,
+        FICTRAC_PORT=args.fictrac_port, FAKE_FICTRAC=args.fake_fictrac)
     before_first_request()
     port=17000
     print_ip(port=port)
@@ -23,6 +23,9 @@ class Panels extends Group {
         this.arenaHeight = arenaHeight;
         this.rotateRadHz = 0;
         this.startTime = undefined;
+        // latest closed loop sample in prediction mode, see `setPrediction()`
+        this.prediction = null;
+        this.predictionBase = 0;
         const fgColor = 0x00ff00;
         const bgColor = 0x000000;
         this._setup(panelAngle, intervalAngle, fgColor, bgColor, arenaHeight);
@@ -84,6 +87,7 @@ class Panels extends Group {
      *      is clockwise
      */
     setRotateRadHz(rotateRadHz){
+        this.prediction = null;
         this.rotateRadHz = rotateRadHz;
         this._log('panels-set-rotateRadHz', rotateRadHz);
     }
@@ -95,11 +99,13 @@ class Panels extends Group {
     *      positive is clockwise
     */
     setRotateDegHz(rotate_deg_hz){
+        this.prediction = null;
         this.rotateRadHz = MathUtils.degToRad(rotate_deg_hz);
         this._log('panels-set-rotate_deg_hz', rotate_deg_hz);
     }
 
     setOscillation(osc_hz, max_deg){
+        this.prediction = null;
         if (osc_hz>0){
             this.startTime = Date.now()/1000;
         } else {
@@ -115,18 +121,60 @@ class Panels extends Group {
      * @param {number} rotation - set the absolute rotation of the camera in radians
      */
     setRotationRad(rotation){
+        this.prediction = null;
         this.rotation.y = rotation % (2*Math.PI);
         this._log('panels-set-rotationRad', rotation);
     }
 
 
+    /**
+     * Follow the heading of the fly in closed loop with latency compensation. Until the next
+     *      sample, each tick extrapolates the heading with the angular velocity to the time the
+     *      frame is expected on screen, at most `horizon` ms beyond the sample. The first sample
+     *      keeps the current rotation. Each further sample logs the difference between its
+     *      heading and the heading extrapolated from the previous sample as
+     *      `panels-prediction-error`. Setting a rotation speed, rotation, or oscillation ends
+     *      the prediction.
+     * 
+     * @param {number} angle - heading since the start of the closed loop in radians
+     * @param {number} velocity - angular velocity in radians per second
+     * @param {number} sampleTime - capture time of the sample on the clock of this client in ms
+     * @param {number} horizon - longest extrapolation in ms
+     */
+    setPrediction(angle, velocity, sampleTime, horizon){
+        if (this.prediction === null){
+            this.predictionBase = this.rotation.y - angle;
+        } else {
+            this._log('panels-prediction-error', angle - this._extrapolate(sampleTime));
+        }
+        this.startTime = undefined;
+        this.rotateRadHz = 0;
+        this.prediction = {angle, velocity, sampleTime, horizon};
+    }
+
+    /**
+     * (private) Heading of the latest prediction sample extrapolated to a time.
+     * 
+     * @param {number} time - time on the clock of this client in ms
+     * @returns {number} heading since the start of the closed loop in radians
+     */
+    _extrapolate(time){
+        const {angle, velocity, sampleTime, horizon} = this.prediction;
+        return angle + velocity * Math.min(Math.max(time - sampleTime, 0), horizon) / 1000;
+    }
+
     /**
      * Interface to allow arena to be animated.
      * 
      * @param {number} delta - time interval since last tick
      */
     tick(delta){
-        if (this.startTime === undefined){
+        if (this.prediction !== null){
+            // the frame of this tick is expected on screen one frame interval from now
+            const heading = this._extrapolate(performance.now() + delta * 1000);
+            this.rotation.y = (this.predictionBase + heading) % (2*Math.PI);
+            this._log('panels-tick-rotation', this.rotation.y);
+        } else if (this.startTime === undefined){
             this.rotation.y = (this.rotation.y + delta * this.rotateRadHz) % (2*Math.PI);
             this._log('panels-tick-rotation', this.rotation.y);
         } else {
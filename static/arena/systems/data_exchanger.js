@@ -2,6 +2,45 @@
  * Module to exchange data between server and client. This is FlyFlix specific.
  */
 import { Color, MathUtils } from '/static/vendor/three.module.js';
+import { SchedulePlayer } from './schedule_player.js';
+
+/**
+ * Rotation of the masks relative to the panels in radians.
+ */
+const MASK_OFFSET = MathUtils.degToRad(35);
+
+/**
+ * Version of the `condition-setup` message this client understands.
+ */
+const CONDITION_SETUP_VERSION = 1;
+
+/**
+ * Messages that change the stimulus. The server adds a sequence number as the last argument and
+ *      the client acknowledges the first rendered frame that shows the change.
+ */
+const STIMULUS_EVENTS = new Set([
+    'speed', 'oscillation', 'spatial-setup', 'rotate-to', 'camera-flip', 'fps', 'condition-setup',
+    'predict'
+]);
+
+/**
+ * Log verbosity levels. A key is logged if its tier is at or below the active level.
+ */
+const LOG_LEVELS = {'minimal': 0, 'standard': 1, 'full': 2};
+
+/**
+ * Tier of high-rate keys: 2 for keys logged every frame, 1 for setup details such as one row
+ *      per bar. All other keys have tier 0 and are always logged.
+ */
+const LOG_KEY_TIERS = {
+    'loop-tick-delta': 2,
+    'loop-render': 2,
+    'loop-skip': 2,
+    'panels-tick-rotation': 2,
+    'camera-tick-rotation': 2,
+    'mask-tick-rotation': 2,
+    'panels-bar': 1,
+};
 class DataExchanger{
 
     /**
@@ -14,24 +53,179 @@ class DataExchanger{
      */
     constructor(camera, scene, loop, panels, masks){
 
-        // The data exchanger connects to a Socket IO at port 17000
+        // The data exchanger connects to a Socket IO at port 17000 with the serializer and
+        // transports of the server, see `socket_options.js`
         const socketurl = window.location.hostname + ":17000";
-        this.socket = io(socketurl);
+        this.socket = io(socketurl, socketOptions(socketConfig));
         this.isLogging = false;
 
-        const mr = MathUtils.degToRad(35);
+        // Client logs are buffered and sent as one `dlb` message every `logBatchInterval` ms or
+        // once `logBatchSize` records are waiting. Append `?log=dl` to the URL to send every
+        // record as its own `dl` message instead.
+        const params = new URLSearchParams(window.location.search);
+        this.logBatching = params.get('log') !== 'dl';
+        this.logBatchInterval = Number(params.get('log-interval') ?? 100);
+        this.logBatchSize = Number(params.get('log-size') ?? 500);
+        this.logBuffer = [];
+
+        // The log policy is sent by the server at connect time and after metadata changes.
+        // Until then everything is logged.
+        this.logLevel = LOG_LEVELS['full'];
+        this.logSample = {};
+        this.logCounts = {};
+        if (this.logBatching){
+            setInterval(() => this.flushLog(), this.logBatchInterval);
+            window.addEventListener('end-experiment', () => this.flushLog());
+            window.addEventListener('pagehide', () => this.flushLog());
+        }
+
+        // A `condition-setup` is applied by `tick()` at the start of the next frame, or right
+        // before a later stimulus message, so that messages are applied in the order they
+        // arrive. Commands of a precompiled protocol are applied by the player just before that.
+        this.camera = camera;
+        this.scene = scene;
+        this.loop = loop;
+        this.panels = panels;
+        this.masks = masks;
+        this.pendingSetup = null;
+        this.isMuted = false;
+        // Messages of the display group are held until their shared time, see `tick()`. The
+        // display joins the group under the name given as `?display=` or its page.
+        this.pendingApply = [];
+        this.displayName = params.get('display') ?? window.location.pathname;
+        loop.updateables.unshift(this);
+        this.schedulePlayer = new SchedulePlayer(
+            this.socket, (sequence) => this.pendingOnsets.push([sequence, performance.now()]));
+        loop.updateables.unshift(this.schedulePlayer);
+
+        // Stimulus messages are acknowledged with their receive time and the timestamp of the
+        // first frame rendered afterwards, as one `onset-ack` message per frame.
+        this.pendingOnsets = [];
+        this.socket.onAny((event, ...args) => {
+            if (STIMULUS_EVENTS.has(event)){
+                this.pendingOnsets.push([args[args.length-1], performance.now()]);
+            }
+        });
+        loop.onRender = (time) => this.acknowledgeOnsets(time);
 
         /**
          * Event handler for `disconnect` sends the event `end-experiment` and stops camera 
          *      and panels rotation.
          */
         this.socket.on('disconnect', () => {
+            this.schedulePlayer.cancel();
+            this.pendingApply = [];
             const endEvent = new Event('end-experiment');
             panels.setRotateRadHz(0);
             camera.setRotateRadHz(0);
             window.dispatchEvent(endEvent);
         });
 
+        /**
+         * Event handler for `log-policy` sets the log verbosity level and the per-key sampling.
+         * 
+         * @param {object} policy - `level` is one of `minimal`, `standard`, or `full`, `sample`
+         *      maps keys to log only every n-th record, 0 turns the key off
+         */
+        this.socket.on('log-policy', (policy) => {
+            this.logLevel = LOG_LEVELS[policy.level] ?? LOG_LEVELS['full'];
+            this.logSample = policy.sample ?? {};
+            this.logCounts = {};
+            this.log(0, 'de-log-policy', JSON.stringify(policy));
+        });
+
+        /**
+         * Event handler for `schedule` loads a precompiled protocol.
+         * 
+         * @param {Array} commands - list of `[timeMs, event, args, sequence]` commands ordered
+         *      by time
+         */
+        this.socket.on('schedule', (commands) => {
+            this.schedulePlayer.load(commands);
+            this.log(0, 'de-schedule', commands.length);
+        });
+
+        /**
+         * Event handler for `schedule-start` starts the loaded protocol.
+         * 
+         * @param {number} leadMs - time until the first command in milliseconds
+         */
+        this.socket.on('schedule-start', (leadMs) => {
+            this.schedulePlayer.start(leadMs);
+            this.log(0, 'de-schedule-start', leadMs);
+        });
+
+        /**
+         * Event handler for `schedule-start-at` starts the loaded protocol at the shared start
+         *      time of the display group.
+         * 
+         * @param {number} timeMs - start time on the clock of this client in milliseconds
+         */
+        this.socket.on('schedule-start-at', (timeMs) => {
+            this.schedulePlayer.startAt(timeMs);
+            this.log(0, 'de-schedule-start-at', timeMs);
+        });
+
+        this.socket.on('schedule-cancel', (lid) => {
+            this.schedulePlayer.cancel();
+            this.log(lid, 'de-schedule-cancel');
+        });
+
+        this.socket.on('schedule-pause', (lid) => {
+            this.schedulePlayer.pause();
+            this.log(lid, 'de-schedule-pause');
+        });
+
+        this.socket.on('schedule-resume', (lid) => {
+            this.schedulePlayer.resume();
+            this.log(lid, 'de-schedule-resume');
+        });
+
+        /**
+         * Event handler for `connect` joins the display group and starts the clock
+         *      synchronisation with the server.
+         */
+        this.socket.on('connect', () => {
+            this.socket.emit('display-join', this.displayName);
+            this.socket.emit('clock-sync-start');
+        });
+
+        /**
+         * Event handler for `apply-at` holds a message of the display group until its shared
+         *      time. The message is then applied in `tick()` as if it had just arrived.
+         * 
+         * @param {number} timeMs - shared time on the clock of this client in milliseconds
+         * @param {string} event - name of the held message
+         * @param {Array} args - arguments of the held message
+         */
+        this.socket.on('apply-at', (timeMs, event, args) => {
+            this.pendingApply.push([timeMs, event, args, performance.now()]);
+        });
+
+        /**
+         * Event handler for `clock-ping` answers right away with the current client time.
+         * 
+         * @param {number} sequence - sequence number of the ping
+         */
+        this.socket.on('clock-ping', (sequence) => {
+            this.socket.emit('clock-pong', sequence, performance.now());
+        });
+
+        this.clockModel = null;
+
+        /**
+         * Event handler for `clock-model` keeps the latest model of this clock from the server,
+         *      used to map server times to client times, see `toClientTime()`.
+         * 
+         * @param {number} referenceMs - reference time on the clock of this client in ms
+         * @param {number} referenceServerMs - the reference time on the server clock in ms
+         * @param {number} slope - server ms per client ms
+         */
+        this.socket.on('clock-model', (referenceMs, referenceServerMs, slope) => {
+            this.clockModel = {referenceMs, referenceServerMs, slope};
+            this.log(0, 'de-clock-model', JSON.stringify(this.clockModel));
+        });
+
         this.socket.on('experiment-started', () =>{
             const startExperiment = new Event('experiment-started');
             window.dispatchEvent(startExperiment);
@@ -44,12 +238,33 @@ class DataExchanger{
          * @param {number} speed - set rotational speed for panels in radians per second
          */
         this.socket.on('speed', (lid, speed) => {
+            this.applySetup();
             panels.setLid(lid);
             panels.setRotateRadHz(speed);
             this.log(lid, 'de-panel-speed', speed);
         });
 
+        /**
+         * Event handler for `predict` passes a closed loop sample to the panels, which
+         *      extrapolate the heading to the time each frame is shown. Without a clock model
+         *      the sample is assumed to be captured on arrival.
+         * 
+         * @param {bigint} lid - Loop ID, the newest FicTrac frame counter
+         * @param {number} angle - heading since the start of the closed loop in radians
+         * @param {number} velocity - angular velocity in radians per second
+         * @param {number} captureServerMs - capture time of the sample on the server clock in ms
+         * @param {number} horizonMs - longest extrapolation beyond the sample in ms
+         */
+        this.socket.on('predict', (lid, angle, velocity, captureServerMs, horizonMs) => {
+            const sampleTime = this.toClientTime(captureServerMs) ?? performance.now();
+            this.applySetup();
+            panels.setLid(lid);
+            panels.setPrediction(angle, velocity, sampleTime, horizonMs);
+            this.log(lid, 'de-panel-predict', angle);
+        });
+
         this.socket.on('oscillation', (lid, osc_freq, osc_width) => {
+            this.applySetup();
             panels.setLid(lid);
             panels.setOscillation(osc_freq, osc_width);
             this.log(lid, 'de-panels-oscillation', osc_freq);
@@ -72,6 +287,7 @@ class DataExchanger{
          * @param {number} targetRotationRad - target rotation in radians
          */
         this.socket.on('rotate-to', (lid, targetRotationRad) => {
+            this.applySetup();
             panels.setLid(lid);
             panels.setRotationRad(targetRotationRad);
             this.log(lid, 'de-rotate-panel-to', targetRotationRad);
@@ -79,6 +295,7 @@ class DataExchanger{
 
 
         this.socket.on('camera-flip', (lid, updown) => {
+            this.applySetup();
             camera.flipUpDown(updown);
             this.log(lid, 'de-flip-camera-updown', updown);
         }
@@ -91,6 +308,7 @@ class DataExchanger{
          * @param {number} fps - target client frame rate
          */
         this.socket.on('fps', (lid, fps) => {
+            this.applySetup();
             loop.setLid(lid);
             loop.setFPS(fps);
             this.log(lid, 'de-fps', fps);
@@ -104,12 +322,13 @@ class DataExchanger{
          * @param {number} spaceWidth - interval width between bars in radians
          */
         this.socket.on('spatial-setup', (lid, barWidth, spaceWidth, maskStart, maskEnd, fgColor, bgColor, barHeight) => {
+            this.applySetup();
             panels.setLid(lid);
             panels.changePanels(barWidth, spaceWidth, fgColor, bgColor, barHeight);
             //scene.changeBgColor(bgColor);
             scene.background = new Color(bgColor);
             masks.setLid(lid);
-            masks.changeMask(maskStart+mr, maskEnd+mr, bgColor);
+            masks.changeMask(maskStart+MASK_OFFSET, maskEnd+MASK_OFFSET, bgColor);
             this.log(lid, 'de-spatial-setup-bar', barWidth);
             this.log(lid, 'de-spatial-setup-space', spaceWidth);
             this.log(lid, 'de-spatial-setup-mask-start', maskStart);
@@ -120,14 +339,40 @@ class DataExchanger{
         });
 
         /**
-         * Event handler for `meta`. The key and value will be logged.
+         * Event handler for `condition-setup` message with the complete stimulus state of a
+         *      condition. The setup is applied at once at the start of the next frame, a later
+         *      setup before that frame replaces it. Any other stimulus message applies the setup
+         *      first, so that it does not overwrite the changes of later messages.
+         * 
+         * @param {bigint} lid - Loop ID
+         * @param {object} setup - versioned stimulus state, see
+         *      `SpatialTemporal.trigger_condition_setup` on the server
+         */
+        this.socket.on('condition-setup', (lid, setup) => {
+            if (setup.version !== CONDITION_SETUP_VERSION){
+                console.warn(`Ignoring condition-setup version ${setup.version}, reload the page`);
+                this.log(lid, 'de-condition-setup-version', setup.version);
+                return;
+            }
+            this.pendingSetup = [lid, setup];
+        });
+
+        /**
+         * Event handler for `meta`. The server already logged the key and value when sending
+         *      the message, so only the receive time is logged as `meta-ack` with the key. At
+         *      `trial-end` the frame time summary of the trial is sent as `frame-stats`.
          * 
          * @param {bigint} lid - Loop ID
          * @param {string} key - key of key-value-pair
          * @param {string} value - value of key-value-pair
          */
         this.socket.on('meta', (lid, key, value) => {
-            this.log(lid, key, value);
+            this.log(lid, 'meta-ack', key);
+            if (key === 'trial-start'){
+                loop.takeFrameStats();
+            } else if (key === 'trial-end'){
+                this.socket.emit('frame-stats', performance.now(), lid, value, loop.takeFrameStats());
+            }
         })
 
         /**
@@ -143,16 +388,130 @@ class DataExchanger{
     }
 
     /**
-     * Log client on the server by sending a `dl` message with the current client timestamp, lid, 
-     *      key, and value.
+     * Apply the held messages of the display group that are due on this frame, which are those
+     *      closer to this frame than to the next one. Then apply a pending `condition-setup`.
+     * 
+     * @param {number} delta - time interval since last tick in seconds
+     */
+    tick(delta){
+        const horizon = performance.now() + delta * 1000 / 2;
+        while (this.pendingApply.length > 0 && this.pendingApply[0][0] <= horizon){
+            const [, event, args, receiveTime] = this.pendingApply.shift();
+            for (const handler of this.socket.listeners(event)){
+                handler(...args);
+            }
+            if (STIMULUS_EVENTS.has(event)){
+                this.pendingOnsets.push([args[args.length-1], receiveTime]);
+            }
+        }
+        this.applySetup();
+    }
+
+    /**
+     * Apply a pending `condition-setup`, if any. The components do not log the single changes,
+     *      the whole setup is logged as one `de-condition-setup` record.
+     */
+    applySetup(){
+        if (this.pendingSetup === null){
+            return;
+        }
+        const [lid, setup] = this.pendingSetup;
+        this.pendingSetup = null;
+        this.isMuted = true;
+        this.loop.setLid(lid);
+        this.loop.setFPS(setup['fps']);
+        this.panels.setLid(lid);
+        this.panels.changePanels(setup['bar'], setup['space'],
+            setup['fg-color'], setup['bg-color'], setup['bar-height']);
+        this.scene.background = new Color(setup['bg-color']);
+        this.masks.setLid(lid);
+        this.masks.changeMask(setup['mask-start']+MASK_OFFSET, setup['mask-end']+MASK_OFFSET,
+            setup['bg-color']);
+        this.camera.flipUpDown(setup['camera-flip']);
+        this.panels.setRotateRadHz(setup['speed']);
+        this.panels.setOscillation(...setup['oscillation']);
+        if (setup['rotation'] !== null){
+            this.panels.setRotationRad(setup['rotation']);
+        }
+        this.isMuted = false;
+        this.log(lid, 'de-condition-setup', JSON.stringify(setup));
+    }
+
+    /**
+     * Map a time on the server clock to the clock of this client.
+     * 
+     * @param {number} serverMs - server time in ms
+     * @returns {number|null} client time in ms, null without a clock model
+     */
+    toClientTime(serverMs){
+        if (this.clockModel === null){
+            return null;
+        }
+        const {referenceMs, referenceServerMs, slope} = this.clockModel;
+        return referenceMs + (serverMs - referenceServerMs) / slope;
+    }
+
+    /**
+     * Acknowledge all stimulus messages received since the last rendered frame.
+     * 
+     * @param {number} renderTime - requestAnimationFrame timestamp of the rendered frame
+     */
+    acknowledgeOnsets(renderTime){
+        if (this.pendingOnsets.length > 0){
+            this.socket.emit('onset-ack', this.pendingOnsets.map(
+                ([sequence, receiveTime]) => [sequence, receiveTime, renderTime]));
+            this.pendingOnsets = [];
+        }
+    }
+
+    /**
+     * Log client on the server with the current client timestamp, lid, key, and value. In batch
+     *      mode the record is buffered until the next `flushLog()`, otherwise it is sent right
+     *      away as a `dl` message. Records are dropped according to the active log policy.
      * 
      * @param {bigint} lid - Loop ID
      * @param {string} key - key of key-value-pair
      * @param {string} value - value of key-value-pair
      */
     log(lid, key, value){
-        if (this.isLogging){
-            this.socket.emit('dl', performance.now(), lid, key, value);
+        if (this.isLogging && !this.isMuted && this._sample(key)){
+            if (this.logBatching){
+                this.logBuffer.push([performance.now(), lid, key, value]);
+                if (this.logBuffer.length >= this.logBatchSize){
+                    this.flushLog();
+                }
+            } else {
+                this.socket.emit('dl', performance.now(), lid, key, value);
+            }
+        }
+    }
+
+    /**
+     * (private) Decide if a record with this key is logged under the active log policy. Keys
+     *      with a sampling rate are logged every n-th time, other keys depend on their tier.
+     * 
+     * @param {string} key - key of key-value-pair
+     * @returns {boolean} true if the record should be logged
+     */
+    _sample(key){
+        const every = this.logSample[key] ??
+            ((LOG_KEY_TIERS[key] ?? 0) <= this.logLevel ? 1 : 0);
+        if (every <= 1){
+            return every === 1;
+        }
+        const count = this.logCounts[key] ?? 0;
+        this.logCounts[key] = count + 1;
+        return count % every === 0;
+    }
+
+    /**
+     * Send all buffered log records as a single `dlb` message. Each record has the same fields
+     *      as the arguments of a `dl` message.
+     */
+    flushLog(){
+        if (this.logBuffer.length > 0){
+            this.socket.emit('dlb', this.logBuffer);
+            this.logBuffer = [];
         }
     }
 }
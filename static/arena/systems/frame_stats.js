@@ -0,0 +1,104 @@
+/**
+ * Running frame time statistics of the animation loop. This is FlyFlix specific.
+ */
+
+/** Width of a histogram bin in milliseconds */
+const BIN_MS = 0.25;
+/** Number of histogram bins, the last bin counts all longer frames */
+const BIN_COUNT = 401;
+
+class FrameStats {
+
+    /**
+     * Histogram of frame times with counters for rendered, skipped, and dropped frames. The
+     *      histogram uses fixed bins, so adding a frame is constant time and percentiles are
+     *      available at any point without keeping every frame time.
+     *
+     * @constructor
+     */
+    constructor() {
+        this.histogram = new Uint32Array(BIN_COUNT);
+        this.reset();
+    }
+
+    /**
+     * Start a new set of statistics, for example at the start of a trial.
+     */
+    reset() {
+        this.histogram.fill(0);
+        this.frames = 0;
+        this.rendered = 0;
+        this.skipped = 0;
+        this.dropped = 0;
+        this.longest = 0;
+    }
+
+    /**
+     * Add a frame to the statistics. A frame that takes more than one and a half times the
+     *      render interval counts every missed interval as a dropped frame.
+     *
+     * @param {number} delta - time since the previous frame in seconds
+     * @param {number} interval - target render interval in seconds
+     * @param {boolean} rendered - true if the frame was rendered, false if it was skipped to keep
+     *      the target frame rate
+     */
+    add(delta, interval, rendered) {
+        const ms = delta * 1000;
+        this.histogram[Math.min(Math.floor(ms / BIN_MS), BIN_COUNT - 1)]++;
+        this.frames++;
+        if (rendered) {
+            this.rendered++;
+        } else {
+            this.skipped++;
+        }
+        if (delta > 1.5 * interval) {
+            this.dropped += Math.round(delta / interval) - 1;
+        }
+        this.longest = Math.max(this.longest, ms);
+    }
+
+    /**
+     * Frame time at a percentile, estimated as the upper edge of the histogram bin.
+     *
+     * @param {number} percent - percentile between 0 and 100
+     * @returns {number} frame time in milliseconds
+     */
+    percentile(percent) {
+        const rank = Math.ceil(this.frames * percent / 100);
+        let count = 0;
+        for (let bin = 0; bin < BIN_COUNT; bin++) {
+            count += this.histogram[bin];
+            if (count >= rank && count > 0) {
+                return bin < BIN_COUNT - 1 ? (bin + 1) * BIN_MS : this.longest;
+            }
+        }
+        return 0;
+    }
+
+    /**
+     * Summary of the statistics. The histogram is cut after the last non-empty bin.
+     *
+     * @returns {object} frame counts, the longest frame and the p50, p95, and p99 frame times in
+     *      milliseconds, and the histogram with its bin width
+     */
+    summary() {
+        let last = BIN_COUNT;
+        while (last > 0 && this.histogram[last - 1] === 0) {
+            last--;
+        }
+        return {
+            'frames': this.frames,
+            'rendered': this.rendered,
+            'skipped': this.skipped,
+            'dropped': this.dropped,
+            'longest': this.longest,
+            'p50': this.percentile(50),
+            'p95': this.percentile(95),
+            'p99': this.percentile(99),
+            'bin-ms': BIN_MS,
+            'histogram': Array.from(this.histogram.subarray(0, last)),
+        };
+    }
+}
+
+export { FrameStats };
@@ -1,4 +1,5 @@
 import { Clock } from '/static/vendor/three.module.js';
+import { FrameStats } from './frame_stats.js';
 
 const clock = new Clock();
 
@@ -25,22 +26,32 @@ class Loop {
         this.updateables = [];
         this.interval = 1/60;
         this.rdelta = clock.getDelta();
+        this.delta = 0;
+        this.frameStats = new FrameStats();
 
         this.lid = 0;
         this.loggable = null;
+        // called with the requestAnimationFrame timestamp after each rendered frame
+        this.onRender = null;
     }
 
     /**
-     * Start the animation
+     * Start the animation. After each rendered frame, `onRender` is called with the
+     *      requestAnimationFrame timestamp of the frame.
      */
     start() {
-        this.renderer.setAnimationLoop(() => {
+        this.renderer.setAnimationLoop((time) => {
             this.tick();
             if( this.rdelta > this.interval){
                 this.renderer.render(this.scene, this.camera);
                 this.rdelta = this.rdelta % this.interval;
+                this.frameStats.add(this.delta, this.interval, true);
+                if (this.onRender){
+                    this.onRender(time);
+                }
                 this._log('loop-render', this.rdelta);
             } else {
+                this.frameStats.add(this.delta, this.interval, false);
                 this._log('loop-skip', this.rdelta);
             }
         }
@@ -61,6 +72,7 @@ class Loop {
      */
     tick() {
         const delta = clock.getDelta();
+        this.delta = delta;
         this.rdelta += delta;
         this._log('loop-tick-delta', delta);
         for(const object of this.updateables) {
@@ -68,6 +80,18 @@ class Loop {
         }
     }
 
+    /**
+     * Frame time summary since the last call, for example for a single trial. The statistics
+     *      start over afterwards.
+     * 
+     * @returns {object} summary as returned by `FrameStats.summary()`
+     */
+    takeFrameStats(){
+        const summary = this.frameStats.summary();
+        this.frameStats.reset();
+        return summary;
+    }
+
     /**
      * Set the Loop ID.
      * 
@@ -0,0 +1,119 @@
+/**
+ * Module to execute a precompiled protocol schedule on the client. This is FlyFlix specific.
+ */
+class SchedulePlayer {
+
+    /**
+     * Plays a schedule of `[timeMs, event, args, sequence]` commands. Each command is applied by
+     *      calling the handlers registered for its event on the socket, exactly as if the server
+     *      had sent it, on the frame closest to its scheduled time. Add the player to the front
+     *      of the loop's `updateables`, so that the commands take effect on the same frame.
+     *
+     * @constructor
+     * @param {Socket} socket - Socket.IO connection with the handlers for all events
+     * @param {function} onApply - called with the sequence number of each applied stimulus
+     *      command, so that its onset can be acknowledged
+     */
+    constructor(socket, onApply) {
+        this.socket = socket;
+        this.onApply = onApply;
+        this.commands = [];
+        this.next = 0;
+        this.startTime = undefined;
+        this.pausedAt = undefined;
+    }
+
+    /**
+     * Set the schedule. It starts with `start()`.
+     *
+     * @param {Array} commands - list of `[timeMs, event, args, sequence]` commands ordered by
+     *      time, the sequence number is null for commands that are not stimulus messages
+     */
+    load(commands) {
+        this.commands = commands;
+        this.next = 0;
+        this.startTime = undefined;
+    }
+
+    /**
+     * Start the schedule after a lead time.
+     *
+     * @param {number} leadMs - time until the schedule starts in milliseconds
+     */
+    start(leadMs) {
+        this.startAt(performance.now() + leadMs);
+    }
+
+    /**
+     * Start the schedule at a given time, for example the shared start of a display group.
+     *
+     * @param {number} timeMs - start time as `performance.now()` in milliseconds
+     */
+    startAt(timeMs) {
+        this.startTime = timeMs;
+    }
+
+    /**
+     * Stop the schedule. The remaining commands are not applied.
+     */
+    cancel() {
+        this.next = this.commands.length;
+        this.startTime = undefined;
+        this.pausedAt = undefined;
+    }
+
+    /**
+     * Hold the schedule. No commands are applied until `resume()`.
+     */
+    pause() {
+        if (this.pausedAt === undefined) {
+            this.pausedAt = performance.now();
+        }
+    }
+
+    /**
+     * Continue a paused schedule. All remaining commands move by the paused interval.
+     */
+    resume() {
+        if (this.pausedAt !== undefined) {
+            if (this.startTime !== undefined) {
+                this.startTime += performance.now() - this.pausedAt;
+            }
+            this.pausedAt = undefined;
+        }
+    }
+
+    /**
+     * Apply all commands due on this frame, which are those closer to this frame than to the
+     *      next one. Report the last applied command to the server as `schedule-progress`.
+     *
+     * @param {number} delta - time interval since last tick in seconds
+     */
+    tick(delta) {
+        if (this.startTime === undefined || this.pausedAt !== undefined ||
+                this.next >= this.commands.length) {
+            return;
+        }
+        const now = performance.now() - this.startTime;
+        const horizon = now + delta * 1000 / 2;
+        let late = 0;
+        const first = this.next;
+        while (this.next < this.commands.length && this.commands[this.next][0] <= horizon) {
+            const [at, event, args, sequence] = this.commands[this.next];
+            for (const handler of this.socket.listeners(event)) {
+                handler(...args);
+            }
+            if (sequence !== undefined && sequence !== null && this.onApply) {
+                this.onApply(sequence);
+            }
+            late = now - at;
+            this.next++;
+        }
+        if (this.next > first) {
+            const [, , args] = this.commands[this.next - 1];
+            this.socket.emit('schedule-progress', performance.now(), args[0], this.next - 1, late);
+        }
+    }
+}
+
+export { SchedulePlayer };
@@ -9,7 +9,7 @@ import { ExperimentControl } from './arena/systems/experiment_control.js';
  *    `three-container-bars.html` template file.
  */
 
-var socket = io();
+var socket = io(socketOptions(socketConfig));
 
 function main() {
     const container = document.querySelector('#scene-container');
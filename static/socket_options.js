@@ -0,0 +1,269 @@
+/**
+ * Socket.IO connection options shared by all FlyFlix pages, including the msgpack parser that
+ *      matches `SocketIO(..., serializer='msgpack')` on the server. Load this script after
+ *      `socket.io.min.js` and connect with `io(url, socketOptions(socketConfig))`, where the
+ *      page template sets `socketConfig` from the server configuration.
+ */
+
+/**
+ * Version of the Socket.IO protocol the parser implements.
+ */
+const MSGPACK_PROTOCOL = 5;
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+/**
+ * Encode a value as msgpack. Integers outside the 32 bit range are written as 64 bit integers,
+ *      so that server timestamps in ns that the client sends back arrive as integers, exactly as
+ *      with JSON.
+ *
+ * @param {*} value - value with numbers, strings, booleans, null, arrays, byte arrays, and objects
+ * @returns {Uint8Array} encoded value
+ */
+function msgpackEncode(value) {
+    const bytes = [];
+    const view = new DataView(new ArrayBuffer(8));
+    const pushView = (count) => {
+        for (let i = 0; i < count; i++) {
+            bytes.push(view.getUint8(i));
+        }
+    };
+    const pushHead = (length, fix, fixMax, codes) => {
+        if (length <= fixMax) {
+            bytes.push(fix | length);
+        } else if (codes[0] !== null && length < 0x100) {
+            bytes.push(codes[0], length);
+        } else if (length < 0x10000) {
+            bytes.push(codes[1]);
+            view.setUint16(0, length);
+            pushView(2);
+        } else {
+            bytes.push(codes[2]);
+            view.setUint32(0, length);
+            pushView(4);
+        }
+    };
+    const encode = (value) => {
+        if (value === null || value === undefined) {
+            bytes.push(0xc0);
+        } else if (value === false || value === true) {
+            bytes.push(value ? 0xc3 : 0xc2);
+        } else if (typeof value === 'number' && Number.isInteger(value) &&
+                value >= -(2 ** 63) && value < 2 ** 64) {
+            if (value >= 0 && value < 0x80) {
+                bytes.push(value);
+            } else if (value < 0 && value >= -32) {
+                bytes.push(value & 0xff);
+            } else if (value >= 0 && value < 2 ** 32) {
+                bytes.push(0xce);
+                view.setUint32(0, value);
+                pushView(4);
+            } else if (value < 0 && value >= -(2 ** 31)) {
+                bytes.push(0xd2);
+                view.setInt32(0, value);
+                pushView(4);
+            } else if (value >= 0) {
+                bytes.push(0xcf);
+                view.setBigUint64(0, BigInt(value));
+                pushView(8);
+            } else {
+                bytes.push(0xd3);
+                view.setBigInt64(0, BigInt(value));
+                pushView(8);
+            }
+        } else if (typeof value === 'number') {
+            bytes.push(0xcb);
+            view.setFloat64(0, value);
+            pushView(8);
+        } else if (typeof value === 'string') {
+            const utf8 = textEncoder.encode(value);
+            pushHead(utf8.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+            for (const byte of utf8) {
+                bytes.push(byte);
+            }
+        } else if (value instanceof ArrayBuffer || ArrayBuffer.isView(value)) {
+            const data = value instanceof ArrayBuffer ? new Uint8Array(value) :
+                new Uint8Array(value.buffer, value.byteOffset, value.byteLength);
+            pushHead(data.length, 0, -1, [0xc4, 0xc5, 0xc6]);
+            for (const byte of data) {
+                bytes.push(byte);
+            }
+        } else if (Array.isArray(value)) {
+            pushHead(value.length, 0x90, 15, [null, 0xdc, 0xdd]);
+            for (const item of value) {
+                encode(item);
+            }
+        } else if (typeof value === 'object') {
+            const keys = Object.keys(value).filter((key) => value[key] !== undefined);
+            pushHead(keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+            for (const key of keys) {
+                encode(key);
+                encode(value[key]);
+            }
+        } else {
+            throw new Error(`msgpack cannot encode ${typeof value}`);
+        }
+    };
+    encode(value);
+    return new Uint8Array(bytes);
+}
+
+/**
+ * Decode a msgpack value. 64 bit integers become numbers, with the same loss of precision
+ *      beyond 2^53 as with JSON.
+ *
+ * @param {Uint8Array} data - encoded value
+ * @returns {*} decoded value
+ */
+function msgpackDecode(data) {
+    const view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+    let offset = 0;
+    const take = (count) => {
+        const start = offset;
+        offset += count;
+        return start;
+    };
+    const string = (length) => textDecoder.decode(data.subarray(take(length), offset));
+    const bin = (length) => data.slice(take(length), offset);
+    const array = (length) => {
+        const result = new Array(length);
+        for (let i = 0; i < length; i++) {
+            result[i] = decode();
+        }
+        return result;
+    };
+    const map = (length) => {
+        const result = {};
+        for (let i = 0; i < length; i++) {
+            const key = decode();
+            result[key] = decode();
+        }
+        return result;
+    };
+    const decode = () => {
+        const code = view.getUint8(take(1));
+        if (code < 0x80) return code;
+        if (code < 0x90) return map(code & 0x0f);
+        if (code < 0xa0) return array(code & 0x0f);
+        if (code < 0xc0) return string(code & 0x1f);
+        if (code >= 0xe0) return code - 0x100;
+        switch (code) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return bin(view.getUint8(take(1)));
+            case 0xc5: return bin(view.getUint16(take(2)));
+            case 0xc6: return bin(view.getUint32(take(4)));
+            case 0xca: return view.getFloat32(take(4));
+            case 0xcb: return view.getFloat64(take(8));
+            case 0xcc: return view.getUint8(take(1));
+            case 0xcd: return view.getUint16(take(2));
+            case 0xce: return view.getUint32(take(4));
+            case 0xcf: return Number(view.getBigUint64(take(8)));
+            case 0xd0: return view.getInt8(take(1));
+            case 0xd1: return view.getInt16(take(2));
+            case 0xd2: return view.getInt32(take(4));
+            case 0xd3: return Number(view.getBigInt64(take(8)));
+            case 0xd9: return string(view.getUint8(take(1)));
+            case 0xda: return string(view.getUint16(take(2)));
+            case 0xdb: return string(view.getUint32(take(4)));
+            case 0xdc: return array(view.getUint16(take(2)));
+            case 0xdd: return array(view.getUint32(take(4)));
+            case 0xde: return map(view.getUint16(take(2)));
+            case 0xdf: return map(view.getUint32(take(4)));
+            default: throw new Error(`msgpack type 0x${code.toString(16)} is not supported`);
+        }
+    };
+    return decode();
+}
+
+/**
+ * Socket.IO packet encoder that writes each packet as one msgpack map with `type`, `nsp`,
+ *      `data`, and `id`.
+ */
+class MsgpackEncoder {
+
+    /**
+     * Encode a packet.
+     *
+     * @param {object} packet - Socket.IO packet
+     * @returns {Array} list with the encoded packet
+     */
+    encode(packet) {
+        return [msgpackEncode(packet)];
+    }
+}
+
+/**
+ * Socket.IO packet decoder for packets written by `MsgpackEncoder` or the msgpack serializer
+ *      of python-socketio. Each decoded packet is passed to the `decoded` listeners.
+ */
+class MsgpackDecoder {
+
+    constructor() {
+        this.listeners = {};
+    }
+
+    /**
+     * Decode one packet as received from Engine.IO.
+     *
+     * @param {ArrayBuffer|Uint8Array} chunk - encoded packet
+     */
+    add(chunk) {
+        if (typeof chunk === 'string') {
+            throw new Error('msgpack parser received a text packet, check the server serializer');
+        }
+        const data = chunk instanceof ArrayBuffer ? new Uint8Array(chunk) :
+            new Uint8Array(chunk.buffer, chunk.byteOffset, chunk.byteLength);
+        const packet = msgpackDecode(data);
+        if (!Number.isInteger(packet.type) || typeof packet.nsp !== 'string') {
+            throw new Error('invalid msgpack packet');
+        }
+        if (packet.id === null) {
+            delete packet.id;
+        }
+        this.emit('decoded', packet);
+    }
+
+    /**
+     * Nothing is buffered between packets, so there is nothing to release.
+     */
+    destroy() {}
+
+    on(event, listener) {
+        (this.listeners[event] ??= []).push(listener);
+        return this;
+    }
+
+    off(event, listener) {
+        this.listeners[event] = (this.listeners[event] ?? []).filter((l) => l !== listener);
+        return this;
+    }
+
+    emit(event, ...args) {
+        for (const listener of this.listeners[event] ?? []) {
+            listener(...args);
+        }
+        return this;
+    }
+}
+
+/**
+ * Connection options for `io()` from the server configuration.
+ *
+ * @param {object} config - `serializer` is `json` or `msgpack`, `transports` lists the
+ *      Engine.IO transports, all transports if missing
+ * @returns {object} options for `io()`
+ */
+function socketOptions(config) {
+    const options = {};
+    if (config?.serializer === 'msgpack') {
+        options.parser = {
+            protocol: MSGPACK_PROTOCOL, Encoder: MsgpackEncoder, Decoder: MsgpackDecoder};
+    }
+    if (config?.transports) {
+        options.transports = config.transports;
+    }
+    return options;
+}
@@ -0,0 +1,49 @@
+"""Tests of the binary session log `Experiment.BinarySink` and its CSV export"""
+
+import pytest
+
+from Experiment import BinarySink, CsvSink
+from Experiment.binary_sink import binary_to_csv
+from Experiment.compressed_stream import zstandard
+
+ROWS = [
+    [1_700_000_000_000_000_000, "client_id", "client_timestamp", "request_timestamp", "key",
+     "value"],
+    [1_700_000_000_000_000_001, "server", 0, 1_699_999_999_999_999_999, "trial-start", 3],
+    [1_700_000_000_000_000_002, "abc", 12.5, 7, "panels-tick-rotation", 0.1 + 0.2],
+    [1_700_000_000_000_000_003, "abc", -1.0, None, "comment", 'quote " comma , line\nbreak'],
+    [1_700_000_000_000_000_004, 1, 0, 2**70, "flag", True],
+    [1_700_000_000_000_000_005, "server", 0, 8, "de-panel-speed", float("inf")],
+    [1_700_000_000_000_000_006, "abc", 3.0, 9, "trial-start", "ünïcode"],
+]
+
+
+def write(sink, rows, batch):
+    """Write the rows in batches of `batch` rows and close the sink."""
+    for start in range(0, len(rows), batch):
+        sink.write(rows[start:start + batch])
+    sink.close()
+
+
+@pytest.mark.parametrize("batch", [1, 3, len(ROWS)])
+@pytest.mark.parametrize("compression", [
+    None, "gzip",
+    pytest.param("zstd", marks=pytest.mark.skipif(zstandard is None, reason="no zstandard"))])
+def test_csv_export_matches_csv_sink(tmp_path, compression, batch):
+    suffix = {None: "", "gzip": ".gz", "zstd": ".zst"}[compression]
+    write(CsvSink(tmp_path / "log.csv"), ROWS, batch)
+    write(BinarySink(str(tmp_path / f"log.ffb{suffix}"), chunk_rows=2, compression=compression),
+          ROWS, batch)
+    count = binary_to_csv(str(tmp_path / f"log.ffb{suffix}"), tmp_path / "export.csv")
+    assert count == len(ROWS)
+    assert (tmp_path / "export.csv").read_bytes() == (tmp_path / "log.csv").read_bytes()
+
+
+def test_export_of_truncated_log_stops_at_last_chunk(tmp_path):
+    write(BinarySink(str(tmp_path / "log.ffb"), chunk_rows=2), ROWS, 2)
+    data = (tmp_path / "log.ffb").read_bytes()
+    (tmp_path / "crashed.ffb").write_bytes(data[:-3])
+    count = binary_to_csv(str(tmp_path / "crashed.ffb"), tmp_path / "export.csv")
+    assert count == 6
+    write(CsvSink(tmp_path / "log.csv"), ROWS[:6], len(ROWS))
+    assert (tmp_path / "export.csv").read_bytes() == (tmp_path / "log.csv").read_bytes()
@@ -0,0 +1,62 @@
+"""Tests of the clock model of `Experiment.ClockSync`"""
+
+import random
+
+import pytest
+
+from Experiment import ClockSync
+
+OFFSET_NS = 1_700_000_000_000_000_000
+DRIFT = 50e-6
+
+
+def server_ns(client_ms):
+    """Server time of a client time for a client clock with an offset and a drift."""
+    return round(OFFSET_NS + client_ms * 1e6 * (1 + DRIFT))
+
+
+def exchange(sync, client_ms, before_ns, after_ns):
+    """Ping sent `before_ns` before and pong received `after_ns` after the client answered."""
+    answered_ns = server_ns(client_ms)
+    sync.add(answered_ns - before_ns, client_ms, answered_ns + after_ns)
+
+
+def test_no_model_before_first_burst():
+    sync = ClockSync()
+    assert not sync.end_burst()
+    assert sync.to_server_ns(1000.0) is None
+    assert sync.to_client_ms(OFFSET_NS) is None
+
+
+def test_burst_keeps_shortest_round_trip():
+    sync = ClockSync()
+    exchange(sync, 1000.0, 4_000_000, 200_000)
+    exchange(sync, 1010.0, 150_000, 150_000)
+    exchange(sync, 1020.0, 100_000, 3_000_000)
+    assert sync.end_burst()
+    assert sync.rtt_ns == 300_000
+    # the symmetric exchange is exact, the others would be off by ms
+    assert sync.to_server_ns(1010.0) == pytest.approx(server_ns(1010.0), abs=1)
+
+
+def test_fit_recovers_offset_and_drift():
+    rng = random.Random(1)
+    sync = ClockSync()
+    for burst in range(20):
+        for exchange_count in range(16):
+            client_ms = burst * 30_000.0 + exchange_count * 10.0
+            exchange(sync, client_ms, rng.randint(100_000, 2_000_000),
+                     rng.randint(100_000, 2_000_000))
+        sync.end_burst()
+    assert sync.model()["drift"] == pytest.approx(DRIFT * 1e6, abs=1)
+    for client_ms in (0.0, 300_000.0, 600_000.0):
+        assert sync.to_server_ns(client_ms) == pytest.approx(server_ns(client_ms), abs=1e6)
+
+
+@pytest.mark.parametrize("client_ms", [0.0, 1234.5, 86_400_000.25])
+def test_to_client_inverts_to_server(client_ms):
+    sync = ClockSync()
+    for burst in range(3):
+        exchange(sync, burst * 30_000.0, 200_000, 200_000)
+        sync.end_burst()
+    assert sync.to_client_ms(sync.to_server_ns(client_ms)) == pytest.approx(client_ms, abs=1e-6)
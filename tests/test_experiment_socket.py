@@ -0,0 +1,67 @@
+"""Tests of freezing and thawing the stimulus with `Experiment.ExperimentSocket`"""
+
+from Experiment import ExperimentSocket
+
+
+class RecordingSocket():
+    """Stands in for `SocketIO` and keeps the sent messages."""
+
+    def __init__(self):
+        self.sent = []
+
+    def emit(self, event, *args, **kwargs):
+        self.sent.append((event, args[0] if args else None))
+
+
+def experiment_socket():
+    """Socket and the list of messages it sends."""
+    socket_io = RecordingSocket()
+    return ExperimentSocket(socket_io, lambda *args: None), socket_io.sent
+
+
+def motion(sent):
+    """Event and values of the sent messages, without shared key and sequence number."""
+    return [(event, data[1:-1]) for event, data in sent]
+
+
+def test_freeze_stops_rotation_and_oscillation():
+    socket, sent = experiment_socket()
+    socket.emit("speed", (1, 2.5))
+    sent.clear()
+    assert socket.freeze()
+    assert socket.paused
+    assert motion(sent) == [("speed", (0,)), ("oscillation", (0, 0))]
+    assert not socket.freeze()
+
+
+def test_thaw_restores_the_motion_from_before_the_freeze():
+    socket, sent = experiment_socket()
+    socket.emit("speed", (1, 2.5))
+    socket.emit("oscillation", (2, 1.0, 15))
+    socket.freeze()
+    # messages sent while frozen, for example the end of a condition, are not restored
+    socket.emit("speed", (3, 9.0))
+    sent.clear()
+    assert socket.thaw()
+    assert not socket.paused
+    assert motion(sent) == [("speed", (2.5,)), ("oscillation", (1.0, 15))]
+    assert not socket.thaw()
+
+
+def test_thaw_restores_the_motion_of_a_condition_setup():
+    socket, sent = experiment_socket()
+    socket.emit("condition-setup", (1, {"speed": 4.0, "oscillation": [2.0, 30]}))
+    socket.freeze()
+    sent.clear()
+    socket.thaw()
+    assert motion(sent) == [("speed", (4.0,)), ("oscillation", (2.0, 30))]
+
+
+def test_thaw_after_stop_does_not_restore():
+    socket, sent = experiment_socket()
+    socket.emit("speed", (1, 2.5))
+    socket.freeze()
+    sent.clear()
+    assert socket.thaw(restore=False)
+    assert not sent
+    assert not socket.paused
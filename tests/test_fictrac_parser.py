@@ -0,0 +1,62 @@
+"""Tests of the framing and parsing of FicTrac output in `Experiment.FicTracParser`"""
+
+from Experiment import FicTracParser, FakeFicTrac
+
+
+def fictrac_lines(count):
+    """FicTrac lines with the counters 1 to `count`, as FicTrac sends them."""
+    sender = FakeFicTrac()
+    return [sender.frame(1_700_000_000_000_000_000 + counter * 10_000_000)
+            for counter in range(count)]
+
+
+def test_lines_of_one_datagram():
+    lines = fictrac_lines(3)
+    parser = FicTracParser()
+    frames = parser.feed(b"".join(lines), 42)
+    assert [frame.counter for frame in frames] == [1, 2, 3]
+    assert all(frame.receive_ns == 42 for frame in frames)
+    assert parser.pending == b""
+    assert parser.malformed == 0
+
+
+def test_line_split_across_datagrams():
+    data = b"".join(fictrac_lines(2))
+    for cut in range(1, len(data)):
+        parser = FicTracParser()
+        frames = parser.feed(data[:cut], 1) + parser.feed(data[cut:], 2)
+        assert [frame.counter for frame in frames] == [1, 2], cut
+        assert parser.malformed == 0
+
+
+def test_columns_and_values():
+    line = fictrac_lines(1)[0]
+    frame = FicTracParser().parse(line.rstrip(b"\n"), 1_700_000_000_001_000_000)
+    values = frame.values
+    assert len(values) == 23
+    assert frame.counter == values[0] == 1
+    assert frame.heading == values[16]
+    assert frame.timestamp == values[21]
+    assert frame.capture_ns == round(frame.timestamp * 1e6)
+
+
+def test_capture_time_outside_window_is_receive_time():
+    line = fictrac_lines(1)[0].rstrip(b"\n")
+    frame = FicTracParser().parse(line, 5)
+    assert frame.capture_ns == 5
+
+
+def test_malformed_lines_are_counted():
+    good = fictrac_lines(1)[0]
+    parser = FicTracParser()
+    frames = parser.feed(b"hello\nFT, 1, 2\n" + good + b"FT" + b", x" * 23 + b"\n\n", 0)
+    assert len(frames) == 1
+    assert parser.malformed == 3
+
+
+def test_overlong_pending_line_is_dropped():
+    parser = FicTracParser(max_pending=16)
+    assert parser.feed(b"x" * 32, 0) == []
+    assert parser.pending == b""
+    assert parser.malformed == 1
+    assert [frame.counter for frame in parser.feed(fictrac_lines(1)[0], 0)] == [1]
@@ -0,0 +1,92 @@
+"""Tests of the ring buffer of `Experiment.FicTracService` and its subscriptions"""
+
+import time
+
+from Experiment import FicTracFrame, FicTracService
+
+
+def publish(service, count):
+    """Publish `count` frames with the next counters."""
+    for _ in range(count):
+        counter = service.count + 1
+        service.publish(FicTracFrame(counter, counter, 0.0, 0.0, b""))
+
+
+def counters(frames):
+    """Counters of frames."""
+    return [frame.counter for frame in frames]
+
+
+def test_subscription_reads_frames_in_order():
+    service = FicTracService(None, capacity=8)
+    publish(service, 2)
+    subscription = service.subscribe("test")
+    publish(service, 3)
+    assert subscription.lag == 3
+    assert counters(subscription.read()) == [3, 4, 5]
+    assert subscription.lag == 0
+    assert subscription.read() == []
+    assert subscription.status()["read"] == 3
+
+
+def test_overrun_of_the_ring_is_counted_as_missed():
+    service = FicTracService(None, capacity=4)
+    subscription = service.subscribe("test")
+    publish(service, 10)
+    assert counters(subscription.read()) == [7, 8, 9, 10]
+    status = subscription.status()
+    assert status["missed"] == 6
+    assert status["skipped"] == 0
+    assert status["max-lag"] == 10
+
+
+def test_newest_only_counts_skipped_frames():
+    service = FicTracService(None, capacity=8)
+    subscription = service.subscribe("test")
+    publish(service, 5)
+    assert counters(subscription.read(newest_only=True)) == [5]
+    publish(service, 1)
+    assert counters(subscription.read(newest_only=True)) == [6]
+    status = subscription.status()
+    assert (status["skipped"], status["missed"], status["read"]) == (4, 0, 2)
+
+
+def test_subscribers_read_independently():
+    service = FicTracService(None, capacity=4)
+    slow = service.subscribe("slow")
+    fast = service.subscribe("fast")
+    publish(service, 3)
+    assert counters(fast.read()) == [1, 2, 3]
+    publish(service, 3)
+    assert counters(fast.read()) == [4, 5, 6]
+    assert counters(slow.read()) == [3, 4, 5, 6]
+    assert (slow.missed, fast.missed) == (2, 0)
+
+
+def test_wait_returns_for_a_frame_or_the_timeout():
+    service = FicTracService(None, capacity=4)
+    subscription = service.subscribe("test")
+    assert not subscription.wait(0.01)
+    publish(service, 1)
+    assert subscription.wait(0.01)
+
+
+def test_interrupt_ends_the_wait():
+    service = FicTracService(None, capacity=4)
+    subscription = service.subscribe("test")
+    subscription.interrupt()
+    start = time.monotonic()
+    assert not subscription.wait(1.0)
+    assert time.monotonic() - start < 0.1
+
+
+def test_close_logs_the_counters_once():
+    logged = []
+    service = FicTracService(None, lambda *args: logged.append(args), capacity=4)
+    subscription = service.subscribe("test")
+    publish(service, 6)
+    subscription.read()
+    subscription.close()
+    subscription.close()
+    assert [entry[1] for entry in logged] == ["fictrac-subscription"]
+    assert service.subscriptions == []
@@ -0,0 +1,85 @@
+"""Tests of launching and arming protocols with `Experiment.RunnerRegistry`"""
+
+from Experiment import RunnerRegistry
+
+
+class TaskRecorder():
+    """Stands in for `SocketIO` and keeps the background tasks instead of starting them."""
+
+    def __init__(self):
+        self.tasks = []
+
+    def start_background_task(self, target, *args):
+        self.tasks.append((target, args))
+
+    def run_next(self):
+        """Run the oldest background task that was not run yet."""
+        target, args = self.tasks.pop(0)
+        target(*args)
+
+
+def protocol(runner):
+    """Protocol that ends right away."""
+
+
+def test_second_launch_keeps_the_active_runner():
+    tasks = TaskRecorder()
+    registry = RunnerRegistry(tasks)
+    assert registry.launch("rig", "optomotor", protocol)
+    runner = registry.get("rig")
+    assert not registry.launch("rig", "optomotor", protocol)
+    assert registry.get("rig") is runner
+    assert runner.state == "waiting"
+    assert len(tasks.tasks) == 1
+
+
+def test_launch_replaces_a_waiting_protocol():
+    tasks = TaskRecorder()
+    registry = RunnerRegistry(tasks)
+    registry.launch("rig", "optomotor", protocol)
+    waiting = registry.get("rig")
+    assert registry.launch("rig", "closedloop", protocol)
+    assert waiting.state == "replaced"
+    assert registry.get("rig").name == "closedloop"
+
+
+def test_launch_does_not_replace_a_running_protocol():
+    tasks = TaskRecorder()
+    registry = RunnerRegistry(tasks)
+    registry.launch("rig", "optomotor", protocol)
+    running = registry.get("rig")
+    running.start()
+    assert not registry.launch("rig", "closedloop", protocol)
+    assert registry.get("rig") is running
+    assert running.state == "running"
+
+
+def test_rigs_run_independently():
+    tasks = TaskRecorder()
+    registry = RunnerRegistry(tasks)
+    assert registry.launch("left", "optomotor", protocol)
+    assert registry.launch("right", "optomotor", protocol)
+    assert len(tasks.tasks) == 2
+
+
+def test_launch_after_the_end_starts_again():
+    tasks = TaskRecorder()
+    registry = RunnerRegistry(tasks)
+    registry.launch("rig", "optomotor", protocol)
+    tasks.run_next()
+    assert registry.get("rig").state == "completed"
+    assert registry.launch("rig", "optomotor", protocol)
+    assert registry.get("rig").state == "waiting"
+
+
+def test_armed_protocol_launches_after_the_current_one():
+    tasks = TaskRecorder()
+    registry = RunnerRegistry(tasks)
+    registry.launch("rig", "optomotor", protocol)
+    armed = registry.arm("rig", "closedloop", protocol)
+    assert armed.state == "armed"
+    assert registry.queued("rig") == ["closedloop"]
+    tasks.run_next()
+    assert registry.get("rig") is armed
+    assert armed.state == "waiting"
+    assert registry.queued("rig") == []
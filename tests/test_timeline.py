@@ -0,0 +1,142 @@
+"""Tests of the deadline schedule, pause, and stop of `Experiment.Timeline`"""
+
+import json
+import threading
+import time
+
+import pytest
+
+from Experiment import Timeline, TimelineStopped
+
+
+def elapsed_ms(since):
+    """Time in ms since a `time.monotonic()` value."""
+    return (time.monotonic() - since) * 1000
+
+
+def later(seconds, action):
+    """Call `action` after `seconds` in another thread."""
+    timer = threading.Timer(seconds, action)
+    timer.start()
+    return timer
+
+
+def test_deadlines_absorb_delays_between_phases():
+    timeline = Timeline()
+    start = time.monotonic()
+    timeline.start()
+    timeline.wait(30)
+    # work between two phases, for example sending the setup of the next condition
+    time.sleep(0.04)
+    timeline.wait(30)
+    # the second phase ends 60 ms after the start, not 30 ms after the end of the delay
+    assert 60 <= elapsed_ms(start) < 85
+
+
+def test_late_phase_reports_its_drift():
+    timeline = Timeline()
+    timeline.start()
+    time.sleep(0.05)
+    drift_ns = timeline.wait(10)
+    assert drift_ns >= 40_000_000
+    # the next phase starts from the scheduled end, so it makes up the drift
+    start = time.monotonic()
+    assert timeline.wait(50) >= 0
+    assert elapsed_ms(start) < 35
+
+
+def test_phases_are_logged():
+    logged = []
+    timeline = Timeline(lambda *args: logged.append(args))
+    timeline.wait(5, "pretrial")
+    timeline.wait(5, "trial")
+    phases = [json.loads(value) for _, key, value in logged if key == "timeline-phase"]
+    assert [phase["phase"] for phase in phases] == ["pretrial", "trial"]
+    assert [phase["scheduled"] for phase in phases] == [5_000_000, 10_000_000]
+
+
+def test_resume_moves_the_deadline_by_the_pause():
+    logged = []
+    timeline = Timeline(lambda *args: logged.append(args))
+    start = time.monotonic()
+    timeline.start()
+    later(0.02, timeline.pause)
+    later(0.07, timeline.resume)
+    timeline.wait(50)
+    # 50 ms of the phase and the time it was paused, about 50 ms
+    resumed = [json.loads(value) for _, key, value in logged if key == "timeline-resume"]
+    paused_ms = resumed[0]["paused"] / 1e6
+    assert 50 + paused_ms <= elapsed_ms(start) < 50 + paused_ms + 25
+
+
+def test_resume_moves_later_deadlines():
+    timeline = Timeline()
+    timeline.start()
+    assert timeline.pause()
+    time.sleep(0.05)
+    assert timeline.resume()
+    start = time.monotonic()
+    timeline.wait(20)
+    timeline.wait(20)
+    assert 40 <= elapsed_ms(start) < 70
+
+
+def test_pause_before_the_start_only_holds_after_the_start():
+    timeline = Timeline()
+    timeline.pause()
+    time.sleep(0.05)
+    start = time.monotonic()
+    later(0.05, timeline.resume)
+    timeline.wait(20)
+    # 50 ms paused after the first wait started and the 20 ms of the phase
+    assert 70 <= elapsed_ms(start) < 100
+
+
+def test_pause_and_resume_only_once():
+    timeline = Timeline()
+    assert not timeline.resume()
+    assert timeline.pause()
+    assert not timeline.pause()
+    assert timeline.resume()
+    assert not timeline.resume()
+
+
+def test_stop_raises_in_a_running_wait():
+    timeline = Timeline()
+    start = time.monotonic()
+    later(0.02, timeline.stop)
+    with pytest.raises(TimelineStopped):
+        timeline.wait(1000, "trial")
+    assert elapsed_ms(start) < 100
+    assert timeline.phase == "trial"
+
+
+def test_stop_raises_in_every_later_wait():
+    timeline = Timeline()
+    timeline.stop()
+    with pytest.raises(TimelineStopped):
+        timeline.wait(10)
+    with pytest.raises(TimelineStopped):
+        timeline.sleep(0.01)
+    assert not timeline.pause()
+
+
+def test_stop_ends_a_paused_wait():
+    timeline = Timeline()
+    timeline.pause()
+    later(0.02, timeline.stop)
+    with pytest.raises(TimelineStopped):
+        timeline.wait(10)
+
+
+def test_wait_for_ends_with_the_event_or_the_stop():
+    timeline = Timeline()
+    event = threading.Event()
+    assert not timeline.wait_for(event, 0.01)
+    later(0.01, event.set)
+    assert timeline.wait_for(event, 1.0)
+    start = time.monotonic()
+    later(0.02, timeline.stop)
+    with pytest.raises(TimelineStopped):
+        timeline.wait_for(threading.Event(), 1.0)
+    assert elapsed_ms(start) < 100